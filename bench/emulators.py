@@ -0,0 +1,477 @@
+"""Serial bootloader emulators on pseudo-terminals (Linux/macOS)
+
+EspRomEmulator answers the ESP32 ROM loader protocol (SLIP framed commands),
+accepts the flasher stub upload and then behaves as the stub: compressed and
+plain flash writes, on-chip MD5, flash reads and baud changes. Stk500Emulator
+is an ATmega328P/2560 with the Arduino (optiboot) STK500v1 bootloader.
+
+Both keep their flash in memory and time-stamp protocol milestones in
+.events, so a benchmark can split a run into phases. Serial line time is
+modelled at 10 bits per byte for the current baud rate, because a pty
+itself transfers at memory speed. Flash erase and page write times can be
+added with erase_seconds_per_sector / write_seconds_per_page.
+
+Reset lines (DTR/RTS) do not exist on a pty: ESP tools must use the
+"no-reset" connect and reset modes.
+"""
+import os
+import tty
+import time
+import zlib
+import struct
+import select
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+SLIP_ESC_END = 0xDC
+SLIP_ESC_ESC = 0xDD
+
+
+class PtyDevice:
+    """A device at the far end of a pseudo-terminal, served by a background thread"""
+
+    def __init__(self, baud: int):
+        self.baud = baud
+        self.events: List[Tuple[str, float]] = []
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._line_free_at = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"emulator {self.port}", daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def event(self, name: str):
+        self.events.append((name, time.perf_counter()))
+
+    def first_event(self, name: str) -> Optional[float]:
+        return next((at for event, at in self.events if event == name), None)
+
+    def last_event(self, name: str) -> Optional[float]:
+        return next((at for event, at in reversed(self.events) if event == name), None)
+
+    def _line_time(self, nbytes: int):
+        """Hold the line for as long as nbytes take at the current baud rate"""
+        now = time.perf_counter()
+        start = max(now, self._line_free_at)
+        self._line_free_at = start + nbytes * 10 / self.baud
+        delay = self._line_free_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def send(self, data: bytes):
+        self._line_time(len(data))
+        view = memoryview(data)
+        while view:
+            written = os.write(self._master, view)
+            view = view[written:]
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 65536)
+            except OSError:
+                # No process has the slave open at the moment (between tool runs)
+                time.sleep(0.01)
+                continue
+            self._line_time(len(data))
+            self.received(data)
+
+    def received(self, data: bytes):
+        raise NotImplementedError
+
+
+# ─────────────────────────────
+# ESP32 ROM LOADER AND FLASHER STUB
+# ─────────────────────────────
+ESP_SYNC = 0x08
+ESP_FLASH_BEGIN = 0x02
+ESP_FLASH_DATA = 0x03
+ESP_FLASH_END = 0x04
+ESP_MEM_BEGIN = 0x05
+ESP_MEM_END = 0x06
+ESP_MEM_DATA = 0x07
+ESP_WRITE_REG = 0x09
+ESP_READ_REG = 0x0A
+ESP_SPI_SET_PARAMS = 0x0B
+ESP_SPI_ATTACH = 0x0D
+ESP_CHANGE_BAUDRATE = 0x0F
+ESP_FLASH_DEFL_BEGIN = 0x10
+ESP_FLASH_DEFL_DATA = 0x11
+ESP_FLASH_DEFL_END = 0x12
+ESP_SPI_FLASH_MD5 = 0x13
+ESP_GET_SECURITY_INFO = 0x14
+ESP_ERASE_FLASH = 0xD0
+ESP_ERASE_REGION = 0xD1
+ESP_READ_FLASH = 0xD2
+
+ESP_ROM_BAUD = 115200
+ESP_SECTOR_SIZE = 4096
+ESP_INVALID_COMMAND = 0x05
+
+ESP32_MAGIC_REG = 0x40001000
+ESP32_MAGIC_VALUE = 0x00F01D83
+ESP32_EFUSE_BASE = 0x3FF5A000
+ESP32_UART_CLKDIV_REG = 0x3FF40014
+ESP32_RTCCALICFG1 = 0x3FF5F06C
+ESP32_SPI_W0_REG = 0x3FF42000 + 0x80
+# Winbond W25Q32 (4 MB): manufacturer 0xEF, device 0x4016
+FLASH_ID_4MB = 0x001640EF
+
+
+def slip_encode(packet: bytes) -> bytes:
+    return (bytes([SLIP_END])
+            + packet.replace(b"\xdb", b"\xdb\xdd").replace(b"\xc0", b"\xdb\xdc")
+            + bytes([SLIP_END]))
+
+
+class EspRomEmulator(PtyDevice):
+    """ESP32 in download mode: ROM loader first, flasher stub after it is uploaded"""
+
+    def __init__(self, mac: bytes = b"\x24\x0a\xc4\x00\x00\x01", flash_size: int = 4 * 1024 * 1024,
+                 erase_seconds_per_sector: float = 0.0):
+        super().__init__(ESP_ROM_BAUD)
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.erase_seconds_per_sector = erase_seconds_per_sector
+        self.stub = False
+        self.registers: Dict[int, int] = {
+            ESP32_MAGIC_REG: ESP32_MAGIC_VALUE,
+            # efuse words 1 and 2 hold the MAC (word 2 low half = first two bytes)
+            ESP32_EFUSE_BASE + 4: int.from_bytes(mac[2:6], "big"),
+            ESP32_EFUSE_BASE + 8: int.from_bytes(mac[0:2], "big"),
+            # 8 MHz clock calibration as a 40 MHz crystal board reports it
+            ESP32_EFUSE_BASE + 16: 128,
+            ESP32_RTCCALICFG1: 800 << 7,
+            ESP32_UART_CLKDIV_REG: 40000000 // ESP_ROM_BAUD,
+            ESP32_SPI_W0_REG: FLASH_ID_4MB,
+        }
+        self._frame = bytearray()
+        self._in_frame = False
+        self._escape = False
+        self._write = None
+        self._read = None
+
+    # --- SLIP framing ---
+
+    def received(self, data: bytes):
+        for byte in data:
+            if byte == SLIP_END:
+                if self._in_frame and self._frame:
+                    self._packet(bytes(self._frame))
+                self._frame.clear()
+                self._in_frame = True
+            elif not self._in_frame:
+                continue
+            elif self._escape:
+                self._frame.append(SLIP_END if byte == SLIP_ESC_END else SLIP_ESC)
+                self._escape = False
+            elif byte == SLIP_ESC:
+                self._escape = True
+            else:
+                self._frame.append(byte)
+
+    def _reply(self, op: int, value: int = 0, data: bytes = b"", error: int = 0):
+        # The ROM sends 4 status bytes, the stub 2
+        status = bytes([1 if error else 0, error]) + (b"" if self.stub else b"\0\0")
+        body = data + status
+        self.send(slip_encode(struct.pack("<BBHI", 1, op, len(body), value) + body))
+
+    # --- commands ---
+
+    def _packet(self, packet: bytes):
+        if self._read is not None:
+            # Host acknowledging a READ_FLASH block
+            self._read_flash_ack(packet)
+            return
+        if len(packet) < 8 or packet[0] != 0:
+            return
+        op, size = struct.unpack("<BH", packet[1:4])
+        data = packet[8:8 + size]
+        handler = {
+            ESP_SYNC: self._sync,
+            ESP_READ_REG: self._read_reg,
+            ESP_WRITE_REG: lambda op, data: self._reply(op),
+            ESP_SPI_ATTACH: lambda op, data: self._reply(op),
+            ESP_SPI_SET_PARAMS: lambda op, data: self._reply(op),
+            ESP_GET_SECURITY_INFO: lambda op, data: self._reply(op, error=ESP_INVALID_COMMAND),
+            ESP_MEM_BEGIN: self._mem_begin,
+            ESP_MEM_DATA: lambda op, data: self._reply(op),
+            ESP_MEM_END: self._mem_end,
+            ESP_CHANGE_BAUDRATE: self._change_baud,
+            ESP_FLASH_BEGIN: self._flash_begin,
+            ESP_FLASH_DEFL_BEGIN: self._flash_begin,
+            ESP_FLASH_DATA: self._flash_data,
+            ESP_FLASH_DEFL_DATA: self._flash_data,
+            ESP_FLASH_END: self._flash_end,
+            ESP_FLASH_DEFL_END: self._flash_end,
+            ESP_SPI_FLASH_MD5: self._md5,
+            ESP_ERASE_FLASH: self._erase_flash,
+            ESP_ERASE_REGION: self._erase_region,
+            ESP_READ_FLASH: self._read_flash,
+        }.get(op)
+        if handler is None:
+            self._reply(op, error=ESP_INVALID_COMMAND)
+        else:
+            handler(op, data)
+
+    def _sync(self, op, data):
+        if self.first_event("sync") is None:
+            self.event("sync")
+        # The ROM answers a SYNC eight times with a non-zero value, the stub once with 0
+        for _ in range(1 if self.stub else 8):
+            self._reply(op, value=0 if self.stub else 0x20120707)
+
+    def _read_reg(self, op, data):
+        (address,) = struct.unpack("<I", data[:4])
+        self._reply(op, value=self.registers.get(address, 0))
+
+    def _mem_begin(self, op, data):
+        if not self.stub and self.first_event("stub_upload") is None:
+            self.event("stub_upload")
+        self._reply(op)
+
+    def _mem_end(self, op, data):
+        self._reply(op)
+        (no_entry, entry) = struct.unpack("<II", data[:8])
+        if not no_entry:
+            self.stub = True
+            self.send(slip_encode(b"OHAI"))
+            self.event("stub_running")
+
+    def _change_baud(self, op, data):
+        (baud,) = struct.unpack("<I", data[:4])
+        self._reply(op)
+        # Let the reply leave at the old rate, then switch
+        self._line_time(0)
+        self.baud = baud
+        self.event("baud_changed")
+
+    def _erase(self, address: int, size: int):
+        end = min(len(self.flash), address + size)
+        self.flash[address:end] = b"\xff" * (end - address)
+        if self.erase_seconds_per_sector:
+            time.sleep(self.erase_seconds_per_sector * -(-size // ESP_SECTOR_SIZE))
+
+    def _flash_begin(self, op, data):
+        erase_size, _, _, offset = struct.unpack("<IIII", data[:16])
+        if self.first_event("write_begin") is None:
+            self.event("write_begin")
+        compressed = op == ESP_FLASH_DEFL_BEGIN
+        # Compressed writes announce the uncompressed size; the stub erases as it goes
+        self._erase(offset, erase_size)
+        self._write = {
+            "offset": offset,
+            "position": offset,
+            "inflate": zlib.decompressobj() if compressed else None,
+        }
+        self._reply(op)
+
+    def _flash_data(self, op, data):
+        if self._write is None:
+            self._reply(op, error=0x01)
+            return
+        (length,) = struct.unpack("<I", data[:4])
+        block = data[16:16 + length]
+        if self._write["inflate"] is not None:
+            block = self._write["inflate"].decompress(block)
+        position = self._write["position"]
+        end = min(position + len(block), len(self.flash))
+        # Programming NOR flash only clears bits, so the 0xFF padding of a
+        # short last block leaves the sectors after the image as they were
+        current = int.from_bytes(self.flash[position:end], "little")
+        programmed = current & int.from_bytes(block[:end - position], "little")
+        self.flash[position:end] = programmed.to_bytes(end - position, "little")
+        self._write["position"] = position + len(block)
+        self._reply(op)
+
+    def _flash_end(self, op, data):
+        # esptool also sends an empty begin/end pair when it leaves the stub running
+        if self._write and self._write["position"] > self._write["offset"]:
+            self.event("write_end")
+        self._write = None
+        self._reply(op)
+
+    def _md5(self, op, data):
+        address, size = struct.unpack("<II", data[:8])
+        self.event("verify")
+        digest = hashlib.md5(self.flash[address:address + size])
+        self._reply(op, data=digest.digest() if self.stub else digest.hexdigest().encode())
+
+    def _erase_flash(self, op, data):
+        self._erase(0, len(self.flash))
+        self._reply(op)
+
+    def _erase_region(self, op, data):
+        address, size = struct.unpack("<II", data[:8])
+        self._erase(address, size)
+        self._reply(op)
+
+    def _read_flash(self, op, data):
+        address, size, block_size, _ = struct.unpack("<IIII", data[:16])
+        self.event("read")
+        self._reply(op)
+        self._read = {"address": address, "end": address + size, "sent": address, "block": block_size}
+        self._read_flash_next()
+
+    def _read_flash_next(self):
+        read = self._read
+        if read["sent"] >= read["end"]:
+            self.send(slip_encode(hashlib.md5(self.flash[read["address"]:read["end"]]).digest()))
+            self._read = None
+            return
+        block_end = min(read["sent"] + read["block"], read["end"])
+        self.send(slip_encode(bytes(self.flash[read["sent"]:block_end])))
+        read["sent"] = block_end
+
+    def _read_flash_ack(self, packet: bytes):
+        # The host acknowledges every block with the total number of bytes received
+        self._read_flash_next()
+
+
+# ─────────────────────────────
+# ARDUINO STK500v1 BOOTLOADER (optiboot)
+# ─────────────────────────────
+STK_OK = 0x10
+STK_INSYNC = 0x14
+STK_NOSYNC = 0x15
+CRC_EOP = 0x20
+
+AVR_SIGNATURES = {
+    "atmega328p": (b"\x1e\x95\x0f", 32 * 1024, 128),
+    "atmega2560": (b"\x1e\x98\x01", 256 * 1024, 256),
+}
+
+# Command byte -> number of argument bytes before CRC_EOP (page commands are handled separately)
+STK_ARG_BYTES = {
+    0x30: 0,   # GET_SYNC
+    0x41: 1,   # GET_PARAMETER
+    0x42: 20,  # SET_DEVICE
+    0x45: 5,   # SET_DEVICE_EXT
+    0x50: 0,   # ENTER_PROGMODE
+    0x51: 0,   # LEAVE_PROGMODE
+    0x55: 2,   # LOAD_ADDRESS (word address, little endian)
+    0x56: 4,   # UNIVERSAL
+    0x75: 0,   # READ_SIGN
+}
+STK_PROG_PAGE = 0x64
+STK_READ_PAGE = 0x74
+
+
+class Stk500Emulator(PtyDevice):
+    """ATmega with an optiboot bootloader speaking STK500v1"""
+
+    def __init__(self, chip: str = "atmega328p", baud: int = 115200, write_seconds_per_page: float = 0.0):
+        super().__init__(baud)
+        signature, flash_size, page_size = AVR_SIGNATURES[chip]
+        self.signature = signature
+        self.page_size = page_size
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.write_seconds_per_page = write_seconds_per_page
+        self.address = 0
+        self._buffer = bytearray()
+
+    def _reply(self, payload: bytes = b""):
+        self.send(bytes([STK_INSYNC]) + payload + bytes([STK_OK]))
+
+    def received(self, data: bytes):
+        self._buffer += data
+        while self._buffer:
+            consumed = self._command()
+            if not consumed:
+                return
+            del self._buffer[:consumed]
+
+    def _command(self) -> int:
+        """Handle one complete command from the buffer; returns bytes used (0 if incomplete)"""
+        buf = self._buffer
+        cmd = buf[0]
+        if cmd in (STK_PROG_PAGE, STK_READ_PAGE):
+            if len(buf) < 4:
+                return 0
+            length = (buf[1] << 8) | buf[2]
+            memtype = buf[3]
+            total = 5 + (length if cmd == STK_PROG_PAGE else 0)
+            if len(buf) < total:
+                return 0
+            if buf[total - 1] != CRC_EOP:
+                self.send(bytes([STK_NOSYNC]))
+                return total
+            # Flash is word addressed, EEPROM byte addressed
+            address = self.address * 2 if memtype == ord("F") else self.address
+            if cmd == STK_PROG_PAGE:
+                if self.first_event("write_begin") is None:
+                    self.event("write_begin")
+                if memtype == ord("F"):
+                    self.flash[address:address + length] = buf[4:4 + length]
+                    if self.write_seconds_per_page:
+                        time.sleep(self.write_seconds_per_page)
+                self.event("page_written")
+                self._reply()
+            else:
+                # Reading back after writing is verification; writing ended with the last page
+                if self.first_event("write_begin") is not None and self.first_event("write_end") is None:
+                    self.event("write_end")
+                self.event("verify")
+                data = bytes(self.flash[address:address + length]) if memtype == ord("F") else b"\xff" * length
+                self._reply(data)
+            return total
+
+        if cmd not in STK_ARG_BYTES:
+            # Line noise or a resync attempt: drop the byte
+            return 1
+        total = 2 + STK_ARG_BYTES[cmd]
+        if len(buf) < total:
+            return 0
+        if buf[total - 1] != CRC_EOP:
+            self.send(bytes([STK_NOSYNC]))
+            return total
+
+        if cmd == 0x30:
+            if self.first_event("sync") is None:
+                self.event("sync")
+            self._reply()
+        elif cmd == 0x41:
+            # Hardware/software versions as optiboot reports them
+            self._reply(bytes([{0x80: 0x03, 0x81: 0x04, 0x82: 0x04}.get(buf[1], 0x03)]))
+        elif cmd == 0x50:
+            self.event("progmode")
+            self._reply()
+        elif cmd == 0x51:
+            if self.first_event("write_begin") is not None and self.first_event("write_end") is None:
+                self.event("write_end")
+            self.event("progmode_end")
+            self._reply()
+        elif cmd == 0x55:
+            self.address = buf[1] | (buf[2] << 8)
+            self._reply()
+        elif cmd == 0x56:
+            self._reply(b"\x00")
+        elif cmd == 0x75:
+            self._reply(self.signature)
+        else:
+            self._reply()
+        return total
@@ -0,0 +1,312 @@
+"""Hardware-free flashing benchmark
+
+Flashes generated images into emulated bootloaders (see emulators.py) through
+the uploader's real code paths and reports end-to-end time, throughput and
+per-phase timings as JSON:
+
+    esptool-cli      build_esptool_command() run as a subprocess
+    esptool-direct   run_esptool_direct() (what frozen builds use)
+    esptool-session  a FlashQueue job through a persistent esptool session
+    avrdude          build_avrdude_command() run as a subprocess (skipped if avrdude is missing)
+    stk500           a FlashQueue job with the built-in STK500v1 programmer
+
+Usage:
+    python bench/run_bench.py                               # default matrix
+    python bench/run_bench.py --sizes 64K,1M --bauds 921600 --paths esptool-session
+    python bench/run_bench.py --compare bench/results/old.json
+
+Runs on Linux and macOS (pseudo-terminals). Every run checks the emulated
+flash against the image, so a fast but wrong path fails the benchmark.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "src"))
+
+from uploader.core import (  # noqa: E402
+    VERSION, build_esptool_command, build_avrdude_command, run_esptool_direct,
+)
+from uploader.jobqueue import FlashQueue, RetryPolicy  # noqa: E402
+from emulators import EspRomEmulator, Stk500Emulator  # noqa: E402
+
+ESP_PATHS = ("esptool-cli", "esptool-direct", "esptool-session")
+AVR_PATHS = ("avrdude", "stk500")
+DEFAULT_SIZES = "64K,256K,1M"
+DEFAULT_BAUDS = "115200,460800,921600"
+DEFAULT_AVR_BAUD = 115200
+ESP_APP_ADDRESS = 0x10000
+# Largest image that fits an ATmega328P behind the bootloader
+AVR_MAX_IMAGE = 30 * 1024
+
+# Phase -> (start events, end event); the first start event that occurred is used.
+# "start"/"end" are the run boundaries, the rest are emulator events.
+PHASES = {
+    "connect": (("start",), "sync"),
+    "stub": (("sync",), "stub_running"),
+    "setup": (("stub_running", "sync"), "write_begin"),
+    "write": (("write_begin",), "write_end"),
+    "verify": (("write_end",), "verify_done"),
+    "finish": (("verify_done",), "end"),
+}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    factor = {"K": 1024, "M": 1024 * 1024}.get(text[-1:], 1)
+    return int(text.rstrip("KM")) * factor
+
+
+def make_image(size: int, seed: int = 1) -> bytes:
+    """Firmware-like image: half incompressible, half repetitive, so compression behaves realistically"""
+    rng = random.Random(seed)
+    noise = rng.randbytes(size // 2)
+    pattern = bytes(range(256)) * (size // 512 + 1)
+    return (noise + pattern)[:size]
+
+
+def write_intel_hex(data: bytes, path: str):
+    """Write data at address 0 as Intel HEX (extended segment records not needed below 64 KB)"""
+    with open(path, 'w') as f:
+        for offset in range(0, len(data), 16):
+            chunk = data[offset:offset + 16]
+            record = bytes([len(chunk), offset >> 8, offset & 0xFF, 0]) + chunk
+            checksum = (-sum(record)) & 0xFF
+            f.write(":" + record.hex().upper() + f"{checksum:02X}\n")
+        f.write(":00000001FF\n")
+
+
+def phase_times(events: List, started: float, ended: float) -> Dict[str, float]:
+    """Per-phase seconds from the emulator's event log"""
+    marks = {"start": started, "end": ended}
+    for name, at in events:
+        marks.setdefault(name, at)
+    # Verification ends with the last verify request (esptool) or read-back (avrdude, stk500)
+    verifies = [at for name, at in events if name == "verify"]
+    if verifies:
+        marks["verify_done"] = verifies[-1]
+    phases = {}
+    for phase, (starts, end) in PHASES.items():
+        start = next((name for name in starts if name in marks), None)
+        if start and end in marks and marks[end] >= marks[start]:
+            phases[phase] = round(marks[end] - marks[start], 4)
+    return phases
+
+
+class QuietLog:
+    """Log callable that keeps output for the report (and echoes it with --verbose)"""
+
+    def __init__(self, verbose: bool):
+        self.verbose = verbose
+        self.lines = []
+
+    def __call__(self, text: str):
+        self.lines.append(text)
+        if self.verbose:
+            sys.stdout.write(text)
+
+    def tail(self, count: int = 15) -> str:
+        return "".join(self.lines)[-2000:].splitlines()[-count:]
+
+
+def _run_queued(config: Dict, port: str, firmware: str, log) -> int:
+    """One job through a FlashQueue, the path the GUI, CLI and daemon take (no retries)"""
+    queue = FlashQueue(log, prefix_ports=False)
+    job = queue.submit(config, port, firmware, retry=RetryPolicy(retries=0))
+    # Until the port is released, i.e. including the final reset
+    queue.join()
+    return job.returncode
+
+
+def run_case(path: str, size: int, baud: int, workdir: str, verbose: bool,
+             erase_ms: float, page_ms: float) -> Dict:
+    """Flash one image through one code path into a fresh emulator"""
+    image = make_image(size)
+    log = QuietLog(verbose)
+    result = {"path": path, "size": size, "baud": baud}
+
+    if path in ESP_PATHS:
+        firmware = os.path.join(workdir, f"bench_{size}.bin")
+        with open(firmware, 'wb') as f:
+            f.write(image)
+        emulator = EspRomEmulator(erase_seconds_per_sector=erase_ms / 1000)
+        config = {
+            "chip": "esp32", "tool": "esptool", "baud": str(baud), "address": hex(ESP_APP_ADDRESS),
+            # A pty has no DTR/RTS: the emulated chip is already in download mode
+            "connect": "no-reset", "reset": "no-reset",
+            "session": path == "esptool-session",
+            # Random bytes, not an ESP image
+            "raw": True,
+        }
+        address = ESP_APP_ADDRESS
+    else:
+        if path == "avrdude" and not shutil.which(
+                build_avrdude_command({"tool": "avrdude", "programmer": "arduino", "chip": "m328p", "baud": "0"}, "", "")[0]):
+            return dict(result, skipped="avrdude not found")
+        firmware = os.path.join(workdir, f"bench_{len(image)}.hex")
+        write_intel_hex(image, firmware)
+        emulator = Stk500Emulator("atmega328p", baud, write_seconds_per_page=page_ms / 1000)
+        config = {"chip": "atmega328p", "tool": path, "baud": str(baud), "programmer": "arduino"}
+        address = 0
+
+    with emulator:
+        started = time.perf_counter()
+        if path == "esptool-cli":
+            returncode = _run_command(build_esptool_command(config, emulator.port, firmware), log)
+        elif path == "esptool-direct":
+            returncode = run_esptool_direct(config, emulator.port, firmware, log)
+        elif path in ("esptool-session", "stk500"):
+            returncode = _run_queued(config, emulator.port, firmware, log)
+        else:
+            returncode = _run_command(build_avrdude_command(config, emulator.port, firmware), log)
+        ended = time.perf_counter()
+        written_ok = bytes(emulator.flash[address:address + len(image)]) == image
+        events = list(emulator.events)
+
+    seconds = ended - started
+    result.update({
+        "ok": returncode == 0 and written_ok,
+        "returncode": returncode,
+        "flash_matches": written_ok,
+        "seconds": round(seconds, 4),
+        "bytes_per_sec": round(len(image) / seconds) if seconds else None,
+        "phases": phase_times(events, started, ended),
+    })
+    if not result["ok"]:
+        result["log_tail"] = log.tail()
+    return result
+
+
+def _run_command(cmd: List[str], log) -> int:
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout:
+        log(line)
+    return process.wait()
+
+
+def esptool_version() -> Optional[str]:
+    try:
+        import esptool
+        return esptool.__version__
+    except ImportError:
+        return None
+
+
+def print_header():
+    print(f"{'path':<16} {'size':>8} {'baud':>8} {'seconds':>8} {'KB/s':>8}  phases")
+
+
+def print_table(results: List[Dict]):
+    for result in results:
+        if result.get("skipped"):
+            print(f"{result['path']:<16} {result['size']:>8} {result['baud']:>8}  skipped: {result['skipped']}")
+            continue
+        rate = f"{result['bytes_per_sec'] / 1024:.1f}" if result["bytes_per_sec"] else "-"
+        phases = " ".join(f"{name}={sec:.2f}" for name, sec in result["phases"].items())
+        status = "" if result["ok"] else "  FAILED"
+        print(f"{result['path']:<16} {result['size']:>8} {result['baud']:>8} "
+              f"{result['seconds']:>8.2f} {rate:>8}  {phases}{status}")
+
+
+def compare(results: List[Dict], previous_path: str):
+    """Print the change in end-to-end time against an earlier results file"""
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)
+    before = {(r["path"], r["size"], r["baud"]): r for r in previous["results"] if r.get("seconds")}
+    print(f"\nCompared with {previous.get('version', '?')} ({os.path.basename(previous_path)}):")
+    for result in results:
+        old = before.get((result["path"], result["size"], result["baud"]))
+        if not old or not result.get("seconds"):
+            continue
+        change = (result["seconds"] - old["seconds"]) / old["seconds"] * 100
+        print(f"  {result['path']:<16} {result['size']:>8} {result['baud']:>8}  "
+              f"{old['seconds']:.2f}s -> {result['seconds']:.2f}s ({change:+.1f}%)")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Hardware-free flashing benchmark")
+    parser.add_argument("--paths", default=",".join(ESP_PATHS + AVR_PATHS),
+                        help="Comma separated code paths to run")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Image sizes, e.g. 64K,1M")
+    parser.add_argument("--bauds", default=DEFAULT_BAUDS, help="ESP baud rates")
+    parser.add_argument("--avr-baud", type=int, default=DEFAULT_AVR_BAUD, help="Arduino bootloader baud rate")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case (the median is reported)")
+    parser.add_argument("--erase-ms", type=float, default=0.0, help="Emulated ESP erase time per 4 KB sector")
+    parser.add_argument("--page-ms", type=float, default=0.0, help="Emulated AVR page write time")
+    parser.add_argument("--output", help="Results file (default bench/results/bench-<version>-<time>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show tool output")
+    args = parser.parse_args(argv)
+
+    paths = [path.strip() for path in args.paths.split(",") if path.strip()]
+    unknown = set(paths) - set(ESP_PATHS + AVR_PATHS)
+    if unknown:
+        parser.error(f"unknown path(s): {', '.join(sorted(unknown))}")
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    bauds = [int(baud) for baud in args.bauds.split(",")]
+
+    # Keep the user's baud and sector caches out of the measurements
+    workdir = tempfile.mkdtemp(prefix="fw_bench_")
+    os.environ["FW_UPLOADER_HOME"] = workdir
+
+    cases = []
+    for path in paths:
+        if path in ESP_PATHS:
+            cases += [(path, size, baud) for size in sizes for baud in bauds]
+        else:
+            # Images are capped to what fits the ATmega328P
+            avr_sizes = sorted({min(size, AVR_MAX_IMAGE) for size in sizes})
+            cases += [(path, size, args.avr_baud) for size in avr_sizes]
+
+    results = []
+    print_header()
+    try:
+        for path, size, baud in cases:
+            runs = [run_case(path, size, baud, workdir, args.verbose, args.erase_ms, args.page_ms)
+                    for _ in range(max(1, args.repeat))]
+            ok_runs = [run for run in runs if run.get("ok")]
+            result = dict(runs[0])
+            if ok_runs:
+                result = sorted(ok_runs, key=lambda run: run["seconds"])[len(ok_runs) // 2]
+                result["runs"] = [run["seconds"] for run in runs]
+                if len(ok_runs) > 1:
+                    result["stdev"] = round(statistics.stdev(run["seconds"] for run in ok_runs), 4)
+            results.append(result)
+            print_table([result])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "esptool": esptool_version(),
+        "settings": {"erase_ms": args.erase_ms, "page_ms": args.page_ms, "repeat": args.repeat},
+        "results": results,
+    }
+    output = args.output or os.path.join(BENCH_DIR, "results",
+                                         f"bench-{VERSION}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    failed = [r for r in results if not r.get("ok") and not r.get("skipped")]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -59,6 +59,23 @@ a = Analysis(
     hiddenimports=[
         'serial.tools.list_ports',
         'tkinter',
+        'uploader.cli',
+        'uploader.gui',
+        # Imported lazily (on first flash / port scan), list them so they are always bundled
+        'uploader.startup',
+        'uploader.esp_session',
+        'uploader.hotplug',
+        'uploader.stk500',
+        'uploader.metrics',
+        'uploader.firmware_store',
+        'uploader.jobqueue',
+        'uploader.engine',
+        'uploader.daemon',
+        'uploader.backup',
+        'uploader.partitions',
+        'uploader.projects',
+        'uploader.adapters',
+        'uploader.releases',
         'json',
         'esptool',
         'esptool.cmds',
@@ -0,0 +1,6 @@
+"""Firmware Uploader package
+
+core - project configs, command builders and flash runners (no GUI)
+cli  - headless command line interface
+gui  - Tkinter user interface
+"""
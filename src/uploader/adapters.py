@@ -0,0 +1,169 @@
+"""Low-latency tuning profiles per USB-serial adapter
+
+Every esptool command and every STK500 page is a command/response round
+trip, and USB-serial adapters hold back short replies: FTDI chips wait for
+their latency timer (16 ms by default) before sending a partly filled USB
+packet. An Arduino page write is two such replies, so the timer rather than
+the baud rate sets the pace.
+
+A profile, keyed by the adapter's USB VID:PID, says how to tune it:
+
+    latency_timer  latency timer in ms, set through Linux sysfs
+                   (/sys/bus/usb-serial/devices/ttyUSB0/latency_timer) for the
+                   duration of a flash and restored afterwards
+    baud           fastest rate known to work: "baud": "auto" starts there
+                   (never probing above it) and uses it until a rate is learned
+    write_block    bytes per esptool flash write packet (the stub's 16 KB at most)
+
+DEFAULT_PROFILES covers common adapters; adapter_profiles.json in the user
+data folder adds or overrides profiles per VID:PID (null turns one off).
+"""
+import os
+import sys
+import json
+from typing import Dict, NamedTuple, Optional
+
+from .core import get_user_data_path
+
+SYSFS_USB_SERIAL = "/sys/bus/usb-serial/devices"
+PROFILES_FILE = "adapter_profiles.json"
+# esptool's flasher stub accepts write packets of up to 16 KB
+MAX_WRITE_BLOCK = 16 * 1024
+
+DEFAULT_PROFILES: Dict[str, Dict] = {
+    "0403:6001": {"name": "FTDI FT232R", "latency_timer": 1, "baud": 921600, "write_block": 16384},
+    "0403:6010": {"name": "FTDI FT2232", "latency_timer": 1, "baud": 921600, "write_block": 16384},
+    "0403:6014": {"name": "FTDI FT232H", "latency_timer": 1, "baud": 921600, "write_block": 16384},
+    "0403:6015": {"name": "FTDI FT-X", "latency_timer": 1, "baud": 921600, "write_block": 16384},
+    "10C4:EA60": {"name": "Silicon Labs CP210x", "baud": 921600, "write_block": 16384},
+    "1A86:7523": {"name": "WCH CH340", "baud": 460800, "write_block": 16384},
+    "1A86:55D4": {"name": "WCH CH9102", "baud": 921600, "write_block": 16384},
+}
+
+
+class AdapterProfile(NamedTuple):
+    name: str
+    latency_timer: Optional[int]
+    baud: Optional[int]
+    write_block: Optional[int]
+
+    @classmethod
+    def from_config(cls, usb_id: str, entry: Dict) -> "AdapterProfile":
+        unknown = set(entry) - {"name", "latency_timer", "baud", "write_block"}
+        if unknown:
+            raise ValueError(f"Unknown adapter profile key(s) for {usb_id}: {', '.join(sorted(unknown))}")
+        latency_timer = entry.get("latency_timer")
+        if latency_timer is not None and not 1 <= int(latency_timer) <= 255:
+            raise ValueError(f"Adapter {usb_id}: latency_timer must be 1-255 ms")
+        write_block = entry.get("write_block")
+        if write_block is not None and not 1024 <= int(write_block) <= MAX_WRITE_BLOCK:
+            raise ValueError(f"Adapter {usb_id}: write_block must be 1024-{MAX_WRITE_BLOCK} bytes")
+        return cls(
+            entry.get("name", usb_id),
+            int(latency_timer) if latency_timer is not None else None,
+            int(entry["baud"]) if entry.get("baud") else None,
+            int(write_block) if write_block is not None else None,
+        )
+
+    def describe(self) -> str:
+        """e.g. baud up to 921600, 16 KB write packets"""
+        parts = []
+        if self.baud:
+            parts.append(f"baud up to {self.baud}")
+        if self.write_block:
+            parts.append(f"{self.write_block // 1024} KB write packets")
+        return ", ".join(parts)
+
+
+def _usb_id(adapter: str) -> str:
+    """VID:PID part of an adapter id (VID:PID or VID:PID:serial)"""
+    return ":".join(adapter.split(":")[:2]).upper()
+
+
+def adapter_profile(adapter: Optional[str]) -> Optional[AdapterProfile]:
+    """Tuning profile for an adapter id (VID:PID, optionally :serial), None if there is none"""
+    if not adapter or adapter.startswith("port:"):
+        return None
+    usb_id = _usb_id(adapter)
+    profiles = dict(DEFAULT_PROFILES)
+    try:
+        with open(get_user_data_path(PROFILES_FILE), 'r') as f:
+            profiles.update({_usb_id(key): value for key, value in json.load(f).items()})
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Warning: Could not load {PROFILES_FILE}: {e}")
+    entry = profiles.get(usb_id)
+    if not entry:
+        return None
+    try:
+        return AdapterProfile.from_config(usb_id, entry)
+    except (ValueError, TypeError) as e:
+        print(f"Warning: {e}")
+        return None
+
+
+def latency_timer_path(port: str) -> Optional[str]:
+    """sysfs latency_timer file of a Linux USB-serial port (None elsewhere or if the driver has none)"""
+    if not sys.platform.startswith("linux"):
+        return None
+    # /dev/serial/by-id/... links resolve to /dev/ttyUSB0
+    path = os.path.join(SYSFS_USB_SERIAL, os.path.basename(os.path.realpath(port)), "latency_timer")
+    return path if os.path.exists(path) else None
+
+
+class AdapterTuning:
+    """Settings applied to one port for one flash; restore() puts the old ones back"""
+
+    def __init__(self, port: str, adapter: str, profile: AdapterProfile):
+        self.port = port
+        self.adapter = adapter
+        self.profile = profile
+        self._restore_latency = None
+
+    def apply(self, log):
+        applied = []
+        if self.profile.latency_timer is not None:
+            applied.append(self._apply_latency_timer(self.profile.latency_timer))
+        if self.profile.describe():
+            applied.append(self.profile.describe())
+        log(f"Adapter tuning ({self.profile.name}, {_usb_id(self.adapter)}): {'; '.join(applied)}\n")
+
+    def _apply_latency_timer(self, latency_timer: int) -> str:
+        path = latency_timer_path(self.port)
+        if path is None:
+            return "latency timer not adjustable here"
+        try:
+            with open(path, 'r') as f:
+                old = int(f.read().strip())
+            if old == latency_timer:
+                return f"latency timer {old} ms"
+            with open(path, 'w') as f:
+                f.write(str(latency_timer))
+        except PermissionError:
+            return f"latency timer left as is (no permission to write {path}, see docs)"
+        except (OSError, ValueError) as e:
+            return f"latency timer left as is ({e})"
+        self._restore_latency = (path, old)
+        return f"latency timer {old} -> {latency_timer} ms"
+
+    def restore(self):
+        if self._restore_latency:
+            path, old = self._restore_latency
+            self._restore_latency = None
+            try:
+                with open(path, 'w') as f:
+                    f.write(str(old))
+            except OSError:
+                # Unplugged: the driver starts with its default again anyway
+                pass
+
+
+def tune_adapter(port: str, adapter: Optional[str], log) -> Optional[AdapterTuning]:
+    """Apply the adapter's profile to port (logged); None if it has no profile"""
+    profile = adapter_profile(adapter)
+    if profile is None:
+        return None
+    tuning = AdapterTuning(port, adapter, profile)
+    tuning.apply(log)
+    return tuning
@@ -0,0 +1,287 @@
+"""Flash backups: read ESP flash into a deduplicated local archive
+
+Flash is read over the esptool session (read-flash) and streamed to disk as
+it arrives, in 64 KB chunks. Each chunk is stored once, zlib-compressed,
+under its SHA-256 (backups/chunks/ab/<sha256>); a backup itself is a small
+JSON record listing its chunks, kept per chip MAC
+(backups/<mac>/<timestamp>.json). Boards running the same firmware share
+all chunks except the ones holding their own data (NVS, SPIFFS), and erased
+flash is one chunk, so backing up a fleet takes little more disk space than
+backing up one board.
+
+Several ports are read at once on the flash engine. "backup": true in a
+project takes a full backup before every flash and does not flash when the
+backup fails. restore() writes a backup back out as a plain image file.
+"""
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .core import (
+    DEFAULT_GANG_CONCURRENCY, FlashProgress, esptool_available, get_user_data_path, prefix_lines,
+    serial_failure_advice,
+)
+from .metrics import current_job
+
+ARCHIVE_DIR = "backups"
+CHUNK_SIZE = 64 * 1024
+# Flash is read from the chip in pieces of this size (one read-flash command each)
+READ_SIZE = 256 * 1024
+
+
+class BackupInfo(NamedTuple):
+    id: str
+    mac: str
+    chip: str
+    address: int
+    size: int
+    sha256: str
+    created: str
+    chunks: List[str]
+
+    def describe(self) -> str:
+        """e.g. 240ac4000001/20261017-101500: esp32, 4096 KB at 0x0, sha256 1a2b3c4d5e6f"""
+        return (f"{self.id}: {self.chip}, {self.size // 1024} KB at {self.address:#x}, "
+                f"sha256 {self.sha256[:12]}")
+
+
+def _mac_key(mac: str) -> str:
+    return mac.replace(":", "").lower()
+
+
+class BackupWriter:
+    """One backup being written: feed it flash data in order, then finish() it"""
+
+    def __init__(self, archive: "BackupArchive", mac: str, chip: str, address: int):
+        self.archive = archive
+        self.mac = mac
+        self.chip = chip
+        self.address = address
+        self.size = 0
+        self.new_bytes = 0
+        self.chunks: List[str] = []
+        self._digest = hashlib.sha256()
+        self._pending = bytearray()
+
+    def write(self, data: bytes):
+        self._digest.update(data)
+        self.size += len(data)
+        self._pending += data
+        while len(self._pending) >= CHUNK_SIZE:
+            self._store(self._pending[:CHUNK_SIZE])
+            del self._pending[:CHUNK_SIZE]
+
+    def _store(self, data):
+        sha256, stored = self.archive.put_chunk(data)
+        self.chunks.append(sha256)
+        self.new_bytes += stored
+
+    def finish(self) -> BackupInfo:
+        """Store the last partial chunk and record the backup"""
+        if self._pending:
+            self._store(self._pending)
+            self._pending = bytearray()
+        return self.archive.record(self.mac, self.chip, self.address, self.size,
+                                   self._digest.hexdigest(), self.chunks)
+
+
+class BackupArchive:
+    """Chunk-deduplicated flash backups in the user data folder"""
+
+    def __init__(self, root: Optional[str] = None):
+        self._root = root
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> str:
+        if not self._root:
+            self._root = get_user_data_path(ARCHIVE_DIR)
+        os.makedirs(self._root, exist_ok=True)
+        return self._root
+
+    def _chunk_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "chunks", sha256[:2], sha256)
+
+    def put_chunk(self, data) -> Tuple[str, int]:
+        """Store a chunk unless it is already there; returns (sha256, compressed bytes added)"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(sha256)
+        if os.path.exists(path):
+            return sha256, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, 6)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        # Two boards storing the same chunk at once write the same bytes
+        os.replace(tmp_path, path)
+        return sha256, len(compressed)
+
+    def writer(self, mac: str, chip: str, address: int = 0) -> BackupWriter:
+        return BackupWriter(self, mac, chip, address)
+
+    def record(self, mac: str, chip: str, address: int, size: int, sha256: str, chunks: List[str]) -> BackupInfo:
+        folder = os.path.join(self.root, _mac_key(mac))
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            # Two backups of one board within a second get a suffix
+            name, count = stamp, 1
+            while os.path.exists(os.path.join(folder, name + ".json")):
+                count += 1
+                name = f"{stamp}-{count}"
+            record = {"mac": mac, "chip": chip, "address": address, "size": size, "sha256": sha256,
+                      "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "chunk_size": CHUNK_SIZE, "chunks": chunks}
+            path = os.path.join(folder, name + ".json")
+            with open(path + ".tmp", 'w') as f:
+                json.dump(record, f)
+            os.replace(path + ".tmp", path)
+        return self.get(f"{_mac_key(mac)}/{name}")
+
+    def get(self, backup_id: str) -> Optional[BackupInfo]:
+        """Backup by id (<mac>/<timestamp>), or None"""
+        try:
+            with open(os.path.join(self.root, backup_id + ".json"), 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return BackupInfo(backup_id, record["mac"], record["chip"], record["address"], record["size"],
+                          record["sha256"], record["created"], record["chunks"])
+
+    def list(self, mac: Optional[str] = None) -> List[BackupInfo]:
+        """Backups, newest first (only the given board's with mac)"""
+        folders = [_mac_key(mac)] if mac else [
+            entry for entry in os.listdir(self.root) if entry != "chunks"
+        ]
+        backups = []
+        for folder in folders:
+            try:
+                entries = os.listdir(os.path.join(self.root, folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.endswith(".json"):
+                    info = self.get(f"{folder}/{entry[:-5]}")
+                    if info:
+                        backups.append(info)
+        return sorted(backups, key=lambda info: info.created, reverse=True)
+
+    def _read_chunk(self, sha256: str, backup_id: str) -> bytes:
+        try:
+            with open(self._chunk_path(sha256), 'rb') as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise ValueError(f"Backup {backup_id} is damaged: chunk {sha256[:12]} ({e})") from None
+
+    def restore(self, backup_id: str, output_path: str) -> BackupInfo:
+        """Write a backup out as a plain image file, checking its SHA-256"""
+        info = self.get(backup_id)
+        if info is None:
+            raise ValueError(f"No backup {backup_id}")
+        digest = hashlib.sha256()
+        tmp_path = output_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                for sha256 in info.chunks:
+                    data = self._read_chunk(sha256, backup_id)
+                    digest.update(data)
+                    f.write(data)
+            if digest.hexdigest() != info.sha256:
+                raise ValueError(f"Backup {backup_id} is damaged: SHA-256 mismatch")
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, output_path)
+        return info
+
+
+BACKUP_ARCHIVE = BackupArchive()
+
+
+# ─────────────────────────────
+# READING BOARDS
+# ─────────────────────────────
+def backup_session(session, log, address: int = 0, size: Optional[int] = None, on_progress=None,
+                   archive: BackupArchive = BACKUP_ARCHIVE) -> BackupInfo:
+    """Read flash through a connected EspSession into the archive (all of it by default)"""
+    if size is None:
+        from esptool.util import flash_size_bytes
+        if not session.info.flash_size:
+            raise ValueError("Flash size unknown, give the size to back up")
+        size = flash_size_bytes(session.info.flash_size) - address
+
+    log(f"Backing up {size // 1024} KB of flash from {address:#x}...\n")
+    # Chip names as the firmware store has them (ESP32-S3 -> esp32s3)
+    chip = session.info.chip.lower().replace("-", "")
+    writer = archive.writer(session.info.mac, chip, address)
+    started = time.monotonic()
+    for offset in range(0, size, READ_SIZE):
+        writer.write(session.read_flash(address + offset, min(READ_SIZE, size - offset)))
+        if on_progress:
+            done = writer.size
+            rate = done / max(time.monotonic() - started, 1e-6)
+            on_progress(FlashProgress(100.0 * done / size, done, size, rate, (size - done) / rate))
+    info = writer.finish()
+    log(f"Backup {info.describe()} ({writer.new_bytes // 1024} KB new in archive, "
+        f"{time.monotonic() - started:.1f} s)\n")
+    return info
+
+
+def backup_port(config: Dict, port: str, log, address: int = 0, size: Optional[int] = None,
+                reset: bool = True, on_progress=None, archive: BackupArchive = BACKUP_ARCHIVE) -> Optional[BackupInfo]:
+    """Connect to an ESP board and back up its flash; None (logged) if that fails
+
+    With reset the board is reset afterwards; otherwise the session stays open
+    for the flash that follows.
+    """
+    from .esp_session import SESSIONS, DEFAULT_CONNECT_MODE, DEFAULT_RESET_MODE, _connect_auto_baud
+    from .baud import is_auto_baud
+    if config["tool"] != "esptool":
+        raise ValueError("Backups read flash with esptool, this project uses " + config["tool"])
+    if not esptool_available():
+        raise ValueError("Backups need the esptool Python package")
+
+    connect_mode = config.get("connect", DEFAULT_CONNECT_MODE)
+    job = current_job()
+    try:
+        job.mark("port_open")
+        if is_auto_baud(config):
+            session = _connect_auto_baud(SESSIONS, port, config["chip"], log, connect_mode)
+        else:
+            session = SESSIONS.connect(port, log, chip=config["chip"], baud=int(config["baud"]),
+                                       connect_mode=connect_mode)
+        job.set_device(session.info.mac)
+        job.mark("backup")
+        info = backup_session(session, log, address, size, on_progress, archive)
+        if reset:
+            job.mark("reset")
+            session.reset(log, config.get("reset", DEFAULT_RESET_MODE))
+        return info
+    except StopIteration:
+        # Raised by esptool when the serial link dies mid-command
+        log(serial_failure_advice())
+    except Exception as e:
+        log(f"\nA fatal error occurred during the backup: {e}\n")
+    SESSIONS.discard(port)
+    return None
+
+
+async def backup_many(config: Dict, ports: List[str], log, max_parallel: int = DEFAULT_GANG_CONCURRENCY,
+                      address: int = 0, size: Optional[int] = None) -> Dict[str, Optional[BackupInfo]]:
+    """Back up several boards at once, with "[port] "-prefixed output"""
+    from .engine import ENGINE
+    slots = asyncio.Semaphore(max_parallel)
+
+    async def one(port):
+        def port_log(text):
+            log(prefix_lines(f"[{port}] ", text))
+        async with slots:
+            return await ENGINE.to_thread(backup_port, config, port, port_log, address, size)
+
+    results = await asyncio.gather(*(one(port) for port in ports))
+    return dict(zip(ports, results))
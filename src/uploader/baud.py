@@ -0,0 +1,147 @@
+"""Automatic baud rate selection per USB-serial adapter
+
+A project with "baud": "auto" gets the fastest rate its adapter handled
+reliably before. Adapters are identified by USB VID:PID and serial number, so
+the result follows the adapter (and its cable) rather than the COM port name.
+When an adapter has not been seen yet, the rate is probed once on the flasher
+stub: switch to the candidate rate, read a block of flash and check it against
+the chip's own MD5. The first rate that passes is stored. A transfer error at
+the stored rate marks it as failed and the next lower rate is used from then on.
+Rates above the one in the adapter's tuning profile are not probed, and the
+command line paths use that rate until one is learned (see adapters.py).
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+from .core import get_user_data_path
+
+AUTO_BAUD = "auto"
+# Rate used for the CLI fallback paths when nothing is cached yet
+DEFAULT_AUTO_BAUD = 460800
+# Tried fastest first; 115200 always works with the ROM loader
+BAUD_CANDIDATES = [2000000, 1500000, 921600, 460800, 230400, 115200]
+# Flash read per candidate rate (read twice, checked against the on-chip MD5)
+PROBE_BYTES = 32 * 1024
+
+
+def is_auto_baud(config: Dict) -> bool:
+    return str(config.get("baud", "")).lower() == AUTO_BAUD
+
+
+def adapter_key(port: str) -> str:
+    """Identify the USB-serial adapter behind port as VID:PID:serial (port name if not USB)"""
+    import serial.tools.list_ports
+    for p in serial.tools.list_ports.comports():
+        if p.device == port and p.vid is not None:
+            return f"{p.vid:04X}:{p.pid:04X}:{p.serial_number or ''}"
+    return f"port:{port}"
+
+
+class BaudCache:
+    """Best known baud rate per adapter, stored as JSON in the user data folder"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or get_user_data_path("baud_cache.json")
+        self._lock = threading.Lock()
+
+    def _read(self) -> Dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, data: Dict):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, key: str) -> Optional[int]:
+        with self._lock:
+            entry = self._read().get(key)
+        return entry["baud"] if entry else None
+
+    def store(self, key: str, baud: int, bytes_per_sec: float = 0.0, failed: Optional[List[int]] = None):
+        with self._lock:
+            data = self._read()
+            entry = data.get(key, {})
+            entry.update({
+                "baud": baud,
+                "bytes_per_sec": round(bytes_per_sec),
+                "failed": sorted(set(entry.get("failed", []) + (failed or [])), reverse=True),
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            })
+            data[key] = entry
+            self._write(data)
+
+    def failed_rates(self, key: str) -> List[int]:
+        with self._lock:
+            return self._read().get(key, {}).get("failed", [])
+
+    def mark_failed(self, key: str, baud: int) -> int:
+        """Record a transfer error at baud and return the next lower rate to use"""
+        lower = [rate for rate in BAUD_CANDIDATES if rate < baud]
+        fallback = lower[0] if lower else BAUD_CANDIDATES[-1]
+        self.store(key, fallback, failed=[baud])
+        return fallback
+
+
+BAUD_CACHE = BaudCache()
+
+
+def effective_baud(config: Dict, port: str, cache: BaudCache = BAUD_CACHE) -> Dict:
+    """Config with "auto" baud replaced by the cached (or default) rate, for the CLI paths"""
+    if not is_auto_baud(config):
+        return config
+    key = adapter_key(port)
+    baud = cache.lookup(key) or profile_baud(key) or DEFAULT_AUTO_BAUD
+    return dict(config, baud=str(baud))
+
+
+def profile_baud(key: str) -> Optional[int]:
+    """Fastest rate known to work with this kind of adapter (see adapters.py)"""
+    from .adapters import adapter_profile
+    profile = adapter_profile(key)
+    return profile.baud if profile else None
+
+
+def probe_baud(session, log, key: str, cache: BaudCache = BAUD_CACHE) -> int:
+    """Find the fastest stable rate on a connected session (left running at that rate)
+
+    session must be connected at the ROM baud with the stub running. A rate
+    that fails leaves host and chip out of step, so the session reconnects
+    before the next candidate.
+    """
+    known_bad = set(cache.failed_rates(key))
+    rom_baud = session.baud
+    # Rates above the adapter profile's are not worth a failed probe and reconnect
+    limit = profile_baud(key) or BAUD_CANDIDATES[0]
+    for baud in BAUD_CANDIDATES:
+        if baud in known_bad or baud <= rom_baud or baud > limit:
+            continue
+        try:
+            started = time.monotonic()
+            session.change_baud(baud)
+            expected = session.flash_md5(0, PROBE_BYTES)
+            for _ in range(2):
+                if hashlib.md5(session.read_flash(0, PROBE_BYTES)).hexdigest() != expected:
+                    raise IOError("data mismatch")
+            bytes_per_sec = 2 * PROBE_BYTES / (time.monotonic() - started)
+        except Exception as e:
+            log(f"Baud {baud}: unstable ({e})\n")
+            known_bad.add(baud)
+            session.close()
+            session.baud = rom_baud
+            session.connect(log)
+            continue
+        log(f"Baud {baud}: OK ({bytes_per_sec / 1024:.1f} KB/s)\n")
+        cache.store(key, baud, bytes_per_sec, failed=sorted(known_bad))
+        return baud
+
+    cache.store(key, rom_baud, failed=sorted(known_bad))
+    return rom_baud
@@ -0,0 +1,386 @@
+"""Command line interface for headless flashing (no tkinter import)
+
+Usage:
+    firmware_uploader                      # start the GUI
+    firmware_uploader flash --project "Aircue Receiver" --port /dev/ttyUSB0 --file fw.bin
+    firmware_uploader batch manifest.json  # flash many boards from a manifest
+    firmware_uploader watch --project "Aircue Receiver" --file fw.bin   # flash boards as they are plugged in
+    firmware_uploader ports                # list serial ports
+    firmware_uploader projects             # list project configurations
+    firmware_uploader firmware [fw.bin]    # list the firmware store, or add files to it
+    firmware_uploader releases [--fetch]   # the projects' cached firmware releases
+    firmware_uploader dump --project "Aircue Receiver" --port /dev/ttyUSB0 --port /dev/ttyUSB1   # back up flash
+    firmware_uploader backups [ID --output flash.bin]   # list backups, or restore one to a file
+    firmware_uploader serve                # HTTP API on localhost for test automation
+    firmware_uploader --profile-startup    # print (and record) startup timings
+"""
+import os
+import sys
+import json
+import time
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .core import (
+    VERSION, DEFAULT_GANG_CONCURRENCY, MAX_GANG_CONCURRENCY,
+    load_custom_projects, get_project_list, get_project_config, get_project_index, project_registry,
+    list_port_infos, flash_many, resolve_config, with_retries,
+)
+from .jobqueue import FlashQueue
+from .startup import PROFILE, enable_from_argv
+
+COMMANDS = ("flash", "batch", "watch", "ports", "projects", "firmware", "releases", "dump", "backups", "serve")
+
+_print_lock = threading.Lock()
+
+
+def log(text: str):
+    """Write tool output to stdout (safe to call from worker threads)"""
+    with _print_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def check_firmware(config: Dict, firmware_path: Optional[str]) -> str:
+    """The firmware file to flash, "" for the project's release (see releases.py)"""
+    if firmware_path:
+        if not os.path.exists(firmware_path):
+            raise ValueError(f"Firmware file not found: {firmware_path}")
+        return firmware_path
+    if not config.get("releases"):
+        raise ValueError("Give a firmware file, the project has no \"releases\"")
+    return ""
+
+
+def load_manifest(manifest_path: str) -> Tuple[List[Tuple[Dict, str, str, int]], int]:
+    """Read a batch manifest and return ([(config, port, firmware_path, priority)], parallel)
+
+    The manifest is either a list of jobs or an object with "jobs" plus optional
+    "defaults" (merged into every job) and "parallel". Each job needs "project",
+    "port" and "file" ("file" may be left out for projects with "releases");
+    "baud", "incremental", "retries", "backup" and "priority" are optional.
+    Relative file paths are resolved against the manifest's directory.
+    """
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+    defaults = manifest.get("defaults", {})
+    parallel = int(manifest.get("parallel", DEFAULT_GANG_CONCURRENCY))
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    jobs = []
+    seen_ports = set()
+    for idx, entry in enumerate(manifest.get("jobs", []), start=1):
+        job = dict(defaults, **entry)
+        missing = [key for key in ("project", "port") if not job.get(key)]
+        if missing:
+            raise ValueError(f"Job {idx}: missing {', '.join(missing)}")
+        if job["port"] in seen_ports:
+            raise ValueError(f"Job {idx}: port {job['port']} is used by more than one job")
+        seen_ports.add(job["port"])
+
+        config = resolve_config(job["project"], job.get("baud"), job.get("incremental", False), job.get("retries"),
+                                job.get("backup", False))
+        try:
+            firmware_path = check_firmware(config, job.get("file") and os.path.join(base_dir, job["file"]))
+        except ValueError as e:
+            raise ValueError(f"Job {idx}: {e}") from None
+        jobs.append((config, job["port"], firmware_path, int(job.get("priority", 0))))
+
+    if not jobs:
+        raise ValueError("Manifest contains no jobs")
+    return jobs, parallel
+
+
+def cmd_flash(args) -> int:
+    """Flash a single device"""
+    config = resolve_config(args.project, args.baud, args.incremental, args.retries, args.backup)
+    firmware_path = check_firmware(config, args.file)
+
+    log(f"Project: {args.project}\n")
+    log(f"Device: {config['chip']}\n")
+    log(f"Tool: {config['tool']}\n")
+    log(f"Firmware: {os.path.basename(firmware_path) if firmware_path else 'project release'}\n")
+    log(f"Port: {args.port}\n\n")
+
+    queue = FlashQueue(log, prefix_ports=False)
+    job = queue.submit(config, args.port, firmware_path)
+    # Also waits for the board's reset at the end of the job (see esp_session.py)
+    queue.join()
+    return 0 if job.returncode == 0 else 1
+
+
+def cmd_batch(args) -> int:
+    """Flash every job in a manifest with bounded parallelism"""
+    jobs, parallel = load_manifest(args.manifest)
+    if args.parallel:
+        parallel = args.parallel
+    if args.retries is not None:
+        jobs = [(with_retries(config, args.retries), port, firmware_path, priority)
+                for config, port, firmware_path, priority in jobs]
+
+    log(f"Batch: {len(jobs)} job(s), max {parallel} parallel\n\n")
+    results = flash_many(jobs, log, max_parallel=parallel)
+
+    failed = sorted(port for port, code in results.items() if code != 0)
+    log(f"\nBatch finished: {len(results) - len(failed)} ok, {len(failed)} failed\n")
+    if failed:
+        log(f"Failed ports: {', '.join(failed)}\n")
+        return 1
+    return 0
+
+
+def cmd_watch(args) -> int:
+    """Flash every matching board as it is plugged in, until Ctrl+C
+    
+    With several --project/--file pairs each board gets the project its USB
+    identity matches best. Without --file the projects' releases are flashed.
+    """
+    from .hotplug import PortWatcher, AutoFlasher
+    
+    files = args.file or [None] * len(args.project)
+    if len(args.project) != len(files):
+        raise ValueError("Give one --file for every --project (or none to flash the projects' releases)")
+    targets = []
+    for project, firmware_path in zip(args.project, files):
+        config = resolve_config(project, args.baud, args.incremental, args.retries, args.backup)
+        targets.append((project, config, check_firmware(config, firmware_path)))
+    
+    watcher = PortWatcher()
+    watcher.start()
+    flasher = AutoFlasher(watcher, targets, log, max_parallel=args.parallel)
+    flasher.start(include_present=args.now)
+    log(f"Watching for {', '.join(args.project)} boards ({watcher.mode}), Ctrl+C to stop\n\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flasher.stop()
+        watcher.stop()
+    
+    failed = sorted(port for port, code in flasher.results.items() if code != 0)
+    log(f"\nStopped: {len(flasher.results) - len(failed)} ok, {len(failed)} failed\n")
+    return 1 if failed else 0
+
+
+def cmd_ports(args) -> int:
+    """List serial ports with their USB identity and matching projects"""
+    index = get_project_index()
+    for info in list_port_infos():
+        usb_id = f"  [{info.vid:04X}:{info.pid:04X}]" if info.vid is not None else ""
+        projects = [name for name, _ in index.candidates(info)]
+        matches = f"  -> {', '.join(projects)}" if projects else ""
+        print(f"{info.display()}{usb_id}{matches}")
+    return 0
+
+
+def cmd_projects(args) -> int:
+    """List project configurations"""
+    if args.sources:
+        for layer, path, loaded in project_registry().sources:
+            print(f"{layer:9} {path}{'' if loaded else '  (not found)'}")
+        print()
+    for name in get_project_list(show_advanced=args.advanced):
+        config = get_project_config(name)
+        print(f"{name}  ({config['chip']}, {config['tool']})")
+    return 0
+
+
+def cmd_firmware(args) -> int:
+    """Add files to the local firmware store, or list what it holds"""
+    from .firmware_store import FIRMWARE_STORE
+    if args.files:
+        for path in args.files:
+            info = FIRMWARE_STORE.add(path)
+            print(info.describe())
+        return 0
+    for info in FIRMWARE_STORE.list():
+        print(f"{info.describe()}  ({info.size} bytes)")
+    return 0
+
+
+def cmd_releases(args) -> int:
+    """Show the cached release of every project with "releases", fetching them first with --fetch"""
+    from .releases import RELEASES, ReleaseSource
+    configs = {name: get_project_config(name) for name in get_project_list(show_advanced=True)}
+    configs = {name: config for name, config in configs.items() if config.get("releases")}
+    if args.fetch:
+        RELEASES.prefetch(list(configs.values()), log)
+        print()
+    for name, config in configs.items():
+        source = ReleaseSource.from_config(config)
+        info = RELEASES.cached(source)
+        cached = f"{RELEASES.cached_version(source)}, {info.describe()}" if info else "nothing cached"
+        print(f"{name}  ({source.source}{' @ ' + source.version if source.version else ''}): {cached}")
+    return 0
+
+
+def cmd_dump(args) -> int:
+    """Back up the flash of one or more boards into the local archive, in parallel"""
+    from .backup import backup_many
+    from .engine import ENGINE
+    config = resolve_config(args.project, args.baud)
+    if config["tool"] != "esptool":
+        raise ValueError(f"{args.project} is not an ESP project, only ESP flash can be backed up")
+
+    log(f"Backing up {len(args.port)} board(s), max {args.parallel} parallel\n\n")
+    results = ENGINE.run(backup_many(config, args.port, log, args.parallel, args.address, args.size))
+
+    failed = sorted(port for port, info in results.items() if info is None)
+    log(f"\nBackup finished: {len(results) - len(failed)} ok, {len(failed)} failed\n")
+    if failed:
+        log(f"Failed ports: {', '.join(failed)}\n")
+        return 1
+    return 0
+
+
+def cmd_backups(args) -> int:
+    """List flash backups, or write one out to a file"""
+    from .backup import BACKUP_ARCHIVE
+    if args.id:
+        if not args.output:
+            raise ValueError("Give --output to restore a backup to a file")
+        info = BACKUP_ARCHIVE.restore(args.id, args.output)
+        print(f"{info.describe()} -> {args.output}")
+        return 0
+    for info in BACKUP_ARCHIVE.list(args.mac):
+        print(f"{info.describe()}  (MAC {info.mac}, {info.created})")
+    return 0
+
+
+def cmd_serve(args) -> int:
+    """Run the local flashing daemon until Ctrl+C"""
+    from .daemon import serve
+    from .releases import prefetch_in_background
+    daemon = serve(args.host, args.port, args.parallel, log)
+    # Jobs without a file flash the project's release; have it ready offline
+    configs = [get_project_config(name) for name in get_project_list(show_advanced=True)]
+    prefetch_in_background([config for config in configs if config.get("releases")], log)
+    log(f"Firmware Uploader v{VERSION} serving on http://{args.host}:{daemon.port}/ "
+        f"(max {args.parallel} parallel), Ctrl+C to stop\n\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="firmware_uploader",
+        description=f"Firmware Uploader v{VERSION} - run without arguments to start the GUI",
+    )
+    parser.add_argument("--version", action="version", version=f"Firmware Uploader v{VERSION}")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print startup timings and append them to startup.jsonl")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    flash = sub.add_parser("flash", help="Flash one device")
+    flash.add_argument("--project", required=True, help="Project name (see 'projects')")
+    flash.add_argument("--port", required=True, help="Serial port, e.g. /dev/ttyUSB0 or COM3")
+    flash.add_argument("--file", help="Firmware file (.bin or .hex, default: the project's release)")
+    flash.add_argument("--baud", help="Override the project's baud rate")
+    flash.add_argument("--incremental", action="store_true",
+                       help="ESP32 only: write just the flash sectors that changed")
+    flash.add_argument("--retries", type=int, help="Override the project's retry count after a failed flash")
+    flash.add_argument("--backup", action="store_true", help="Back up the board's flash before writing (ESP32)")
+    flash.set_defaults(func=cmd_flash)
+
+    batch = sub.add_parser("batch", help="Flash many devices from a JSON manifest")
+    batch.add_argument("manifest", help="Manifest file")
+    batch.add_argument("--parallel", type=int, choices=range(1, MAX_GANG_CONCURRENCY + 1),
+                       metavar=f"1-{MAX_GANG_CONCURRENCY}", help="Max devices flashed at once")
+    batch.add_argument("--retries", type=int, help="Override the retry count of every job")
+    batch.set_defaults(func=cmd_batch)
+
+    watch = sub.add_parser("watch", help="Flash every matching board as it is plugged in")
+    watch.add_argument("--project", required=True, action="append",
+                       help="Project name (repeat with --file to serve several projects)")
+    watch.add_argument("--file", action="append",
+                       help="Firmware file for that project (default: the project's release)")
+    watch.add_argument("--baud", help="Override the project's baud rate")
+    watch.add_argument("--incremental", action="store_true",
+                       help="ESP32 only: write just the flash sectors that changed")
+    watch.add_argument("--parallel", type=int, default=DEFAULT_GANG_CONCURRENCY,
+                       choices=range(1, MAX_GANG_CONCURRENCY + 1),
+                       metavar=f"1-{MAX_GANG_CONCURRENCY}", help="Max devices flashed at once")
+    watch.add_argument("--retries", type=int, help="Override the projects' retry count after a failed flash")
+    watch.add_argument("--backup", action="store_true", help="Back up every board's flash before writing (ESP32)")
+    watch.add_argument("--now", action="store_true", help="Also flash matching boards already plugged in")
+    watch.set_defaults(func=cmd_watch)
+    
+    ports = sub.add_parser("ports", help="List serial ports")
+    ports.set_defaults(func=cmd_ports)
+
+    projects = sub.add_parser("projects", help="List project configurations")
+    projects.add_argument("--advanced", action="store_true", help="Include generic boards")
+    projects.add_argument("--sources", action="store_true",
+                          help="Also show the config files the projects were merged from")
+    projects.set_defaults(func=cmd_projects)
+
+    firmware = sub.add_parser("firmware", help="List the local firmware store, or add files to it")
+    firmware.add_argument("files", nargs="*", help="Firmware files to add")
+    firmware.set_defaults(func=cmd_firmware)
+
+    releases = sub.add_parser("releases", help="Show the projects' cached firmware releases")
+    releases.add_argument("--fetch", action="store_true", help="Fetch the latest releases first")
+    releases.set_defaults(func=cmd_releases)
+
+    dump = sub.add_parser("dump", help="Back up the flash of ESP boards into the local archive")
+    dump.add_argument("--project", required=True, help="Project name (chip, baud and connect settings)")
+    dump.add_argument("--port", required=True, action="append", help="Serial port (repeat for several boards)")
+    dump.add_argument("--baud", help="Override the project's baud rate")
+    dump.add_argument("--address", type=lambda value: int(value, 0), default=0, help="Start address (default 0)")
+    dump.add_argument("--size", type=lambda value: int(value, 0), help="Bytes to read (default: to the end of flash)")
+    dump.add_argument("--parallel", type=int, default=DEFAULT_GANG_CONCURRENCY,
+                      choices=range(1, MAX_GANG_CONCURRENCY + 1),
+                      metavar=f"1-{MAX_GANG_CONCURRENCY}", help="Max boards read at once")
+    dump.set_defaults(func=cmd_dump)
+
+    backups = sub.add_parser("backups", help="List flash backups, or restore one to a file")
+    backups.add_argument("id", nargs="?", help="Backup to restore (as listed, <mac>/<time>)")
+    backups.add_argument("--output", help="Image file to write the backup to")
+    backups.add_argument("--mac", help="Only list this board's backups")
+    backups.set_defaults(func=cmd_backups)
+
+    from .daemon import DEFAULT_HOST, DEFAULT_PORT
+    serve = sub.add_parser("serve", help="Run a local HTTP API for submitting flash jobs")
+    serve.add_argument("--host", default=DEFAULT_HOST,
+                       help=f"Address to listen on (default {DEFAULT_HOST}, this PC only)")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"TCP port (default {DEFAULT_PORT})")
+    serve.add_argument("--parallel", type=int, default=DEFAULT_GANG_CONCURRENCY,
+                       choices=range(1, MAX_GANG_CONCURRENCY + 1),
+                       metavar=f"1-{MAX_GANG_CONCURRENCY}", help="Max devices flashed at once")
+    serve.set_defaults(func=cmd_serve)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    """Run a CLI subcommand, or start the GUI when none is given"""
+    if argv is None:
+        argv = sys.argv[1:]
+    argv = enable_from_argv(argv)
+    PROFILE.mark("core imported")
+
+    # Anything that isn't a subcommand (including macOS -psn_* launch args) opens the GUI
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help", "--version"):
+        from .gui import main as gui_main
+        gui_main()
+        return 0
+
+    args = build_parser().parse_args(argv)
+    load_custom_projects()
+    PROFILE.mark("projects loaded")
+    PROFILE.report(VERSION)
+    try:
+        return args.func(args)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
@@ -0,0 +1,768 @@
+"""Flashing core: project configs, tool command builders and flash runners.
+
+Nothing in here imports tkinter, so the CLI can reuse it on headless rigs.
+pyserial, subprocess and esptool are imported where they are used, to keep
+startup (especially of the frozen app) short.
+"""
+import os
+import io
+import re
+import sys
+import time
+import contextlib
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .images import resolve_flash_plan
+from .identity import ProjectIndex, port_score
+
+# Directory holding firmware_uploader.py, projects_config.json and _version.txt
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ─────────────────────────────
+# PATH HELPERS FOR BUNDLED TOOLS
+# ─────────────────────────────
+def get_resource_path(relative_path):
+    """Get absolute path to resource, works for dev and PyInstaller"""
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    return os.path.join(base_path, relative_path)
+
+
+def get_user_data_path(*parts):
+    """Get a path in the per-user data folder (logs, caches), creating its parent folder
+    
+    Defaults to ~/.firmware_uploader; set FW_UPLOADER_HOME to move it.
+    """
+    base_path = os.getenv("FW_UPLOADER_HOME") or os.path.join(os.path.expanduser("~"), ".firmware_uploader")
+    path = os.path.join(base_path, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+# ─────────────────────────────
+# VERSION (injected at build time)
+# ─────────────────────────────
+def get_version():
+    """Get version from environment variable or version file"""
+    # Try environment variable first (set during build)
+    version = os.getenv("FW_VERSION")
+    if version:
+        return version
+    
+    # Try the version file (created during build): bundled, then next to the script.
+    # In frozen builds both are the same folder, so it is only checked once.
+    candidates = [get_resource_path("_version.txt"), os.path.join(SRC_DIR, "_version.txt")]
+    for version_file in dict.fromkeys(os.path.normpath(path) for path in candidates):
+        try:
+            with open(version_file, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    
+    # Fallback to DEV (makes it obvious if version wasn't injected)
+    return "DEV"
+
+VERSION = get_version()
+
+def get_bundled_tool_path(tool_name):
+    """Get path to bundled tool executable"""
+    if getattr(sys, 'frozen', False):
+        # Running as compiled executable
+        tools_dir = get_resource_path('tools')
+        if os.name == 'nt':  # Windows
+            tool_path = os.path.join(tools_dir, f"{tool_name}.exe")
+        else:  # macOS/Linux
+            tool_path = os.path.join(tools_dir, tool_name)
+        
+        if os.path.exists(tool_path):
+            return tool_path
+    
+    # Fallback to system PATH
+    return tool_name
+
+# ─────────────────────────────
+# PROJECT CONFIGURATIONS
+# ─────────────────────────────
+# Advanced/generic boards (hidden by default)
+ADVANCED_PROJECTS = {
+    "ESP32 - Generic": {
+        "chip": "esp32",
+        "tool": "esptool",
+        "baud": "460800",
+        "address": "0x10000",
+        "port_hint": "CH9102",
+        "usb": [{"vid": "1A86", "pid": "55D4"}]
+    },
+    "ESP32-S3": {
+        "chip": "esp32s3",
+        "tool": "esptool",
+        "baud": "460800",
+        "address": "0x10000",
+        "port_hint": "USB JTAG",
+        "usb": [{"vid": "303A", "pid": "1001"}]
+    },
+    "ESP32-C3": {
+        "chip": "esp32c3",
+        "tool": "esptool",
+        "baud": "460800",
+        "address": "0x0",
+        "port_hint": "USB JTAG",
+        "usb": [{"vid": "303A", "pid": "1001"}]
+    },
+    "Olimex ESP32-POE-ISO": {
+        "chip": "esp32",
+        "tool": "esptool",
+        "baud": "460800",
+        "address": "0x10000",
+        "port_hint": "CH340 or FT232",
+        "usb": [{"vid": "1A86", "pid": "7523"}, {"vid": "0403", "pid": "6001"}]
+    },
+    "Arduino Uno": {
+        "chip": "atmega328p",
+        "tool": "avrdude",
+        "baud": "115200",
+        "programmer": "arduino",
+        "port_hint": "Arduino Uno",
+        "usb": [{"vid": "2341", "pid": "0043"}, {"vid": "2341", "pid": "0001"}, {"vid": "2A03", "pid": "0043"}]
+    },
+    "Arduino Nano": {
+        "chip": "atmega328p",
+        "tool": "avrdude",
+        "baud": "57600",
+        "programmer": "arduino",
+        "port_hint": "CH340",
+        "usb": [{"vid": "1A86", "pid": "7523"}]
+    },
+    "Arduino Nano (Old Bootloader)": {
+        "chip": "atmega328p",
+        "tool": "avrdude",
+        "baud": "57600",
+        "programmer": "arduino",
+        "port_hint": "FT232",
+        "usb": [{"vid": "0403", "pid": "6001"}]
+    }
+}
+
+def load_custom_projects():
+    """Load the layered project configs and reload them whenever a config file changes"""
+    from .projects import PROJECT_CONFIG
+    for problem in PROJECT_CONFIG.reload().problems:
+        print(f"Warning: {problem}")
+    PROJECT_CONFIG.watch()
+
+def project_registry():
+    """Current compiled project configs (see projects.py)"""
+    from .projects import PROJECT_CONFIG
+    return PROJECT_CONFIG.registry
+
+def get_project_list(show_advanced=False):
+    """Get list of project names based on advanced mode"""
+    return project_registry().project_list(show_advanced)
+
+
+def get_project_index() -> ProjectIndex:
+    """Index of all projects (user projects first) for matching ports to projects
+    
+    Built once per loaded set of project configs.
+    """
+    return project_registry().index
+
+def get_project_config(project_name):
+    """Get configuration for a project (read-only; copy it with dict() to change it)"""
+    return project_registry().projects.get(project_name)
+
+
+def resolve_config(project_name: str, baud: str = None, incremental: bool = False, retries: int = None,
+                   backup: bool = False) -> Dict:
+    """Look up a project config, optionally overriding its baud rate or retry count or enabling
+    incremental flashing or a backup before flashing"""
+    config = get_project_config(project_name)
+    if not config:
+        raise ValueError(f"Unknown project: {project_name}")
+    if baud:
+        config = dict(config, baud=str(baud))
+    if incremental:
+        config = dict(config, incremental=True)
+    if retries is not None:
+        config = with_retries(config, retries)
+    if backup:
+        config = dict(config, backup=True)
+    return config
+
+
+def with_retries(config: Dict, retries: int) -> Dict:
+    """Config with its "retry" count replaced (other retry settings kept)"""
+    return dict(config, retry=dict(config.get("retry") or {}, retries=int(retries)))
+
+
+class PortInfo(NamedTuple):
+    device: str
+    description: str
+    vid: Optional[int]
+    pid: Optional[int]
+    serial_number: Optional[str]
+    manufacturer: Optional[str]
+
+    def display(self) -> str:
+        return f"{self.device} ({self.description})"
+
+
+def list_port_infos() -> List[PortInfo]:
+    """Enumerate serial ports with their USB identity (vid/pid are None for non-USB ports)"""
+    import serial.tools.list_ports
+    return [
+        PortInfo(p.device, p.description or "Unknown device", p.vid, p.pid, p.serial_number, p.manufacturer)
+        for p in serial.tools.list_ports.comports()
+    ]
+
+
+def list_serial_ports(infos: Optional[List[PortInfo]] = None) -> List[Tuple[str, str]]:
+    """Return a list of (device, description) tuples (from infos if given, else a fresh scan)"""
+    if infos is None:
+        infos = list_port_infos()
+    return [(info.device, info.display()) for info in infos]
+
+
+# Per-project "verify": skip it, compare a hash (or a sample) or read everything back
+VERIFY_NONE = "none"
+VERIFY_HASH = "hash"
+VERIFY_FULL = "full"
+VERIFY_POLICIES = (VERIFY_NONE, VERIFY_HASH, VERIFY_FULL)
+
+
+def verify_policy(config: Dict) -> str:
+    """The project's "verify" policy, or what the tool did so far (esptool: hash, AVR: full)"""
+    policy = config.get("verify") or (VERIFY_HASH if config["tool"] == "esptool" else VERIFY_FULL)
+    if policy not in VERIFY_POLICIES:
+        raise ValueError(f"Unknown verify policy {policy!r} (use {', '.join(VERIFY_POLICIES)})")
+    return policy
+
+
+def esptool_connection_args(config: Dict) -> List[str]:
+    """--before/--after for the project's "connect" and "reset" modes (esptool's defaults if unset)"""
+    args = []
+    if config.get("connect"):
+        args += ["--before", config["connect"]]
+    if config.get("reset"):
+        args += ["--after", config["reset"]]
+    return args
+
+
+def build_esptool_command(config: Dict, port: str, firmware_path: str, plan=None) -> List[str]:
+    """Build esptool command for ESP32 devices"""
+    # All segments of the image set go into one write-flash call
+    plan = plan or resolve_flash_plan(config, firmware_path)
+    args = [
+        "--chip", config["chip"],
+        "--baud", config["baud"],
+        "--port", port,
+    ] + esptool_connection_args(config) + ["write-flash"] + plan.esptool_args()
+    
+    # Check if we're running as a frozen executable
+    if getattr(sys, 'frozen', False):
+        # Frozen apps should use run_esptool_direct() instead
+        # This function is only called in development mode or as fallback
+        # Windows - check for standalone esptool first
+        esptool_path = get_bundled_tool_path('esptool')
+        if esptool_path != 'esptool' and os.path.exists(esptool_path):
+            # Standalone esptool executable found
+            return [esptool_path] + args
+        # If no standalone executable, try to find esptool in system PATH
+        # (user may have Python and esptool installed separately)
+        import shutil
+        esptool_cmd = shutil.which('esptool') or shutil.which('esptool.py')
+        if esptool_cmd:
+            return [esptool_cmd] + args
+        # Try with Python in PATH as fallback
+        python_path = shutil.which('python') or shutil.which('python3')
+        if python_path:
+            return [python_path, "-m", "esptool"] + args
+        # Last resort: hope esptool is in PATH
+        return ["esptool"] + args
+    
+    # Use Python module (development environment)
+    return [sys.executable, "-m", "esptool"] + args
+
+
+def build_avrdude_command(config: Dict, port: str, firmware_path: str) -> List[str]:
+    """Build avrdude command for Arduino devices"""
+    # Use bundled avrdude if available
+    avrdude_path = get_bundled_tool_path('avrdude')
+    
+    cmd = [
+        avrdude_path,
+        "-c", config["programmer"],
+        "-p", config["chip"],
+        "-P", port,
+        "-b", config["baud"],
+        "-D",
+        "-U", f"flash:w:{firmware_path}:i"
+    ]
+    # avrdude can only read everything back, so "hash" keeps its full verification
+    if verify_policy(config) == VERIFY_NONE:
+        cmd.append("-V")
+    
+    # Add config file if bundled (Windows needs this)
+    if getattr(sys, 'frozen', False) and os.name == 'nt':
+        tools_dir = get_resource_path('tools')
+        avrdude_conf = os.path.join(tools_dir, 'avrdude.conf')
+        if os.path.exists(avrdude_conf):
+            cmd.insert(1, "-C")
+            cmd.insert(2, avrdude_conf)
+    
+    return cmd
+
+
+class _ThreadOutputRouter(io.TextIOBase):
+    """sys.stdout/sys.stderr stand-in that sends each thread's output to its own buffer"""
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "target", None) or self._fallback
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        # A target that prints itself (the CLI's log writes to stdout) reaches the real stream
+        if getattr(self._local, "forwarding", False):
+            return self._fallback.write(text)
+        self._local.forwarding = True
+        try:
+            return self._target().write(text)
+        finally:
+            self._local.forwarding = False
+
+    def flush(self):
+        target = self._target()
+        if hasattr(target, "flush"):
+            target.flush()
+
+    @contextlib.contextmanager
+    def capture(self, target):
+        """Route output written by the current thread into target"""
+        previous = getattr(self._local, "target", None)
+        self._local.target = target
+        try:
+            yield target
+        finally:
+            self._local.target = previous
+
+
+_output_router_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def capture_thread_output(target):
+    """Capture stdout/stderr of the current thread only (safe for parallel in-process esptool runs)"""
+    with _output_router_lock:
+        if not isinstance(sys.stdout, _ThreadOutputRouter):
+            sys.stdout = _ThreadOutputRouter(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadOutputRouter):
+            sys.stderr = _ThreadOutputRouter(sys.stderr)
+    with sys.stdout.capture(target), sys.stderr.capture(target):
+        yield target
+
+
+# ─────────────────────────────
+# LIVE OUTPUT AND PROGRESS
+# ─────────────────────────────
+# esptool 4.x: "Writing at 0x00010000... (12 %)"
+# esptool 5.x: "Writing at 0x00010000 [====>      ]  12.3% 16384/131072 bytes..."
+ESPTOOL_PROGRESS_RE = re.compile(r"Writing at (0x[0-9a-fA-F]+)\D.*?(\d+(?:\.\d+)?)\s*%")
+
+
+class FlashProgress(NamedTuple):
+    percent: float
+    bytes_done: int
+    total_bytes: int
+    bytes_per_sec: float
+    eta_seconds: Optional[float]
+
+
+def format_progress(progress: FlashProgress) -> str:
+    """Human readable progress line, e.g. 45% - 120.3 KB/s - ETA 0:12"""
+    text = f"{progress.percent:.0f}% - {progress.bytes_per_sec / 1024:.1f} KB/s"
+    if progress.eta_seconds is not None:
+        minutes, seconds = divmod(int(progress.eta_seconds), 60)
+        text += f" - ETA {minutes}:{seconds:02d}"
+    return text
+
+
+class EsptoolProgressParser:
+    """Turn esptool "Writing at ..." lines into FlashProgress updates
+    
+    esptool only prints a percentage per written region, so throughput and ETA
+    are derived from the region sizes and the time since the first "Writing at"
+    line. When several regions are written in one run, pass their sizes as
+    segment_sizes; a drop in percentage marks the start of the next region.
+    """
+
+    def __init__(self, total_bytes: int, on_progress, segment_sizes: Optional[List[int]] = None):
+        self.segment_sizes = segment_sizes or [total_bytes]
+        self.total_bytes = sum(self.segment_sizes)
+        self.on_progress = on_progress
+        self._segment = 0
+        self._segment_base = 0
+        self._started = None
+        self._last_percent = None
+        self._last_reported = None
+
+    def feed(self, line: str):
+        match = ESPTOOL_PROGRESS_RE.search(line)
+        if not match:
+            return
+        segment_percent = float(match.group(2))
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        elif segment_percent < self._last_percent and self._segment + 1 < len(self.segment_sizes):
+            # Next region started
+            self._segment_base += self.segment_sizes[self._segment]
+            self._segment += 1
+        self._last_percent = segment_percent
+
+        bytes_done = self._segment_base + int(self.segment_sizes[self._segment] * segment_percent / 100)
+        percent = 100.0 * bytes_done / self.total_bytes if self.total_bytes else 100.0
+        # Only report whole-percent steps so the UI isn't flooded
+        if self._last_reported is not None and int(percent) == int(self._last_reported) and percent < 100:
+            return
+        self._last_reported = percent
+
+        elapsed = now - self._started
+        bytes_per_sec = bytes_done / elapsed if elapsed > 0 else 0.0
+        eta_seconds = None
+        if bytes_per_sec > 0:
+            eta_seconds = (self.total_bytes - bytes_done) / bytes_per_sec
+        self.on_progress(FlashProgress(percent, bytes_done, self.total_bytes, bytes_per_sec, eta_seconds))
+
+
+# Tool output without a line end is passed on in pieces of at most this many characters
+MAX_LINE_LENGTH = 16 * 1024
+
+
+class StreamingLogWriter(io.TextIOBase):
+    """File-like sink that forwards each complete output line to log as soon as it is written
+    
+    Carriage returns (in-place progress updates) count as line ends too, so
+    progress shows up live instead of after the tool has finished. Only the
+    unfinished line is buffered, and never more than MAX_LINE_LENGTH of it.
+    """
+
+    def __init__(self, log, on_line=None):
+        self.log = log
+        self.on_line = on_line
+        self._partial = ""
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        # Split only the new text, so a long unfinished line isn't scanned again on every write
+        *lines, tail = re.split(r"(?<=[\r\n])", text)
+        if lines:
+            lines[0] = self._partial + lines[0]
+            self._partial = tail
+        else:
+            self._partial += tail
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line:
+                self._emit(line + "\n")
+        if len(self._partial) > MAX_LINE_LENGTH:
+            self.finish()
+        return len(text)
+
+    def finish(self):
+        """Forward whatever is left in the partial line buffer"""
+        if self._partial:
+            self._emit(self._partial + "\n")
+            self._partial = ""
+
+    def _emit(self, line):
+        self.log(line)
+        if self.on_line:
+            self.on_line(line)
+
+
+def make_progress_parser(config: Dict, firmware_path: Optional[str], on_progress,
+                         segment_sizes: Optional[List[int]] = None) -> Optional[EsptoolProgressParser]:
+    """Create a progress parser for esptool output, or None if progress isn't wanted
+    
+    The size to track comes from segment_sizes when given, else from the firmware file.
+    """
+    if not on_progress or config["tool"] != "esptool":
+        return None
+    if not segment_sizes:
+        try:
+            segment_sizes = [os.path.getsize(firmware_path)]
+        except (OSError, TypeError):
+            return None
+    return EsptoolProgressParser(sum(segment_sizes), on_progress, segment_sizes)
+
+
+def esptool_available() -> bool:
+    """True if esptool can be imported in-process (always the case in frozen builds)"""
+    import importlib.util
+    return importlib.util.find_spec("esptool") is not None
+
+
+def serial_failure_advice() -> str:
+    """Troubleshooting text shown when talking to the chip over serial fails"""
+    advice = (
+        "\n"
+        "ERROR: Serial communication failed.\n"
+        "\nPossible causes:\n"
+        "1. Wrong COM port selected\n"
+        "2. Device not in bootloader mode (try holding BOOT button while connecting)\n"
+        "3. USB cable issue (try a different cable)\n"
+        "4. Wrong chip type selected\n"
+    )
+    if os.name != 'nt':
+        advice += "5. Serial port permissions (macOS/Linux may need sudo or dialout group)\n"
+    return advice
+
+
+def run_esptool_direct(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    """Run esptool directly by calling its main function (for frozen exe)"""
+    # Prepare arguments as if they were command-line args
+    plan = resolve_flash_plan(config, firmware_path)
+    for note in plan.notes:
+        log(note + "\n")
+    args = [
+        "--chip", config["chip"],
+        "--baud", config["baud"],
+        "--port", port,
+    ] + esptool_connection_args(config) + ["write-flash"] + plan.esptool_args()
+    
+    # Stream stdout/stderr to the log line by line (per thread, so several ports can flash at once)
+    parser = make_progress_parser(config, firmware_path, on_progress,
+                                  segment_sizes=[os.path.getsize(path) for _, path in plan.segments])
+    output = StreamingLogWriter(log, on_line=parser.feed if parser else None)
+    
+    try:
+        # Import esptool and call its main function
+        import esptool
+        
+        with capture_thread_output(output):
+            try:
+                # Pass our arguments directly instead of patching sys.argv
+                esptool.main(args)
+                returncode = 0
+            except SystemExit as e:
+                returncode = e.code if e.code else 0
+            except StopIteration:
+                # Handle StopIteration which can occur when serial communication fails
+                output.write(serial_failure_advice())
+                returncode = 1
+            finally:
+                output.finish()
+        
+        return returncode
+        
+    except Exception as e:
+        log(f"Error calling esptool: {str(e)}\n")
+        import traceback
+        log(f"Traceback: {traceback.format_exc()}\n")
+        return 1
+
+
+async def flash_job(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    """Flash one device on the flash engine and return the tool's exit code
+    
+    All output goes to log as it is produced; on_progress(FlashProgress) is
+    called while esptool or the built-in STK500 programmer writes. Phase
+    timings of every job are recorded (see metrics.py). The firmware is
+    flashed from the local firmware store, after checking it suits the chip.
+    Every flash runs through jobqueue.FlashQueue, which awaits this (via
+    flash_attempt()) on a port's worker.
+    """
+    from .engine import ENGINE
+    from .metrics import METRICS, FlashJobMetrics, adapter_id, recording
+    from .adapters import tune_adapter
+    job = FlashJobMetrics(config, port, firmware_path, *await ENGINE.to_thread(adapter_id, port))
+    try:
+        with recording(job):
+            job_log = job.wrap_log(log)
+            # Low-latency settings for the adapter, undone once the flash is over (see adapters.py)
+            tuning = await ENGINE.to_thread(tune_adapter, port, job.adapter, job_log)
+            try:
+                returncode = await _flash_job(config, port, firmware_path, job_log, on_progress)
+            finally:
+                if tuning:
+                    await ENGINE.to_thread(tuning.restore)
+    except BaseException as e:
+        job.finish(1, error=str(e) or type(e).__name__)
+        METRICS.record(job)
+        raise
+    job.finish(returncode)
+    METRICS.record(job)
+    log(job.summary() + "\n")
+    return returncode
+
+
+async def _flash_job(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    from .engine import ENGINE
+    from .firmware_store import FIRMWARE_STORE, prepare_firmware
+    # Hashing and copying a large image from a share shouldn't hold up other ports
+    firmware_path = await ENGINE.to_thread(prepare_firmware, config, firmware_path, log)
+    # The store must not prune the image while it is being written
+    with FIRMWARE_STORE.pinned(firmware_path):
+        return await _write_firmware(config, port, firmware_path, log, on_progress)
+
+
+async def _write_firmware(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    from .engine import ENGINE
+    # Prefer a persistent esptool session (no process spawn, connection reused);
+    # "session": false in a project config falls back to the esptool CLI
+    use_session = config["tool"] == "esptool" and config.get("session", True) and esptool_available()
+    
+    if config.get("backup"):
+        # The board is only overwritten once its current flash is in the archive;
+        # a session flash goes on over the backup's connection
+        from .backup import backup_port
+        if await ENGINE.to_thread(backup_port, config, port, log, reset=not use_session) is None:
+            log("❌ Backup failed, the board was not flashed\n")
+            return 1
+    
+    if use_session:
+        from .esp_session import run_esptool_session
+        log("Running esptool (session)...\n\n")
+        return await ENGINE.to_thread(run_esptool_session, config, port, firmware_path, log, on_progress)
+    
+    # Another tool opens the port now: reset and close a session an earlier job left open
+    await ENGINE.to_thread(release_esp_session, port, log)
+    
+    if config["tool"] == "stk500":
+        # Built-in programmer for optiboot boards (no avrdude process)
+        from .stk500 import run_stk500
+        log("Running built-in STK500 programmer...\n\n")
+        return await run_stk500(config, port, firmware_path, log, on_progress)
+    
+    if config["tool"] == "esptool":
+        # The esptool CLI needs a number; use what auto-baud learned for this adapter
+        from .baud import effective_baud
+        config = await ENGINE.to_thread(effective_baud, config, port)
+    
+    # Check if we should call esptool directly (frozen exe) or via subprocess
+    # Note: For frozen apps, we use direct Python call to avoid subprocess issues
+    use_direct_esptool = (config["tool"] == "esptool" and 
+                          getattr(sys, 'frozen', False))
+    
+    if use_direct_esptool:
+        # Running as frozen exe - call esptool directly (avoids subprocess issues)
+        log("Running esptool (bundled)...\n\n")
+        returncode = await ENGINE.to_thread(run_esptool_direct, config, port, firmware_path, log, on_progress)
+    else:
+        returncode = await _run_tool_process(config, port, firmware_path, log, on_progress)
+    
+    if returncode == 0 and config["tool"] == "esptool" and verify_policy(config) == VERIFY_FULL:
+        # esptool's command line only checks the MD5; read the flash back in a second connection
+        if not esptool_available():
+            log("\n⚠ Full verification needs the esptool Python package, only the MD5 was checked\n")
+            return returncode
+        from .esp_session import verify_read_back
+        return await ENGINE.to_thread(verify_read_back, config, port, firmware_path, log)
+    return returncode
+
+
+async def _run_tool_process(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    """Run esptool or avrdude as a subprocess, streaming its output to log"""
+    # Build command based on tool
+    segment_sizes = None
+    if config["tool"] == "esptool":
+        plan = resolve_flash_plan(config, firmware_path)
+        for note in plan.notes:
+            log(note + "\n")
+        segment_sizes = [os.path.getsize(path) for _, path in plan.segments]
+        cmd = build_esptool_command(config, port, firmware_path, plan)
+    elif config["tool"] == "avrdude":
+        cmd = build_avrdude_command(config, port, firmware_path)
+    else:
+        raise ValueError(f"Unsupported tool: {config['tool']}")
+    
+    log(f"Command: {' '.join(cmd)}\n\n")
+    
+    from .engine import run_process
+    parser = make_progress_parser(config, firmware_path, on_progress, segment_sizes)
+    return await run_process(cmd, log, on_line=parser.feed if parser else None)
+
+
+# ─────────────────────────────
+# GANG FLASHING (same image to many ports)
+# ─────────────────────────────
+# Parallel writes per USB hub before bandwidth becomes the bottleneck
+DEFAULT_GANG_CONCURRENCY = 4
+MAX_GANG_CONCURRENCY = 16
+
+
+def find_matching_ports(config: Dict, ports: List[PortInfo]) -> List[str]:
+    """Return all port devices matching the project's USB identity (or port hint)"""
+    if not config:
+        return []
+    return [info.device for info in ports if port_score(config, info) > 0]
+
+
+def release_esp_session(port: str, log):
+    """Reset the board and close the esptool session left open on port, if any (see esp_session.py)"""
+    # Sessions only exist if a session flash ran (the module is imported on first use)
+    esp_session = sys.modules.get(f"{__package__}.esp_session")
+    if esp_session:
+        esp_session.SESSIONS.release(port, log)
+
+
+def prefix_lines(prefix: str, text: str) -> str:
+    """Prefix every line of text (used to tell parallel port logs apart)"""
+    return "".join(f"{prefix}{line}" for line in text.splitlines(keepends=True))
+
+
+async def flash_attempt(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> Tuple[int, bool]:
+    """Flash once and return (exit code, whether trying again could help)
+
+    Errors are logged. A missing tool or a firmware file that doesn't suit the
+    project fails the same way every time, so it is not worth a retry.
+    """
+    try:
+        return await flash_job(config, port, firmware_path, log, on_progress), True
+    except FileNotFoundError:
+        log(f"❌ Tool '{config['tool']}' not found. Please ensure it's installed and in PATH.\n")
+        return 1, False
+    except ValueError as e:
+        log(f"❌ {str(e)}\n")
+        return 1, False
+    except Exception as e:
+        log(f"❌ Error: {str(e)}\n")
+        return 1, True
+
+
+def flash_many(jobs: List[Tuple], log,
+               max_parallel: int = DEFAULT_GANG_CONCURRENCY, on_status=None, on_progress=None) -> Dict[str, int]:
+    """Run several (config, port, firmware_path[, priority]) flash jobs in parallel and return {port: exit code}
+    
+    Every port gets its own worker on the flash engine; at most max_parallel of them write at
+    the same time, and failed jobs are retried as their project's "retry" says
+    (see jobqueue.py). on_status(port, status, returncode) is called as each
+    port moves through "queued", "flashing", "retrying" and "done"/"failed",
+    and on_progress(port, FlashProgress) while esptool writes.
+    """
+    from .jobqueue import FlashQueue
+    queue = FlashQueue(log, max_parallel, on_status, on_progress)
+    submitted = [queue.submit(config, port, firmware_path, *rest) for config, port, firmware_path, *rest in jobs]
+    queue.join()
+    return {job.port: job.returncode for job in submitted}
+
+
+def gang_flash(config: Dict, ports: List[str], firmware_path: str, log,
+               max_parallel: int = DEFAULT_GANG_CONCURRENCY, on_status=None, on_progress=None) -> Dict[str, int]:
+    """Flash the same firmware to several ports at once and return {port: exit code}"""
+    jobs = [(config, port, firmware_path) for port in ports]
+    return flash_many(jobs, log, max_parallel=max_parallel, on_status=on_status, on_progress=on_progress)
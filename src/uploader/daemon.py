@@ -0,0 +1,359 @@
+"""Local flashing daemon: the flash pipeline over HTTP on localhost
+
+`firmware_uploader serve` keeps projects loaded and the flash engine running,
+so test scripts can drive a bench PC without starting the GUI for every job.
+The server runs on the flash engine's event loop (engine.py); jobs go through
+a FlashQueue, with its per-port workers, priorities and retries.
+
+    GET    /health              version, queued and running jobs
+    GET    /projects            project names with chip and tool
+    GET    /ports               serial ports, USB identity and matching projects
+    GET    /jobs                recent jobs
+    POST   /jobs                {"project", "port", "file" | "sha256", "baud", "incremental", "retries", "backup", "priority"}
+                                 (no file or sha256: the project's release)
+    GET    /jobs/<id>           one job, with its last progress
+    GET    /jobs/<id>/log       the job's log as text
+    DELETE /jobs/<id>           cancel a job that hasn't started
+    GET    /events              Server-Sent Events for every job (status, log, progress)
+    GET    /jobs/<id>/events    events for one job, ending when it finishes
+
+It only listens on localhost unless told otherwise. There, requests must
+name a local Host and POST bodies must be JSON, so web pages open in a
+browser on the same PC can't submit jobs.
+"""
+import os
+import json
+import time
+import asyncio
+import collections
+from typing import Dict, List, Optional, Tuple
+
+from .core import (VERSION, DEFAULT_GANG_CONCURRENCY, get_project_list, get_project_config, get_project_index,
+                   resolve_config)
+from .engine import ENGINE
+from .jobqueue import FlashQueue, FlashJob
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+# Finished jobs kept for GET /jobs
+MAX_FINISHED_JOBS = 200
+MAX_LOG_LINES = 5000
+MAX_BODY_BYTES = 64 * 1024
+# SSE comment sent when nothing happened for this long, so proxies and clients see the stream is alive
+HEARTBEAT_SECONDS = 15.0
+EVENT_BUFFER = 1000
+FINISHED = ("done", "failed", "cancelled")
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+           415: "Unsupported Media Type", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class DaemonJob:
+    """A submitted job with what the API reports about it"""
+
+    def __init__(self, job: FlashJob, project: str, firmware_path: str):
+        self.job = job
+        self.project = project
+        self.firmware_path = firmware_path
+        self.submitted = time.time()
+        self.finished: Optional[float] = None
+        self.progress = None
+        self.log = collections.deque(maxlen=MAX_LOG_LINES)
+
+    def to_dict(self) -> Dict:
+        job = self.job
+        return {
+            "id": job.id,
+            "project": self.project,
+            "port": job.port,
+            "file": self.firmware_path,
+            "priority": job.priority,
+            "status": job.status,
+            "attempts": job.attempts,
+            "returncode": job.returncode,
+            "baud": job.config.get("baud"),
+            "progress": self.progress._asdict() if self.progress else None,
+            "submitted": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.submitted)),
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.finished)) if self.finished else None,
+        }
+
+
+class FlashDaemon:
+    """HTTP API for the flash queue (start() and stop() run on the engine loop)"""
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 max_parallel: int = DEFAULT_GANG_CONCURRENCY, log=None):
+        self.host = host
+        self.port = port
+        self.log = log or (lambda text: None)
+        self.queue = FlashQueue(self.log, max_parallel)
+        self.jobs: Dict[int, DaemonJob] = collections.OrderedDict()
+        self._subscribers: List[Tuple[Optional[int], asyncio.Queue]] = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # ─────────────────────────────
+    # JOBS AND EVENTS
+    # ─────────────────────────────
+    async def submit(self, request: Dict) -> DaemonJob:
+        """Queue a job from a POST /jobs body"""
+        # Config files, the firmware store and file shares can be slow: not on the engine loop
+        config, firmware_path, priority = await ENGINE.to_thread(self._resolve_request, request)
+        try:
+            job = self.queue.submit(config, request["port"], firmware_path, priority, observer=self._observe)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        entry = self.jobs[job.id] = DaemonJob(job, request["project"], firmware_path)
+        self._trim_jobs()
+        return entry
+
+    @staticmethod
+    def _resolve_request(request: Dict) -> Tuple[Dict, str, int]:
+        """(config, firmware path, priority) for a POST /jobs body (raises HttpError)"""
+        from .firmware_store import FIRMWARE_STORE
+        missing = [key for key in ("project", "port") if not request.get(key)]
+        if missing:
+            raise HttpError(400, f"Missing {', '.join(missing)}")
+        try:
+            config = resolve_config(request["project"], request.get("baud"), request.get("incremental", False),
+                                    request.get("retries"), request.get("backup", False))
+            priority = int(request.get("priority", 0))
+        except (ValueError, TypeError) as e:
+            raise HttpError(400, str(e))
+
+        if not (request.get("file") or request.get("sha256")):
+            if not config.get("releases"):
+                raise HttpError(400, "Missing file or sha256")
+            # The project's release, from the cache (see releases.py)
+            firmware_path = ""
+        elif request.get("sha256"):
+            info = FIRMWARE_STORE.get(str(request["sha256"]).lower())
+            if not info:
+                raise HttpError(404, f"No stored firmware with sha256 {request['sha256']}")
+            firmware_path = info.path
+        else:
+            firmware_path = os.path.abspath(os.path.expanduser(str(request["file"])))
+            if not os.path.exists(firmware_path):
+                raise HttpError(400, f"Firmware file not found: {firmware_path}")
+        return config, firmware_path, priority
+
+    def _trim_jobs(self):
+        finished = [job_id for job_id, entry in self.jobs.items() if entry.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _observe(self, job: FlashJob, kind: str, data):
+        # Called from the engine loop, the executor (esptool's Python API) or a submitting thread
+        ENGINE.call_soon(self._record, job, kind, data)
+
+    def _record(self, job: FlashJob, kind: str, data):
+        entry = self.jobs.get(job.id)
+        if entry is None:
+            # Dropped from the list already
+            return
+        if kind == "log":
+            entry.log.append(data)
+            payload = {"id": job.id, "port": job.port, "text": data}
+        elif kind == "progress":
+            entry.progress = data
+            payload = dict(data._asdict(), id=job.id, port=job.port)
+        else:
+            if data in FINISHED:
+                entry.finished = time.time()
+            # The job may have moved on since; report the status this event is about
+            payload = dict(entry.to_dict(), status=data)
+        self._publish(job.id, kind, payload)
+
+    def _publish(self, job_id: int, kind: str, payload: Dict):
+        message = f"event: {kind}\ndata: {json.dumps(payload)}\n\n".encode()
+        for wanted, queue in list(self._subscribers):
+            if wanted in (None, job_id):
+                if queue.full():
+                    # A client that stops reading doesn't get to hold events forever
+                    queue.get_nowait()
+                queue.put_nowait(message)
+
+    # ─────────────────────────────
+    # HTTP
+    # ─────────────────────────────
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, query, headers, body = await self._read_request(reader)
+                self._check_host(headers)
+                await self._route(writer, method, path, query, headers, body)
+            except HttpError as e:
+                self._send_json(writer, e.status, {"error": str(e)})
+            except Exception as e:
+                self._send_json(writer, 500, {"error": str(e) or type(e).__name__})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            raise HttpError(400, "Malformed request line")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HttpError(400, "Bad Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        path, _, query = target.partition("?")
+        return method.upper(), path.rstrip("/") or "/", query, headers, body
+
+    def _check_host(self, headers: Dict):
+        if self.host not in LOCAL_HOSTS:
+            # Listening on the network was asked for explicitly
+            return
+        host = headers.get("host", "")
+        name = host.rsplit(":", 1)[0] if not host.endswith("]") else host
+        name = name.strip("[]")
+        if name not in LOCAL_HOSTS:
+            raise HttpError(403, f"Host {host!r} not allowed")
+
+    async def _route(self, writer, method: str, path: str, query: str, headers: Dict, body: bytes):
+        parts = path.strip("/").split("/")
+        if path == "/health" and method == "GET":
+            states = collections.Counter(entry.job.status for entry in self.jobs.values())
+            self._send_json(writer, 200, {"version": VERSION, "jobs": dict(states)})
+        elif path == "/projects" and method == "GET":
+            self._send_json(writer, 200, [
+                {"name": name, "chip": get_project_config(name)["chip"], "tool": get_project_config(name)["tool"]}
+                for name in get_project_list(show_advanced="advanced=1" in query.split("&"))
+            ])
+        elif path == "/ports" and method == "GET":
+            self._send_json(writer, 200, await ENGINE.to_thread(self._ports))
+        elif path == "/jobs" and method == "GET":
+            self._send_json(writer, 200, [entry.to_dict() for entry in self.jobs.values()])
+        elif path == "/jobs" and method == "POST":
+            if not headers.get("content-type", "").startswith("application/json"):
+                raise HttpError(415, "POST /jobs needs Content-Type: application/json")
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError as e:
+                raise HttpError(400, f"Invalid JSON: {e}")
+            if not isinstance(request, dict):
+                raise HttpError(400, "Expected a JSON object")
+            self._send_json(writer, 201, (await self.submit(request)).to_dict())
+        elif path == "/events" and method == "GET":
+            await self._stream(writer, None)
+        elif parts[0] == "jobs" and len(parts) in (2, 3):
+            entry = self._job(parts[1])
+            action = parts[2] if len(parts) == 3 else None
+            if action is None and method == "GET":
+                self._send_json(writer, 200, entry.to_dict())
+            elif action is None and method == "DELETE":
+                if not self.queue.cancel(entry.job):
+                    raise HttpError(409, f"Job {entry.job.id} is {entry.job.status}, it can't be cancelled")
+                self._send_json(writer, 200, entry.to_dict())
+            elif action == "log" and method == "GET":
+                self._send(writer, 200, "".join(entry.log).encode(), "text/plain; charset=utf-8")
+            elif action == "events" and method == "GET":
+                await self._stream(writer, entry)
+            else:
+                raise HttpError(405 if action in (None, "log", "events") else 404, f"{method} {path}")
+        else:
+            known = path in ("/health", "/projects", "/ports", "/jobs", "/events")
+            raise HttpError(405 if known else 404, f"{method} {path}")
+
+    def _job(self, job_id: str) -> DaemonJob:
+        try:
+            return self.jobs[int(job_id)]
+        except (ValueError, KeyError):
+            raise HttpError(404, f"No job {job_id}")
+
+    @staticmethod
+    def _ports() -> List[Dict]:
+        from .core import list_port_infos
+        index = get_project_index()
+        return [{
+            "device": info.device,
+            "description": info.description,
+            "vid": f"{info.vid:04X}" if info.vid is not None else None,
+            "pid": f"{info.pid:04X}" if info.pid is not None else None,
+            "serial_number": info.serial_number,
+            "projects": [name for name, _ in index.candidates(info)],
+        } for info in list_port_infos()]
+
+    async def _stream(self, writer: asyncio.StreamWriter, entry: Optional[DaemonJob]):
+        """Server-Sent Events for one job (or all jobs) until the client goes away or the job finishes"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        queue: asyncio.Queue = asyncio.Queue(EVENT_BUFFER)
+        # The entry is kept: a finished job can be trimmed from self.jobs while we stream
+        job_id = entry.job.id if entry else None
+        subscription = (job_id, queue)
+        self._subscribers.append(subscription)
+        try:
+            if entry is not None:
+                # Catch up on what the job did before the client connected
+                for text in list(entry.log):
+                    payload = {"id": job_id, "port": entry.job.port, "text": text}
+                    writer.write(f"event: log\ndata: {json.dumps(payload)}\n\n".encode())
+                writer.write(f"event: status\ndata: {json.dumps(entry.to_dict())}\n\n".encode())
+                if entry.finished:
+                    return
+            await writer.drain()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    message = b": keep-alive\n\n"
+                writer.write(message)
+                await writer.drain()
+                if entry is not None and entry.finished and queue.empty():
+                    return
+        finally:
+            self._subscribers.remove(subscription)
+
+    @staticmethod
+    def _send(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str):
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+
+    def _send_json(self, writer: asyncio.StreamWriter, status: int, payload):
+        self._send(writer, status, json.dumps(payload, indent=2).encode() + b"\n", "application/json")
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, max_parallel: int = DEFAULT_GANG_CONCURRENCY,
+          log=None) -> FlashDaemon:
+    """Start the daemon on the flash engine and return it (it runs until stopped)"""
+    daemon = FlashDaemon(host, port, max_parallel, log)
+    ENGINE.run(daemon.start())
+    return daemon
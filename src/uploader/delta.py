@@ -0,0 +1,163 @@
+"""Sector-level incremental flashing for ESP targets
+
+After every write the MD5 of each 4 KB flash sector of the image is recorded
+per device (keyed by chip MAC). On the next flash, sectors whose recorded hash
+matches the new image are confirmed with the chip's own MD5 command (whole runs
+at once, bisected only on a mismatch), and only the sectors that really changed
+are erased and written. Devices without a record are checked the same way, so
+re-flashing a board that already holds most of the image is fast too.
+
+The image is passed in as a buffer (usually a memory-mapped file, see
+images.mapped_file) and hashed through memoryview slices; only the sectors
+that are written get copied.
+"""
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .core import get_user_data_path, make_progress_parser
+from .metrics import current_job
+
+SECTOR_SIZE = 4096
+# Largest run of sectors checked with one on-chip MD5 before bisecting (256 KB)
+MAX_CHECK_RUN_SECTORS = 64
+
+
+def sector_hashes(data) -> List[str]:
+    """MD5 of every flash sector covered by data (the last one may be partial)"""
+    view = memoryview(data)
+    return [
+        hashlib.md5(view[offset:offset + SECTOR_SIZE]).hexdigest()
+        for offset in range(0, len(view), SECTOR_SIZE)
+    ]
+
+
+def group_runs(sectors: List[int], max_run: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Group sorted sector indices into (first, count) runs of consecutive sectors"""
+    runs = []
+    for sector in sectors:
+        if runs and runs[-1][0] + runs[-1][1] == sector and (max_run is None or runs[-1][1] < max_run):
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((sector, 1))
+    return runs
+
+
+class SectorCache:
+    """Sector MD5s of the last image written to each device, one JSON file per MAC"""
+
+    def __init__(self, folder: Optional[str] = None):
+        self.folder = folder or os.path.dirname(get_user_data_path("sectors", "_"))
+        self._lock = threading.Lock()
+
+    def _path(self, mac: str) -> str:
+        return os.path.join(self.folder, mac.replace(":", "").lower() + ".json")
+
+    def _read(self, mac: str) -> Dict:
+        try:
+            with open(self._path(mac), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, mac: str, address: int) -> Optional[List[str]]:
+        with self._lock:
+            return self._read(mac).get(hex(address))
+
+    def store(self, mac: str, address: int, hashes: List[str]):
+        with self._lock:
+            record = self._read(mac)
+            record[hex(address)] = hashes
+            tmp_path = self._path(mac) + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_path, self._path(mac))
+
+    def forget(self, mac: str):
+        with self._lock:
+            try:
+                os.remove(self._path(mac))
+            except OSError:
+                pass
+
+
+SECTOR_CACHE = SectorCache()
+
+
+def find_changed_sectors(session, address: int, data, candidates: List[int]) -> List[int]:
+    """Check candidate sectors against the chip's MD5 and return the ones that differ
+
+    Consecutive candidates are checked as one region; a mismatching region is
+    bisected, so a handful of changes costs a handful of extra round trips.
+    """
+    changed = []
+    view = memoryview(data)
+
+    def check(first, count):
+        start = first * SECTOR_SIZE
+        end = min((first + count) * SECTOR_SIZE, len(view))
+        local_md5 = hashlib.md5(view[start:end]).hexdigest()
+        if session.flash_md5(address + start, end - start) == local_md5:
+            return
+        if count == 1:
+            changed.append(first)
+            return
+        half = count // 2
+        check(first, half)
+        check(first + half, count - half)
+
+    for first, count in group_runs(candidates, MAX_CHECK_RUN_SECTORS):
+        check(first, count)
+    return changed
+
+
+def write_incremental(session, address: int, data, log, on_progress=None,
+                      cache: SectorCache = SECTOR_CACHE, flash_settings: Optional[Dict] = None) -> Tuple[int, int]:
+    """Write only the sectors of data that differ from what is in flash
+
+    session must be connected (its MAC keys the cache). When flash_settings
+    apply (data is the bootloader), sectors are compared against the
+    header-patched image, as written. Returns (bytes written, bytes skipped).
+    """
+    if address % SECTOR_SIZE:
+        raise ValueError(f"Incremental flashing needs a sector-aligned address, got {address:#x}")
+
+    mac = session.info.mac
+    # Compare and write the bytes that end up in flash (a bootloader header may be patched)
+    data = session.as_written(address, data, flash_settings)
+    new_hashes = sector_hashes(data)
+    recorded = cache.load(mac, address) or []
+
+    # Sectors whose recorded hash differs certainly changed; everything else is checked on the chip
+    known_changed = [
+        idx for idx, digest in enumerate(new_hashes)
+        if idx < len(recorded) and recorded[idx] != digest
+    ]
+    # Checking sectors against the chip's MD5 is recorded as verification time
+    current_job().mark("verify")
+    known_set = set(known_changed)
+    candidates = [idx for idx in range(len(new_hashes)) if idx not in known_set]
+    changed = sorted(known_changed + find_changed_sectors(session, address, data, candidates))
+
+    # esptool takes bytes, so the changed sectors (and only those) are copied out
+    regions = []
+    for first, count in group_runs(changed):
+        start = first * SECTOR_SIZE
+        end = min((first + count) * SECTOR_SIZE, len(data))
+        regions.append((address + start, bytes(data[start:end])))
+    written = sum(len(chunk) for _, chunk in regions)
+
+    log(f"Incremental: {len(changed)} of {len(new_hashes)} sector(s) changed "
+        f"({written // 1024} KB to write, {(len(data) - written) // 1024} KB unchanged)\n")
+
+    # One write_flash call for all regions: a single erase/write pass on this connection
+    if regions:
+        parser = make_progress_parser({"tool": "esptool"}, None, on_progress,
+                                      segment_sizes=[len(chunk) for _, chunk in regions])
+        session.write(regions, log, on_line=parser.feed if parser else None,
+                      flash_settings=flash_settings)
+
+    cache.store(mac, address, new_hashes)
+    return written, len(data) - written
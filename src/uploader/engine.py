@@ -0,0 +1,230 @@
+"""asyncio flashing engine
+
+Every flash runs as a task on one event loop thread ("flash-engine"), however
+many ports are attached:
+
+- esptool CLI and avrdude run through asyncio.create_subprocess_exec; their
+  output is read on the loop (no reader thread per process).
+- The built-in STK500 programmer talks to the port through AsyncSerial, which
+  reads the port's file descriptor when the loop says it is readable.
+- esptool's Python API (session and frozen paths) blocks, so those calls run
+  on a small executor, bounded by MAX_GANG_CONCURRENCY rather than by the
+  number of boards.
+
+Blocking callers (CLI, GUI worker, bench) use ENGINE.run(coroutine), which
+waits for the result; code already on the loop awaits the coroutines
+directly. Task-local state (the current metrics job) travels with each task
+and into executor calls, as contextvars.
+"""
+import os
+import sys
+import codecs
+import asyncio
+import functools
+import threading
+import contextvars
+import concurrent.futures
+from typing import Callable, List, Optional
+
+from .core import MAX_GANG_CONCURRENCY, MAX_LINE_LENGTH
+
+# Output is read in chunks of this size and split into lines
+READ_CHUNK = 4096
+
+
+class FlashEngine:
+    """The event loop thread all flashes share (started on first use)"""
+
+    def __init__(self, max_workers: int = MAX_GANG_CONCURRENCY):
+        self.max_workers = max_workers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                started = threading.Event()
+                self._thread = threading.Thread(target=self._run_loop, args=(started,),
+                                                name="flash-engine", daemon=True)
+                self._thread.start()
+                started.wait()
+            return self._loop
+
+    def _run_loop(self, started: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        _attach_child_watcher(loop)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix="flash-blocking")
+        self._loop = loop
+        started.set()
+        loop.run_forever()
+
+    def in_loop(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedule a coroutine on the engine from any thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the engine and wait for its result (not from the engine thread)"""
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("ENGINE.run() called on the engine thread, await the coroutine instead")
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback: Callable, *args):
+        """Run callback on the engine thread (thread-safe)"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def to_thread(self, func: Callable, *args, **kwargs):
+        """Run a blocking call on the engine's executor, keeping the caller's contextvars"""
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+
+def _attach_child_watcher(loop: asyncio.AbstractEventLoop):
+    """Wait for subprocesses with pidfds instead of a thread per process (Linux, Python < 3.12)
+
+    Python 3.12 picks the pidfd watcher itself; elsewhere the default stays.
+    """
+    if sys.version_info >= (3, 12) or not sys.platform.startswith("linux"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.set_child_watcher(watcher)
+    except (AttributeError, OSError):
+        pass
+
+
+ENGINE = FlashEngine()
+
+
+# ─────────────────────────────
+# SUBPROCESS TOOLS
+# ─────────────────────────────
+async def run_process(cmd: List[str], log, on_line: Optional[Callable] = None) -> int:
+    """Run a tool, streaming its combined output to log line by line, and return its exit code
+
+    Newlines are translated like a text-mode pipe ("\r" and "\r\n" become
+    "\n"), so progress lines arrive one by one. Output without line ends
+    is passed on every MAX_LINE_LENGTH bytes rather than buffered. Decoding is
+    incremental, so a character cut off there (or between reads) stays whole.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+    )
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def emit(raw: bytes, line_end: str = "", final: bool = False):
+        text = (decoder.decode(raw, final) + line_end).replace("\r\n", "\n").replace("\r", "\n")
+        for line in text.splitlines(keepends=True):
+            log(line)
+            if on_line:
+                on_line(line)
+
+    pending = b""
+    while True:
+        chunk = await process.stdout.read(READ_CHUNK)
+        if not chunk:
+            break
+        pending += chunk
+        # A trailing "\r" may be the first half of "\r\n"
+        end = len(pending) - pending.endswith(b"\r")
+        cut = max(pending.rfind(b"\n", 0, end), pending.rfind(b"\r", 0, end)) + 1
+        if cut:
+            emit(pending[:cut])
+            pending = pending[cut:]
+        if len(pending) > MAX_LINE_LENGTH:
+            emit(pending, "\n")
+            pending = b""
+    emit(pending, final=True)
+    return await process.wait()
+
+
+# ─────────────────────────────
+# NON-BLOCKING SERIAL
+# ─────────────────────────────
+class AsyncSerial:
+    """A serial port read by the event loop
+
+    On POSIX the port's file descriptor is watched with loop.add_reader and
+    incoming bytes are buffered until read() asks for them, so a waiting
+    port costs no thread. Where the loop can't watch serial handles
+    (Windows), reads fall back to the engine's executor.
+    """
+
+    def __init__(self, port: str, baud: int):
+        import serial
+        self.serial = serial.Serial(port, baud, timeout=0)
+        self._loop = asyncio.get_running_loop()
+        self._buffer = bytearray()
+        self._readable = asyncio.Event()
+        self._error: Optional[Exception] = None
+        self._watching = False
+        try:
+            self._loop.add_reader(self.serial.fileno(), self._on_readable)
+            self._watching = True
+        except (AttributeError, NotImplementedError, ValueError):
+            self.serial.timeout = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.serial.fileno(), READ_CHUNK)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            data = b""
+            self._error = e
+        if not data:
+            # Port gone (unplugged); stop watching so the loop doesn't spin
+            self._error = self._error or OSError("Serial port closed")
+            self._loop.remove_reader(self.serial.fileno())
+            self._watching = False
+        self._buffer += data
+        self._readable.set()
+
+    async def read(self, count: int, timeout: float) -> bytes:
+        """Up to count bytes, fewer if the timeout passes first"""
+        if not self._watching and self._error is None:
+            self.serial.timeout = timeout
+            return await ENGINE.to_thread(self.serial.read, count)
+        deadline = self._loop.time() + timeout
+        while len(self._buffer) < count and self._error is None:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            self._readable.clear()
+            try:
+                await asyncio.wait_for(self._readable.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if self._error is not None and not self._buffer:
+            raise self._error
+        data = bytes(self._buffer[:count])
+        del self._buffer[:count]
+        return data
+
+    def write(self, data: bytes):
+        self.serial.write(data)
+
+    def reset_input_buffer(self):
+        self.serial.reset_input_buffer()
+        self._buffer.clear()
+
+    def set_modem_lines(self, dtr: bool, rts: bool):
+        self.serial.dtr = dtr
+        self.serial.rts = rts
+
+    def close(self):
+        if self._watching:
+            self._loop.remove_reader(self.serial.fileno())
+            self._watching = False
+        self.serial.close()
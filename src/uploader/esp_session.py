@@ -0,0 +1,440 @@
+"""Persistent esptool sessions built on esptool's Python API
+
+Running esptool's CLI for every flash pays for ROM sync, stub upload and the
+baud change each time. An EspSession keeps the serial connection open with the
+stub loader running, so detect / read MAC / write / verify / reset can run back
+to back on one connection. SessionPool keeps one session per port and caches
+the detected chip and flash size per port, keyed by MAC so a newly plugged-in
+board is never mistaken for the previous one.
+
+A flash through the pool doesn't reset the board: SessionPool.finish() only
+records the project's reset mode and leaves the stub running, so the next job
+on the port (a retry, the next job of a batch) skips sync, stub upload and baud
+change. The reset is done by SessionPool.release() once the port has nothing
+left to do (FlashQueue calls it when a port's worker runs out of jobs). A kept
+session is only reused after the board answers with the same MAC.
+"""
+import os
+import contextlib
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .core import (
+    StreamingLogWriter, VERIFY_FULL, capture_thread_output, serial_failure_advice, make_progress_parser,
+    verify_policy,
+)
+from .images import mapped_file, resolve_flash_plan
+from .adapters import adapter_profile
+from .baud import BAUD_CACHE, adapter_key, is_auto_baud, probe_baud
+from .metrics import current_job
+
+# ROM bootloaders only sync reliably at 115200; the stub switches to the project baud afterwards
+ESP_ROM_BAUD = 115200
+DEFAULT_CONNECT_MODE = "default-reset"
+DEFAULT_RESET_MODE = "hard-reset"
+# Read-back verification reads and compares flash in pieces of this size
+READ_BACK_CHUNK = 256 * 1024
+
+
+class ChipInfo(NamedTuple):
+    chip: str
+    description: str
+    mac: str
+    flash_size: Optional[str]
+
+
+def format_mac(mac) -> str:
+    """Format a MAC tuple as aa:bb:cc:dd:ee:ff"""
+    return ":".join(f"{byte:02x}" for byte in mac)
+
+
+class EspSession:
+    """Open connection to one ESP chip with the stub loader running
+
+    Every method takes a log callable; esptool's own output is streamed into it.
+    Methods are serialised per session, so a session can be shared between threads.
+    """
+
+    def __init__(self, port: str, chip: str = "auto", baud: int = 460800,
+                 connect_mode: str = DEFAULT_CONNECT_MODE):
+        self.port = port
+        self.chip = chip
+        self.baud = int(baud)
+        self.connect_mode = connect_mode
+        self.esp = None
+        self.info: Optional[ChipInfo] = None
+        # Reset mode to apply when the session is released (None: leave the stub running)
+        self.pending_reset: Optional[str] = None
+        self.lock = threading.RLock()
+
+    @property
+    def connected(self) -> bool:
+        return self.esp is not None
+
+    @contextlib.contextmanager
+    def _output(self, log, on_line=None):
+        """Stream esptool's output for the duration of one operation"""
+        writer = StreamingLogWriter(log, on_line=on_line)
+        try:
+            with capture_thread_output(writer):
+                yield writer
+        finally:
+            writer.finish()
+
+    def connect(self, log, cached: Optional[ChipInfo] = None) -> ChipInfo:
+        """Sync with the ROM, upload the stub, switch baud and attach flash
+
+        A session that is still open is kept if the board still answers with
+        the same MAC. cached is the ChipInfo from an earlier session on this
+        port; its flash size is reused when the MAC shows it is the same board.
+        """
+        with self.lock:
+            if self.esp is not None:
+                if self._same_board():
+                    log(f"Reusing session on {self.port}: {self.info.description}, MAC {self.info.mac}\n")
+                    return self.info
+                self.close()
+
+            from esptool.cmds import detect_chip, run_stub, attach_flash, detect_flash_size
+            from esptool.targets import CHIP_DEFS
+            from esptool.util import flash_size_bytes
+
+            with self._output(log):
+                if self.chip == "auto":
+                    esp = detect_chip(self.port, ESP_ROM_BAUD, self.connect_mode)
+                else:
+                    esp = CHIP_DEFS[self.chip](self.port, ESP_ROM_BAUD)
+                    esp.connect(self.connect_mode)
+                try:
+                    mac = format_mac(esp.read_mac("BASE_MAC"))
+                    if cached and cached.mac == mac:
+                        description = cached.description
+                    else:
+                        description = esp.get_chip_description()
+                        cached = None
+
+                    esp = run_stub(esp)
+                    if self.baud > ESP_ROM_BAUD:
+                        esp.change_baud(self.baud)
+                    attach_flash(esp)
+
+                    flash_size = cached.flash_size if cached else detect_flash_size(esp)
+                    if flash_size:
+                        esp.flash_set_parameters(flash_size_bytes(flash_size))
+                except BaseException:
+                    esp._port.close()
+                    raise
+
+            self.esp = esp
+            self.info = ChipInfo(esp.CHIP_NAME, description, mac, flash_size)
+            log(f"Session open on {self.port}: {description}, MAC {mac}, "
+                f"flash {flash_size or 'unknown'}{' (cached)' if cached else ''}\n")
+            return self.info
+
+    def _same_board(self) -> bool:
+        try:
+            return self.read_mac() == self.info.mac
+        except Exception:
+            # Unplugged, or another board that is not running the stub
+            return False
+
+    def change_baud(self, baud: int):
+        """Switch host and stub to a new baud rate"""
+        with self.lock:
+            self.esp.change_baud(baud)
+            self.baud = baud
+
+    def set_write_block(self, size: int):
+        """Bytes per flash write packet (the stub's default is its maximum, 16 KB)"""
+        with self.lock:
+            self.esp.FLASH_WRITE_SIZE = size
+
+    def read_flash(self, address: int, size: int) -> bytes:
+        with self.lock:
+            return self.esp.read_flash(address, size)
+
+    def read_mac(self) -> str:
+        with self.lock:
+            return format_mac(self.esp.read_mac("BASE_MAC"))
+
+    def flash_md5(self, address: int, size: int) -> str:
+        """MD5 of a flash region, computed on the chip (hex string)"""
+        with self.lock:
+            return self.esp.flash_md5sum(address, size)
+
+    def as_written(self, address: int, data, flash_settings: Optional[Dict] = None):
+        """data as write_flash puts it in flash: with flash_settings patched into a bootloader header
+
+        Anything that is not a bootloader image at the bootloader offset is returned unchanged.
+        """
+        if not flash_settings or address != self.esp.BOOTLOADER_FLASH_OFFSET:
+            return data
+        from esptool.cmds import _update_image_flash_params
+        with self.lock:
+            if self.esp.secure_download_mode or self.esp.get_secure_boot_enabled():
+                return data
+        settings = {key: flash_settings.get(key) or "keep" for key in ("flash_mode", "flash_freq", "flash_size")}
+        if settings["flash_size"] == "detect":
+            # write_flash detects the size the same way; the session detected it on connect
+            settings["flash_size"] = self.info.flash_size or "4MB"
+        # Its notes ("Flash parameters set to ...") are printed again by the write itself
+        with self._output(lambda text: None):
+            return _update_image_flash_params(self.esp, address, settings["flash_freq"], settings["flash_mode"],
+                                              settings["flash_size"], bytes(data))
+
+    def write(self, addr_data: List[Tuple[int, str]], log, on_line=None, flash_settings: Optional[Dict] = None):
+        """Write (address, file or bytes) pairs compressed in one pass, verifying each by MD5
+        
+        flash_settings (flash_mode/flash_freq/flash_size) are patched into the bootloader header.
+        """
+        from esptool.cmds import write_flash
+        with self.lock, self._output(log, on_line):
+            write_flash(self.esp, addr_data, compress=True, **(flash_settings or {}))
+
+    def verify(self, addr_data: List[Tuple[int, str]], log):
+        """Compare flash against (address, file or bytes) pairs; raises on mismatch"""
+        from esptool.cmds import verify_flash
+        with self.lock, self._output(log):
+            verify_flash(self.esp, addr_data)
+
+    def reset(self, log, mode: str = DEFAULT_RESET_MODE):
+        """Reset the chip; any mode that leaves the stub also closes the session"""
+        from esptool.cmds import reset_chip
+        with self.lock:
+            self.pending_reset = None
+            with self._output(log):
+                reset_chip(self.esp, mode)
+            if mode != "no-reset-stub":
+                self.close()
+
+    def close(self):
+        with self.lock:
+            if self.esp is not None:
+                try:
+                    self.esp._port.close()
+                except Exception:
+                    pass
+                self.esp = None
+
+
+class SessionPool:
+    """One EspSession per port, plus per-port chip info that outlives the sessions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, EspSession] = {}
+        self._chip_info: Dict[str, ChipInfo] = {}
+
+    def get(self, port: str, chip: str = "auto", baud: int = 460800,
+            connect_mode: str = DEFAULT_CONNECT_MODE) -> EspSession:
+        """Return the session for port, replacing it if chip, baud or connect mode changed"""
+        with self._lock:
+            session = self._sessions.get(port)
+            if session and (session.chip != chip or session.baud != int(baud)
+                            or session.connect_mode != connect_mode):
+                session.close()
+                session = None
+            if session is None:
+                session = EspSession(port, chip, baud, connect_mode)
+                self._sessions[port] = session
+            return session
+
+    def connect(self, port: str, log, chip: str = "auto", baud: int = 460800,
+                connect_mode: str = DEFAULT_CONNECT_MODE) -> EspSession:
+        """Get a connected session for port, using the cached chip info when it matches"""
+        session = self.get(port, chip, baud, connect_mode)
+        info = session.connect(log, cached=self.chip_info(port))
+        with self._lock:
+            self._chip_info[port] = info
+        return session
+
+    def finish(self, port: str, mode: str = DEFAULT_RESET_MODE):
+        """End a job on port, keeping the session (and stub) open; release() resets the board"""
+        with self._lock:
+            session = self._sessions.get(port)
+        if session:
+            session.pending_reset = None if mode == "no-reset-stub" else mode
+
+    def release(self, port: str, log):
+        """Reset the board as the last job on port asked and close its session"""
+        with self._lock:
+            session = self._sessions.pop(port, None)
+        if session is None:
+            return
+        try:
+            if session.connected and session.pending_reset:
+                session.reset(log, session.pending_reset)
+        except Exception as e:
+            log(f"Could not reset the board on {port}: {e}\n")
+        finally:
+            session.close()
+
+    def chip_info(self, port: str) -> Optional[ChipInfo]:
+        with self._lock:
+            return self._chip_info.get(port)
+
+    def discard(self, port: str):
+        """Close and forget the session on port (after an error)"""
+        with self._lock:
+            session = self._sessions.pop(port, None)
+        if session:
+            session.close()
+
+    def close_all(self, log=None):
+        """Release every session (resetting boards that are still waiting for it)"""
+        with self._lock:
+            ports = list(self._sessions)
+        for port in ports:
+            self.release(port, log or (lambda text: None))
+
+
+SESSIONS = SessionPool()
+
+
+def _connect_auto_baud(pool: SessionPool, port: str, chip: str, log,
+                       connect_mode: str = DEFAULT_CONNECT_MODE) -> EspSession:
+    """Connect at the adapter's cached best baud, probing it first if unknown"""
+    key = adapter_key(port)
+    baud = BAUD_CACHE.lookup(key)
+    if baud:
+        log(f"Auto baud: {baud} (cached for adapter {key})\n")
+        return pool.connect(port, log, chip=chip, baud=baud, connect_mode=connect_mode)
+
+    log(f"Auto baud: probing adapter {key}...\n")
+    session = pool.connect(port, log, chip=chip, baud=ESP_ROM_BAUD, connect_mode=connect_mode)
+    baud = probe_baud(session, log, key)
+    log(f"Auto baud: using {baud}\n")
+    return session
+
+
+def _write_plan(session: EspSession, plan, config: Dict, firmware_path: str, log, on_progress):
+    if config.get("incremental"):
+        from .delta import write_incremental
+        for address, path in plan.segments:
+            with mapped_file(path) as data:
+                write_incremental(session, address, data, log, on_progress,
+                                  flash_settings=plan.flash_settings)
+    else:
+        parser = make_progress_parser(config, firmware_path, on_progress,
+                                      segment_sizes=[os.path.getsize(path) for _, path in plan.segments])
+        session.write(plan.segments, log, on_line=parser.feed if parser else None,
+                      flash_settings=plan.flash_settings)
+
+
+def _read_back(session: EspSession, plan, log) -> bool:
+    """Read every written segment back and compare it byte for byte
+
+    Flash is read in chunks and compared against the mapped image, so
+    neither side is ever held in memory whole.
+    """
+    job = current_job()
+    job.mark("verify")
+    total = 0
+    for address, path in plan.segments:
+        with mapped_file(path) as data:
+            expected = session.as_written(address, data, plan.flash_settings)
+            offset = _first_difference(session, address, expected)
+            size = len(expected)
+        if offset is not None:
+            log(f"\n❌ Verify failed: {os.path.basename(path)} differs from flash at {address + offset:#x}\n")
+            job.set_verified(False)
+            return False
+        total += size
+    log(f"Read back and verified {total} bytes\n")
+    job.set_verified(True)
+    return True
+
+
+def _first_difference(session: EspSession, address: int, expected) -> Optional[int]:
+    """Offset of the first byte where flash differs from expected, None if it all matches"""
+    for start in range(0, len(expected), READ_BACK_CHUNK):
+        data = session.read_flash(address + start, min(READ_BACK_CHUNK, len(expected) - start))
+        if data != expected[start:start + len(data)]:
+            return start + next((idx for idx, byte in enumerate(data) if byte != expected[start + idx]),
+                                len(data))
+    return None
+
+
+def verify_read_back(config: Dict, port: str, firmware_path: str, log, pool: SessionPool = SESSIONS) -> int:
+    """Full verification after a command line flash: connect again, read everything back, reset"""
+    try:
+        plan = resolve_flash_plan(config, firmware_path)
+        current_job().mark("port_open")
+        session = pool.connect(port, log, chip=config["chip"], baud=int(config["baud"]),
+                               connect_mode=config.get("connect", DEFAULT_CONNECT_MODE))
+        current_job().set_device(session.info.mac)
+        ok = _read_back(session, plan, log)
+        current_job().mark("reset")
+        # The next job on this port runs the command line again, which needs the port
+        session.reset(log, config.get("reset", DEFAULT_RESET_MODE))
+        pool.discard(port)
+        return 0 if ok else 1
+    except Exception as e:
+        log(f"\nA fatal error occurred while verifying: {e}\n")
+        pool.discard(port)
+        return 1
+
+
+def run_esptool_session(config: Dict, port: str, firmware_path: str, log,
+                        on_progress=None, pool: SessionPool = SESSIONS) -> int:
+    """Flash through a pooled session: connect (or reuse), write all segments
+    
+    The session stays open for the next job on the port; the board is reset
+    when the pool releases the port (see SessionPool.finish()).
+    With "incremental": true in the config only changed sectors are written.
+    With "baud": "auto" a transfer error is retried once at the next lower rate,
+    which is remembered for the adapter. esptool checks every write by MD5;
+    "verify": "full" also reads all segments back.
+    """
+    from esptool.util import FatalError
+    
+    try:
+        # With "partitions" the plan may need the device's partition table, so it is made once connected
+        plan = None if config.get("partitions") else resolve_flash_plan(config, firmware_path)
+        auto_baud = is_auto_baud(config)
+        connect_mode = config.get("connect", DEFAULT_CONNECT_MODE)
+        policy = verify_policy(config)
+        job = current_job()
+        job.mark("port_open")
+        if auto_baud:
+            session = _connect_auto_baud(pool, port, config["chip"], log, connect_mode)
+        else:
+            session = pool.connect(port, log, chip=config["chip"], baud=int(config["baud"]),
+                                   connect_mode=connect_mode)
+        job.set_device(session.info.mac)
+        profile = adapter_profile(job.adapter)
+        if profile and profile.write_block:
+            session.set_write_block(profile.write_block)
+        if plan is None:
+            plan = resolve_flash_plan(config, firmware_path, read_flash=session.read_flash)
+        for note in plan.notes:
+            log(note + "\n")
+        if len(plan.segments) > 1:
+            log(f"Writing {len(plan.segments)} segments:\n{plan.describe()}\n")
+        
+        job.mark("write")
+        try:
+            _write_plan(session, plan, config, firmware_path, log, on_progress)
+        except (FatalError, OSError, StopIteration) as e:
+            if not auto_baud:
+                raise
+            fallback = BAUD_CACHE.mark_failed(adapter_key(port), session.baud)
+            job.count_retry()
+            log(f"\nTransfer failed at {session.baud} baud ({e}), retrying at {fallback}...\n")
+            pool.discard(port)
+            session = pool.connect(port, log, chip=config["chip"], baud=fallback, connect_mode=connect_mode)
+            _write_plan(session, plan, config, firmware_path, log, on_progress)
+        
+        if policy == VERIFY_FULL and not _read_back(session, plan, log):
+            pool.discard(port)
+            return 1
+        job.mark("reset")
+        pool.finish(port, config.get("reset", DEFAULT_RESET_MODE))
+        return 0
+    except StopIteration:
+        # Raised by esptool when the serial link dies mid-command
+        log(serial_failure_advice())
+    except Exception as e:
+        log(f"\nA fatal error occurred: {e}\n")
+    pool.discard(port)
+    return 1
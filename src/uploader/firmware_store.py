@@ -0,0 +1,411 @@
+"""Content-addressed local firmware store
+
+A selected firmware file is copied once into the user data folder under its
+SHA-256 (firmware/<sha256><ext>) and parsed once; the result is kept next
+to it as <sha256>.json. Flashes then read the local copy, however slow the
+share the file came from. A source path whose size and modification time
+are unchanged is not hashed again.
+
+Stored metadata:
+- ESP images: chip (from the image header's chip ID), segment layout
+  (load address, length) and, for apps, version / project name / IDF version
+  from esp_app_desc. Merged images are parsed at the bootloader offset.
+- Intel HEX: the address ranges the file covers.
+
+check_compatible() rejects an image built for another chip than the
+project's, before the port is opened. An esptool project only takes ESP
+images unless it sets "raw": true (data such as a filesystem image) or
+lists its "segments".
+
+Images that a job is flashing are pinned and never pruned, nor are images
+used in the last PRUNE_GRACE_SECONDS (between being stored and pinned).
+"""
+import os
+import json
+import time
+import struct
+import hashlib
+import threading
+import contextlib
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .core import get_user_data_path
+from .images import mapped_file
+
+STORE_DIR = "firmware"
+SOURCES_NAME = "sources.json"
+# Least recently used images are removed when the store grows past this
+MAX_STORE_BYTES = 1024 * 1024 * 1024
+PRUNE_GRACE_SECONDS = 300
+COPY_CHUNK = 1024 * 1024
+
+ESP_IMAGE_MAGIC = 0xE9
+ESP_APP_DESC_MAGIC = 0xABCD5432
+# Image header chip IDs (esptool's IMAGE_CHIP_ID), so esptool isn't imported to read a header
+ESP_CHIP_IDS = {
+    0: "esp32", 2: "esp32s2", 5: "esp32c3", 9: "esp32s3", 12: "esp32c2", 13: "esp32c6",
+    16: "esp32h2", 18: "esp32p4", 20: "esp32c61", 23: "esp32c5", 25: "esp32h21", 28: "esp32h4",
+}
+# Where a merged image (esptool merge-bin) has its bootloader and, usually, its app
+ESP_BOOTLOADER_OFFSETS = (0x1000, 0x2000)
+ESP_APP_OFFSET = 0x10000
+ESP_MAX_SEGMENTS = 16
+HEX_SUFFIXES = (".hex", ".ihex", ".ihx")
+
+
+class FirmwareInfo(NamedTuple):
+    sha256: str
+    size: int
+    name: str
+    kind: str
+    chip: Optional[str]
+    version: Optional[str]
+    project_name: Optional[str]
+    idf_version: Optional[str]
+    segments: List[Tuple[int, int]]
+    ranges: List[Tuple[int, int]]
+    path: str
+
+    def describe(self) -> str:
+        """e.g. app.bin: esp32 app "rx" 1.4.2 (IDF v5.2), 3 segments, sha256 1a2b3c4d5e6f"""
+        parts = [self.chip] if self.chip else []
+        if self.kind == "esp-app":
+            parts.append("app" + (f" \"{self.project_name}\"" if self.project_name else ""))
+            if self.version:
+                parts.append(self.version)
+            if self.idf_version:
+                parts.append(f"(IDF {self.idf_version})")
+        elif self.kind == "intel-hex":
+            parts.append("Intel HEX " + ", ".join(f"{start:#06x}-{end - 1:#06x}" for start, end in self.ranges[:4]))
+        else:
+            parts.append(self.kind)
+        text = f"{self.name}: {' '.join(parts)}"
+        if self.segments:
+            text += f", {len(self.segments)} segments"
+        return text + f", sha256 {self.sha256[:12]}"
+
+
+# ─────────────────────────────
+# IMAGE PARSING
+# ─────────────────────────────
+def _c_string(raw: bytes) -> Optional[str]:
+    text = raw.split(b"\0", 1)[0].decode("utf-8", "replace").strip()
+    return text or None
+
+
+def parse_esp_image(data: bytes, offset: int = 0) -> Optional[Dict]:
+    """Header, segments and esp_app_desc of the ESP image at offset
+
+    None if there is no image there, including data that merely starts with
+    the magic byte but whose segments do not fit the file.
+    """
+    if len(data) < offset + 24 or data[offset] != ESP_IMAGE_MAGIC:
+        return None
+    segment_count = data[offset + 1]
+    if not 0 < segment_count <= ESP_MAX_SEGMENTS:
+        return None
+    # Extended header (ESP32 and later): chip ID at byte 12
+    chip_id = struct.unpack_from("<H", data, offset + 12)[0]
+    info = {"chip": ESP_CHIP_IDS.get(chip_id), "segments": [], "app": None}
+
+    position = offset + 24
+    for idx in range(segment_count):
+        if position + 8 > len(data):
+            return None
+        load_address, length = struct.unpack_from("<II", data, position)
+        position += 8
+        if idx == 0 and length >= 256 and struct.unpack_from("<I", data, position)[0] == ESP_APP_DESC_MAGIC:
+            # esp_app_desc_t: magic, secure_version, 2 reserved words, version[32],
+            # project_name[32], time[16], date[16], idf_ver[32]
+            version, project_name, _, _, idf_version = struct.unpack_from("<32s32s16s16s32s", data, position + 16)
+            info["app"] = {
+                "version": _c_string(version),
+                "project_name": _c_string(project_name),
+                "idf_version": _c_string(idf_version),
+            }
+        info["segments"].append((load_address, length))
+        position += length
+        if position > len(data):
+            return None
+    return info
+
+
+def hex_ranges(runs: List[Tuple[int, bytes]]) -> List[Tuple[int, int]]:
+    """Contiguous [start, end) address ranges covered by a parsed HEX file"""
+    return [(start, start + len(data)) for start, data in runs]
+
+
+def parse_firmware(path: str, name: str) -> Dict:
+    """Metadata of a firmware file (stored next to the local copy)"""
+    meta = {"kind": "raw", "chip": None, "version": None, "project_name": None, "idf_version": None,
+            "segments": [], "ranges": []}
+    if name.lower().endswith(HEX_SUFFIXES):
+        from .stk500 import parse_intel_hex
+        with open(path, 'r') as f:
+            meta.update(kind="intel-hex", ranges=hex_ranges(parse_intel_hex(f.read())))
+        return meta
+
+    with mapped_file(path) as data:
+        return _parse_esp_firmware(data, meta)
+
+
+def _parse_esp_firmware(data, meta: Dict) -> Dict:
+    image = parse_esp_image(data)
+    if image:
+        meta.update(kind="esp-image", chip=image["chip"], segments=image["segments"])
+    else:
+        # A merged image starts with the bootloader (after padding on some chips)
+        for offset in ESP_BOOTLOADER_OFFSETS:
+            image = parse_esp_image(data, offset)
+            if image:
+                meta.update(kind="esp-merged", chip=image["chip"])
+                image = parse_esp_image(data, ESP_APP_OFFSET) or image
+                break
+    if image and image["app"]:
+        if meta["kind"] == "esp-image":
+            meta["kind"] = "esp-app"
+        meta.update(image["app"])
+    return meta
+
+
+def check_compatible(info: FirmwareInfo, config: Dict):
+    """Raise ValueError if the image cannot be meant for the project's chip"""
+    if config["tool"] == "esptool":
+        if info.kind == "intel-hex":
+            raise ValueError(f"{info.name} is an Intel HEX file, ESP32 projects need a .bin image")
+        chip = config.get("chip", "auto")
+        if info.kind == "raw":
+            if config.get("raw") or config.get("segments"):
+                return
+            # ESP8266 images have no extended header, so parse_esp_image() doesn't recognise them
+            if chip == "esp8266" and _first_byte(info.path) == ESP_IMAGE_MAGIC:
+                return
+            raise ValueError(f"{info.name} is not an ESP image (set \"raw\": true in the project "
+                             "to write other data)")
+        if chip not in ("auto", "esp8266") and info.chip != chip:
+            raise ValueError(f"{info.name} was built for {info.chip or 'an unknown chip'}, "
+                             f"but the project is for {chip}")
+    elif info.kind.startswith("esp-"):
+        raise ValueError(f"{info.name} is an ESP image ({info.chip or 'unknown chip'}), "
+                         f"but the project is for {config['chip']}")
+
+
+def _first_byte(path: str) -> Optional[int]:
+    with open(path, 'rb') as f:
+        data = f.read(1)
+    return data[0] if data else None
+
+
+# ─────────────────────────────
+# STORE
+# ─────────────────────────────
+class FirmwareStore:
+    """Firmware images keyed by SHA-256, with their parsed metadata"""
+
+    def __init__(self, root: Optional[str] = None):
+        self._root = root
+        self._lock = threading.Lock()
+        # sha256: number of jobs flashing the image
+        self._pinned: Dict[str, int] = {}
+
+    @property
+    def root(self) -> str:
+        if not self._root:
+            self._root = get_user_data_path(STORE_DIR)
+        os.makedirs(self._root, exist_ok=True)
+        return self._root
+
+    def _sources_path(self) -> str:
+        return os.path.join(self.root, SOURCES_NAME)
+
+    def _read_sources(self) -> Dict:
+        try:
+            with open(self._sources_path(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_sources(self, sources: Dict):
+        tmp_path = self._sources_path() + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sources, f, indent=2)
+        os.replace(tmp_path, self._sources_path())
+
+    def _meta_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256 + ".json")
+
+    def get(self, sha256: str) -> Optional[FirmwareInfo]:
+        """Stored image by hash, or None"""
+        try:
+            with open(self._meta_path(sha256), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        path = os.path.join(self.root, sha256 + meta["ext"])
+        if not os.path.exists(path):
+            return None
+        return FirmwareInfo(
+            sha256, meta["size"], meta["name"], meta["kind"], meta["chip"], meta["version"],
+            meta["project_name"], meta["idf_version"],
+            [tuple(s) for s in meta["segments"]], [tuple(r) for r in meta["ranges"]], path,
+        )
+
+    def add(self, source_path: str) -> FirmwareInfo:
+        """Store a file (or find it already stored) and return its metadata"""
+        source_path = os.path.abspath(source_path)
+        with self._lock:
+            stat = os.stat(source_path)
+            sources = self._read_sources()
+            known = sources.get(source_path)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                info = self.get(known["sha256"])
+                if info:
+                    self._touch(info.path)
+                    return info
+
+            info = self._import(source_path)
+            sources[source_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": info.sha256}
+            self._write_sources(sources)
+            self._prune(keep=info.sha256)
+            return info
+
+    def add_verified(self, stream, name: str, sha256: str) -> FirmwareInfo:
+        """Store an image read from stream (a download) only if its SHA-256 is the expected one"""
+        sha256 = sha256.lower()
+        info = self.get(sha256)
+        if info:
+            self._touch(info.path)
+            return info
+        info = self._import_stream(stream, name, expected_sha256=sha256)
+        with self._lock:
+            self._prune(keep=info.sha256)
+        return info
+
+    def _import(self, source_path: str) -> FirmwareInfo:
+        with open(source_path, 'rb') as src:
+            return self._import_stream(src, os.path.basename(source_path))
+
+    def _import_stream(self, src, name: str, expected_sha256: Optional[str] = None) -> FirmwareInfo:
+        """Hash and copy in one pass over the source, then parse the local copy"""
+        ext = os.path.splitext(name)[1].lower()
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.root, f".import-{os.getpid()}-{threading.get_ident()}")
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as dst:
+                while True:
+                    chunk = src.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            # A download that broke off
+            os.remove(tmp_path)
+            raise
+        sha256 = digest.hexdigest()
+        if expected_sha256 and sha256 != expected_sha256:
+            os.remove(tmp_path)
+            raise ValueError(f"{name}: SHA-256 {sha256[:12]} does not match the expected {expected_sha256[:12]}")
+
+        existing = self.get(sha256)
+        if existing:
+            os.remove(tmp_path)
+            self._touch(existing.path)
+            return existing
+
+        path = os.path.join(self.root, sha256 + ext)
+        try:
+            meta = parse_firmware(tmp_path, name)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        meta.update(name=name, size=size, ext=ext, imported=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        meta_tmp = self._meta_path(sha256) + ".tmp"
+        with open(meta_tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_tmp, self._meta_path(sha256))
+        return self.get(sha256)
+
+    @staticmethod
+    def _touch(path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def list(self) -> List[FirmwareInfo]:
+        """Stored images, most recently used first"""
+        infos = []
+        for entry in os.listdir(self.root):
+            if entry.endswith(".json") and entry != SOURCES_NAME:
+                info = self.get(entry[:-5])
+                if info:
+                    infos.append(info)
+        return sorted(infos, key=lambda info: os.path.getmtime(info.path), reverse=True)
+
+    @contextlib.contextmanager
+    def pinned(self, path: str):
+        """Keep the stored image at path from being pruned (no-op for a path outside the store)"""
+        sha256 = None
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.root):
+            sha256 = os.path.splitext(os.path.basename(path))[0]
+            with self._lock:
+                self._pinned[sha256] = self._pinned.get(sha256, 0) + 1
+        try:
+            yield
+        finally:
+            if sha256:
+                with self._lock:
+                    self._pinned[sha256] -= 1
+                    if not self._pinned[sha256]:
+                        del self._pinned[sha256]
+
+    def _prune(self, keep: str):
+        """Remove least recently used images past MAX_STORE_BYTES (call with the lock held)"""
+        infos = self.list()
+        total = sum(info.size for info in infos)
+        recent = time.time() - PRUNE_GRACE_SECONDS
+        for info in reversed(infos):
+            if total <= MAX_STORE_BYTES:
+                break
+            if info.sha256 == keep or info.sha256 in self._pinned or os.path.getmtime(info.path) > recent:
+                continue
+            self.remove(info.sha256)
+            total -= info.size
+
+    def remove(self, sha256: str):
+        """Delete a stored image and its metadata"""
+        info = self.get(sha256)
+        for path in ([info.path] if info else []) + [self._meta_path(sha256)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+FIRMWARE_STORE = FirmwareStore()
+
+
+def prepare_firmware(config: Dict, firmware_path: str, log, store: FirmwareStore = FIRMWARE_STORE) -> str:
+    """Store the selected file, check it against the project and return the path to flash from
+
+    Without a file the project's cached release is used.
+
+    ESP-IDF build folders (flasher_args.json) and projects with "segments" keep
+    the original path, because their other files are found relative to it.
+    """
+    if not firmware_path:
+        # No file selected: the project's release, from the cache (see releases.py)
+        from .releases import RELEASES
+        return RELEASES.firmware_path(config, log)
+    if firmware_path.lower().endswith(".json"):
+        return firmware_path
+    info = store.add(firmware_path)
+    check_compatible(info, config)
+    log(f"Firmware {info.describe()}\n")
+    if config.get("segments"):
+        return firmware_path
+    return info.path
@@ -0,0 +1,641 @@
+"""Tkinter user interface for the firmware uploader"""
+import os
+import sys
+import json
+import threading
+import tkinter as tk
+from tkinter import filedialog, scrolledtext, ttk, messagebox
+
+from .core import (
+    VERSION, DEFAULT_GANG_CONCURRENCY, MAX_GANG_CONCURRENCY, SRC_DIR,
+    get_resource_path, load_custom_projects, get_project_list, get_project_config, project_registry,
+    list_port_infos, get_project_index, find_matching_ports, gang_flash, format_progress,
+)
+from .hotplug import PortWatcher, AutoFlasher
+from .logview import LogPipeline, ProgressView, new_session_log_path
+from .startup import PROFILE
+
+
+def flash_firmware(project_name: str, firmware_path: str, port_display: str, log, button, progress=None):
+    """Flash firmware based on project configuration"""
+    if not project_name:
+        messagebox.showwarning("Missing project", "Please select a project first.")
+        return
+    if not port_display:
+        messagebox.showwarning("Missing port", "Please select a serial port first.")
+        return
+
+    config = get_project_config(project_name)
+    if not config:
+        messagebox.showerror("Error", f"Unknown project: {project_name}")
+        return
+    if not firmware_path and not config.get("releases"):
+        messagebox.showwarning("Missing file", "Please select a firmware file first.")
+        return
+
+    # Extract just the port name (before any space or parentheses)
+    port = port_display.split(" ")[0].strip()
+
+    button.config(state=tk.DISABLED)
+    log(f"\n{'='*60}\n")
+    log(f"Project: {project_name}\n")
+    log(f"Device: {config['chip']}\n")
+    log(f"Tool: {config['tool']}\n")
+    log(f"Firmware: {os.path.basename(firmware_path) if firmware_path else 'project release'}\n")
+    log(f"Port: {port}\n")
+    log(f"{'='*60}\n\n")
+    if progress:
+        progress.begin()
+
+    def finish(ok: bool, title: str, message: str):
+        # On the Tk thread: workers only post their outcome here
+        if progress:
+            progress.end(ok)
+        button.config(state=tk.NORMAL)
+        (messagebox.showinfo if ok else messagebox.showerror)(title, message)
+
+    def run():
+        try:
+            # Through the job queue, so transient sync failures are retried (see jobqueue.py)
+            from .jobqueue import FlashQueue
+            on_progress = (lambda port, update: progress.update(update)) if progress else None
+            queue = FlashQueue(log, on_progress=on_progress, prefix_ports=False)
+            job = queue.submit(config, port, firmware_path)
+            job.wait()
+        except ValueError as e:
+            # Invalid retry settings in the project config
+            button.after(0, finish, False, "Error", str(e))
+            return
+        except Exception as e:
+            log(f"\n❌ Error: {str(e)}\n")
+            button.after(0, finish, False, "Error", str(e))
+            return
+        if job.returncode == 0:
+            button.after(0, finish, True, "Success", "Firmware uploaded successfully!")
+        else:
+            button.after(0, finish, False, "Error", "Firmware upload failed. Check the log for details.")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def open_gang_window(root, project_combo, firmware_entry, log, watcher):
+    """Open the gang flashing window (same firmware to several ports at once)"""
+    window = tk.Toplevel(root)
+    window.title("Gang Flash")
+    window.geometry("600x480")
+    
+    tk.Label(window, text="Ports to flash:", font=("Arial", 10, "bold")).pack(anchor="w", padx=10, pady=(10, 0))
+    port_list = tk.Listbox(window, selectmode=tk.MULTIPLE, height=8, exportselection=False)
+    port_list.pack(fill="x", padx=10, pady=5)
+    
+    ports = []
+    
+    def reload_ports(rescan=False):
+        ports[:] = watcher.rescan() if rescan else watcher.ports()
+        port_list.delete(0, tk.END)
+        for info in ports:
+            port_list.insert(tk.END, info.display())
+    
+    def select_matching():
+        config = get_project_config(project_combo.get())
+        matching = find_matching_ports(config, ports)
+        port_list.selection_clear(0, tk.END)
+        for idx, info in enumerate(ports):
+            if info.device in matching:
+                port_list.selection_set(idx)
+    
+    controls = tk.Frame(window)
+    controls.pack(fill="x", padx=10, pady=5)
+    tk.Button(controls, text="🔄 Refresh", command=lambda: reload_ports(rescan=True)).pack(side="left")
+    tk.Button(controls, text="Select matching", command=select_matching).pack(side="left", padx=5)
+    tk.Label(controls, text="Max parallel:").pack(side="left", padx=(15, 0))
+    max_parallel = tk.Spinbox(controls, from_=1, to=MAX_GANG_CONCURRENCY, width=4)
+    max_parallel.delete(0, tk.END)
+    max_parallel.insert(0, str(DEFAULT_GANG_CONCURRENCY))
+    max_parallel.pack(side="left", padx=5)
+    
+    # Per-port status table
+    status_table = ttk.Treeview(window, columns=("port", "status", "progress", "exit"), show="headings", height=8)
+    status_table.heading("port", text="Port")
+    status_table.heading("status", text="Status")
+    status_table.heading("progress", text="Progress")
+    status_table.heading("exit", text="Exit code")
+    status_table.column("status", width=80)
+    status_table.column("progress", width=180)
+    status_table.column("exit", width=70, anchor="center")
+    status_table.pack(fill="both", expand=True, padx=10, pady=5)
+    
+    def set_status(port, status, returncode=None):
+        exit_text = "" if returncode is None else str(returncode)
+        if status_table.exists(port):
+            status_table.set(port, "status", status)
+            status_table.set(port, "exit", exit_text)
+        else:
+            status_table.insert("", tk.END, iid=port, values=(port, status, "", exit_text))
+    
+    def set_progress(port, text):
+        if status_table.exists(port):
+            status_table.set(port, "progress", text)
+    
+    def start():
+        project_name = project_combo.get()
+        firmware_path = firmware_entry.get()
+        selected = [ports[idx].device for idx in port_list.curselection()]
+        config = get_project_config(project_name)
+        if not config:
+            messagebox.showwarning("Missing project", "Please select a project first.", parent=window)
+            return
+        if not firmware_path and not config.get("releases"):
+            messagebox.showwarning("Missing file", "Please select a firmware file first.", parent=window)
+            return
+        if not selected:
+            messagebox.showwarning("Missing port", "Please select at least one serial port.", parent=window)
+            return
+        try:
+            parallel = int(max_parallel.get())
+        except ValueError:
+            parallel = DEFAULT_GANG_CONCURRENCY
+        
+        start_button.config(state=tk.DISABLED)
+        status_table.delete(*status_table.get_children())
+        log(f"\n{'='*60}\n")
+        log(f"Gang flash: {project_name}\n")
+        log(f"Firmware: {os.path.basename(firmware_path) if firmware_path else 'project release'}\n")
+        log(f"Ports: {', '.join(selected)} (max {parallel} parallel)\n")
+        log(f"{'='*60}\n\n")
+            
+        def on_status(port, status, returncode):
+            window.after(0, set_status, port, status, returncode)
+        
+        def on_progress(port, progress):
+            window.after(0, set_progress, port, format_progress(progress))
+        
+        def finish(results, error=None):
+            # On the Tk thread
+            start_button.config(state=tk.NORMAL)
+            if error is not None:
+                messagebox.showerror("Error", error, parent=window)
+                return
+            failed = [port for port, code in results.items() if code != 0]
+            if failed:
+                messagebox.showerror("Error", f"Flash failed on: {', '.join(failed)}", parent=window)
+            else:
+                messagebox.showinfo("Success", f"Firmware uploaded to {len(results)} device(s)!", parent=window)
+        
+        def run():
+            try:
+                results = gang_flash(config, selected, firmware_path, log,
+                                     max_parallel=parallel, on_status=on_status, on_progress=on_progress)
+            except Exception as e:
+                log(f"\n❌ Error: {str(e)}\n")
+                window.after(0, finish, {}, str(e))
+                return
+            failed = [port for port, code in results.items() if code != 0]
+            log(f"\nGang flash finished: {len(results) - len(failed)} ok, {len(failed)} failed\n")
+            window.after(0, finish, results)
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    start_button = tk.Button(
+        window,
+        text="🚀 Flash Selected",
+        font=("Arial", 11, "bold"),
+        bg="#4CAF50",
+        fg="white",
+        command=start
+    )
+    start_button.pack(pady=10)
+    
+    reload_ports()
+    select_matching()
+
+
+def select_firmware(entry, project_combo):
+    """Open file dialog to select firmware"""
+    project = project_combo.get()
+    
+    # Determine file types based on project
+    config = get_project_config(project)
+    if config:
+        tool = config["tool"]
+        if tool == "esptool":
+            filetypes = [("BIN files", "*.bin"), ("ESP-IDF build", "flasher_args.json"), ("All files", "*.*")]
+        elif tool in ("avrdude", "stk500"):
+            filetypes = [("HEX files", "*.hex"), ("BIN files", "*.bin"), ("All files", "*.*")]
+        else:
+            filetypes = [("All files", "*.*")]
+    else:
+        filetypes = [("Firmware files", "*.bin *.hex"), ("All files", "*.*")]
+    
+    file = filedialog.askopenfilename(filetypes=filetypes)
+    if file:
+        entry.delete(0, tk.END)
+        entry.insert(0, file)
+
+
+def refresh_ports(combo, project_combo=None, ports=None, keep_current=False):
+    """Refresh the list of COM ports and auto-select the best match for the project
+    
+    ports is a PortInfo list, scanned now if not given. With keep_current the
+    operator's selection stays if that port is still there.
+    """
+    if ports is None:
+        ports = list_port_infos()
+    current = combo.get()
+    combo["values"] = [info.display() for info in ports]
+    
+    if not ports:
+        combo.set("❌ No serial ports found")
+        return
+    if keep_current and current in combo["values"]:
+        return
+    
+    # Pick the port that matches the project's USB identity (or port hint) best
+    best_match_idx = None
+    if project_combo:
+        project = project_combo.get()
+        index = get_project_index()
+        best_score = 0
+        for idx, info in enumerate(ports):
+            score = index.score(project, info)
+            if score > best_score:
+                best_score = score
+                best_match_idx = idx
+    
+    # Set the selection
+    if best_match_idx is not None:
+        combo.current(best_match_idx)
+    else:
+        # No good match found - leave empty
+        combo.set("")
+
+
+def update_port_hint(project_combo, hint_label):
+    """Update the port hint based on selected project"""
+    project = project_combo.get()
+    config = get_project_config(project)
+    if config:
+        hint = config.get("port_hint", "")
+        hint_label.config(text=f"Serial Port (look for: {hint}):" if hint else "Serial Port:")
+    else:
+        hint_label.config(text="Serial Port:")
+
+
+def update_release_hint(project_combo, firmware_label):
+    """Show which release flashes when no firmware file is selected"""
+    config = get_project_config(project_combo.get())
+    if not config or not config.get("releases"):
+        firmware_label.config(text="Firmware File:")
+        return
+    from .releases import RELEASES, ReleaseSource
+    version = RELEASES.cached_version(ReleaseSource.from_config(config))
+    firmware_label.config(text=f"Firmware File (leave empty for release {version}):" if version
+                          else "Firmware File (leave empty for the latest release):")
+
+
+def export_sample_config():
+    """Export a sample configuration file"""
+    sample = {
+        "Custom ESP32 Project": {
+            "chip": "esp32",
+            "tool": "esptool",
+            "baud": "921600",
+            "address": "0x10000",
+            "port_hint": "CH9102",
+            "usb": [{"vid": "1A86", "pid": "55D4"}]
+        },
+        "Custom Arduino Mega": {
+            "chip": "atmega2560",
+            "tool": "avrdude",
+            "baud": "115200",
+            "programmer": "wiring",
+            "port_hint": "Arduino Mega",
+            "usb": [{"vid": "2341", "pid": "0042"}]
+        }
+    }
+    
+    with open("projects_config_sample.json", 'w') as f:
+        json.dump(sample, f, indent=2)
+    
+    messagebox.showinfo("Success", "Sample config exported to 'projects_config_sample.json'")
+
+
+def main():
+    PROFILE.mark("gui imported")
+    root = tk.Tk()
+    root.title(f"Firmware Uploader v{VERSION}")
+    root.geometry("700x600")
+    
+    # Set window icon
+    try:
+        if os.name == 'nt':  # Windows
+            icon_path = get_resource_path(os.path.join('build-tools', 'assets', 'logo.ico'))
+            # If not found in that path, try relative to script
+            if not os.path.exists(icon_path):
+                icon_path = os.path.join(SRC_DIR, '..', 'build-tools', 'assets', 'logo.ico')
+            if os.path.exists(icon_path):
+                root.iconbitmap(icon_path)
+        else:  # macOS/Linux
+            icon_path = get_resource_path(os.path.join('build-tools', 'assets', 'logo.png'))
+            # If not found in that path, try relative to script
+            if not os.path.exists(icon_path):
+                icon_path = os.path.join(SRC_DIR, '..', 'build-tools', 'assets', 'logo.png')
+            if os.path.exists(icon_path):
+                icon_img = tk.PhotoImage(file=icon_path)
+                root.iconphoto(True, icon_img)
+    except Exception as e:
+        # If icon loading fails, just continue without it
+        print(f"Could not load icon: {e}")
+    
+    # Menu bar
+    menubar = tk.Menu(root)
+    root.config(menu=menubar)
+    
+    file_menu = tk.Menu(menubar, tearoff=0)
+    menubar.add_cascade(label="File", menu=file_menu)
+    file_menu.add_command(label="Export Sample Config", command=export_sample_config)
+    file_menu.add_separator()
+    file_menu.add_command(label="Exit", command=root.quit)
+    
+    help_menu = tk.Menu(menubar, tearoff=0)
+    menubar.add_cascade(label="Help", menu=help_menu)
+    help_menu.add_command(
+        label="How to Use",
+        command=lambda: messagebox.showinfo(
+            "How to Use",
+            "1. Select your project from the dropdown\n"
+            "   (Click 'Advanced' for generic boards)\n"
+            "2. Browse for your firmware file (.bin or .hex)\n"
+            "3. Connect your device via USB\n"
+            "4. Select the COM port\n"
+            "5. Click 'Flash Firmware'\n"
+            "   (or 'Gang Flash' to flash several ports at once)\n\n"
+            "Troubleshooting:\n"
+            "• No ports? Replug the cable or install USB drivers\n"
+            "• Upload failed? Check project selection and cable"
+        )
+    )
+    help_menu.add_command(
+        label="About",
+        command=lambda: messagebox.showinfo(
+            "About",
+            f"Firmware Uploader v{VERSION}\n\n"
+            "Simple tool for uploading firmware to\n"
+            "ESP32, Arduino, and other devices.\n\n"
+            "Supports: esptool, avrdude, STK500 (built-in)\n\n"
+            "─────────────────────────────\n"
+            "Developed by: Daniël Vegter\n"
+            "Company: Broadcast Rental\n"
+            "─────────────────────────────"
+        )
+    )
+    
+    # --- Project selector ---
+    project_label_frame = tk.Frame(root)
+    project_label_frame.pack(anchor="w", padx=10, pady=(10, 0), fill="x")
+    
+    tk.Label(project_label_frame, text="Project:", font=("Arial", 10, "bold")).pack(side="left")
+    
+    # Advanced mode toggle
+    show_advanced = tk.BooleanVar(value=False)
+    
+    def toggle_advanced():
+        """Toggle between user projects and all projects"""
+        is_advanced = show_advanced.get()
+        projects = get_project_list(show_advanced=is_advanced)
+        
+        # Store current selection
+        current = project_combo.get()
+        
+        # Update combo box values
+        project_combo["values"] = projects
+        
+        # Try to keep current selection if still valid
+        if current in projects:
+            project_combo.set(current)
+        elif projects:
+            project_combo.current(0)
+        
+        # Update button text
+        if is_advanced:
+            advanced_btn.config(text="✓ Advanced", relief=tk.SUNKEN)
+        else:
+            advanced_btn.config(text="Advanced", relief=tk.RAISED)
+    
+    advanced_btn = tk.Button(
+        project_label_frame,
+        text="Advanced",
+        command=lambda: [show_advanced.set(not show_advanced.get()), toggle_advanced()],
+        relief=tk.RAISED,
+        padx=10
+    )
+    advanced_btn.pack(side="right", padx=(0, 10))
+    
+    project_combo = ttk.Combobox(root, width=60, state="readonly")
+    project_combo.pack(anchor="w", padx=10, pady=5)
+    project_combo.set("Loading projects...")
+    
+    # --- Firmware selector ---
+    firmware_label = tk.Label(root, text="Firmware File:", font=("Arial", 10, "bold"))
+    firmware_label.pack(anchor="w", padx=10, pady=(10, 0))
+    fw_frame = tk.Frame(root)
+    fw_frame.pack(fill="x", padx=10, pady=5)
+    firmware_entry = tk.Entry(fw_frame, width=70)
+    firmware_entry.pack(side="left", fill="x", expand=True)
+    tk.Button(
+        fw_frame,
+        text="Browse",
+        command=lambda: select_firmware(firmware_entry, project_combo)
+    ).pack(side="left", padx=5)
+    
+    # --- Serial port selector ---
+    port_hint_label = tk.Label(root, text="Serial Port:", font=("Arial", 10, "bold"))
+    port_hint_label.pack(anchor="w", padx=10, pady=(10, 0))
+    
+    port_frame = tk.Frame(root)
+    port_frame.pack(fill="x", padx=10, pady=5)
+    
+    port_combo = ttk.Combobox(port_frame, width=50)
+    port_combo.pack(side="left", fill="x", expand=True)
+    
+    # Ports are tracked by a background watcher; the UI only reads its cached list
+    watcher = PortWatcher()
+    
+    tk.Button(
+        port_frame,
+        text="🔄 Refresh",
+        command=lambda: refresh_ports(port_combo, project_combo, watcher.rescan())
+    ).pack(side="left", padx=5)
+    
+    seen_generation = [watcher.generation]
+    # Project configs reload in the background when a config file changes
+    seen_projects = [0]
+    seen_releases = [0]
+    
+    def prefetch_releases():
+        """Fetch the projects' releases in the background, so flashing works offline"""
+        from .releases import prefetch_in_background
+        registry = project_registry()
+        configs = [config for config in registry.projects.values() if config.get("releases")]
+        if configs:
+            prefetch_in_background(configs, log)
+    
+    def poll_ports():
+        if watcher.generation != seen_generation[0]:
+            seen_generation[0] = watcher.generation
+            refresh_ports(port_combo, project_combo, watcher.ports(), keep_current=True)
+        registry = project_registry()
+        if registry.generation != seen_projects[0]:
+            seen_projects[0] = registry.generation
+            toggle_advanced()
+            update_port_hint(project_combo, port_hint_label)
+            update_release_hint(project_combo, firmware_label)
+            prefetch_releases()
+            refresh_ports(port_combo, project_combo, watcher.ports(), keep_current=True)
+            log(f"Project configurations reloaded ({len(registry.names)} project(s))\n")
+            for problem in registry.problems:
+                log(f"Warning: {problem}\n")
+        from .releases import RELEASES
+        if RELEASES.generation != seen_releases[0]:
+            seen_releases[0] = RELEASES.generation
+            update_release_hint(project_combo, firmware_label)
+        root.after(500, poll_ports)
+    
+    # Update port hint and refresh port selection when project changes
+    def on_project_change(event):
+        update_port_hint(project_combo, port_hint_label)
+        update_release_hint(project_combo, firmware_label)
+        refresh_ports(port_combo, project_combo, watcher.ports())
+    
+    project_combo.bind("<<ComboboxSelected>>", on_project_change)
+    
+    # --- Flash button ---
+    flash_button = tk.Button(
+        root,
+        text="🚀 Flash Firmware",
+        font=("Arial", 12, "bold"),
+        bg="#4CAF50",
+        fg="white",
+        command=lambda: flash_firmware(
+            project_combo.get(),
+            firmware_entry.get(),
+            port_combo.get(),
+            log,
+            flash_button,
+            progress
+        ),
+        state=tk.DISABLED
+    )
+    flash_button.pack(padx=10, pady=(15, 5))
+    
+    progress = ProgressView(root)
+    progress.frame.pack(fill="x", padx=10, pady=(0, 5))
+    
+    extra_frame = tk.Frame(root)
+    extra_frame.pack(padx=10, pady=(0, 10))
+    tk.Button(
+        extra_frame,
+        text="Gang Flash (multiple ports)...",
+        command=lambda: open_gang_window(root, project_combo, firmware_entry, log, watcher)
+    ).pack(side="left")
+    
+    # Auto-flash: every matching board plugged in while this is ticked gets flashed
+    auto_flash = tk.BooleanVar(value=False)
+    auto_flasher = [None]
+    
+    def toggle_auto_flash():
+        if auto_flasher[0]:
+            auto_flasher[0].stop()
+            auto_flasher[0] = None
+            log("Auto-flash off\n")
+        if not auto_flash.get():
+            return
+        config = get_project_config(project_combo.get())
+        firmware_path = firmware_entry.get()
+        if not config or not (firmware_path or config.get("releases")):
+            messagebox.showwarning("Auto-flash", "Please select a project and a firmware file first.")
+            auto_flash.set(False)
+            return
+        auto_flasher[0] = AutoFlasher(watcher, [(project_combo.get(), config, firmware_path)], log)
+        auto_flasher[0].start()
+        log(f"\nAuto-flash on: {project_combo.get()}, "
+            f"{os.path.basename(firmware_path) if firmware_path else 'project release'}\n"
+            f"Plug in matching boards to flash them (port watch: {watcher.mode or 'starting'})\n")
+    
+    tk.Checkbutton(
+        extra_frame,
+        text="Auto-flash new boards",
+        variable=auto_flash,
+        command=toggle_auto_flash
+    ).pack(side="left", padx=(15, 0))
+    
+    # --- Log output ---
+    tk.Label(root, text="Log Output:", font=("Arial", 10, "bold")).pack(anchor="w", padx=10)
+    log_text = scrolledtext.ScrolledText(root, wrap=tk.WORD, width=80, height=20)
+    log_text.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+    
+    # All output goes through a queue drained by the main loop (workers never touch Tk directly)
+    log = LogPipeline(log_text, spill_path=new_session_log_path())
+    log.start()
+    
+    log(f"Firmware Uploader v{VERSION}\n")
+    if log.spill_path:
+        log(f"Full log: {log.spill_path}\n")
+    PROFILE.mark("window built")
+    
+    # Project configs and the first port scan load in the background, so the window shows at once
+    loaded = threading.Event()
+    
+    def load_in_background():
+        try:
+            load_custom_projects()
+            PROFILE.mark("projects loaded")
+            prefetch_releases()
+            watcher.start()
+            PROFILE.mark("ports enumerated")
+        except Exception as e:
+            # The window still has to become usable (built-in projects, manual port entry)
+            log(f"❌ Startup error: {e}\n")
+        finally:
+            loaded.set()
+    
+    def finish_startup():
+        if not loaded.is_set():
+            root.after(20, finish_startup)
+            return
+        project_combo["values"] = get_project_list(show_advanced=show_advanced.get())
+        if project_combo["values"]:
+            project_combo.current(0)
+        else:
+            project_combo.set("")
+        update_port_hint(project_combo, port_hint_label)
+        update_release_hint(project_combo, firmware_label)
+        refresh_ports(port_combo, project_combo, watcher.ports())
+        seen_generation[0] = watcher.generation
+        registry = project_registry()
+        seen_projects[0] = registry.generation
+        root.after(500, poll_ports)
+        flash_button.config(state=tk.NORMAL)
+        
+        log(f"Loaded {len(registry.names)} project configuration(s)\n")
+        log(f"Available: {len(registry.advanced_names)} advanced board(s)\n")
+        for problem in registry.problems:
+            log(f"Warning: {problem}\n")
+        log("="*60 + "\n\n")
+        PROFILE.mark("interactive")
+        profile_path = PROFILE.report(VERSION)
+        if profile_path:
+            log(PROFILE.format() + f"Saved to {profile_path}\n\n")
+    
+    threading.Thread(target=load_in_background, name="startup", daemon=True).start()
+    root.after(0, lambda: [PROFILE.mark("main loop started"), finish_startup()])
+    
+    root.mainloop()
+    if auto_flasher[0]:
+        auto_flasher[0].stop()
+    watcher.stop()
+    # Sessions only exist if a flash ran (the module is imported on first use)
+    esp_session = sys.modules.get(f"{__package__}.esp_session")
+    if esp_session:
+        esp_session.SESSIONS.close_all()
+    log.stop()
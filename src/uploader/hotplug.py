@@ -0,0 +1,228 @@
+"""Serial port hotplug monitoring
+
+A PortWatcher thread keeps a cached list of serial ports and reports boards
+being plugged in and out, so the UI never rescans on its own. On Linux with
+pyudev installed it sleeps on udev "tty" events and rescans only when one
+arrives; everywhere else it rescans every second and compares the result.
+
+An AutoFlasher listens to a watcher and flashes every newly attached port that
+matches one of its projects (by USB identity, see identity.py), for production
+stations where the operator only swaps boards.
+"""
+import sys
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .core import PortInfo, DEFAULT_GANG_CONCURRENCY, list_port_infos
+from .identity import ProjectIndex, has_identity, port_score
+from .jobqueue import FlashQueue
+
+ATTACH = "attach"
+DETACH = "detach"
+POLL_INTERVAL = 1.0
+# USB-serial drivers need a moment after the device node appears before it can be opened
+ATTACH_SETTLE_SECONDS = 0.5
+# Boards with a native USB port re-enumerate after the reset that ends a flash
+REFLASH_COOLDOWN_SECONDS = 30.0
+
+
+def _udev_monitor():
+    """udev monitor for tty devices, or None when udev (or pyudev) is not available"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import pyudev
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by("tty")
+        monitor.start()
+        return monitor
+    except Exception:
+        return None
+
+
+class PortWatcher:
+    """Background thread that keeps the serial port list current
+
+    Listeners are called as listener(ATTACH or DETACH, PortInfo) from the
+    watcher thread. generation increases on every change, so a UI can poll it
+    cheaply and refresh only when something happened.
+    """
+
+    def __init__(self, interval: float = POLL_INTERVAL):
+        self.interval = interval
+        self.generation = 0
+        self.mode = None
+        self._ports: Dict[str, PortInfo] = {}
+        self._listeners: List[Callable] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ports(self) -> List[PortInfo]:
+        """Cached port list, sorted by device name"""
+        with self._lock:
+            return [self._ports[device] for device in sorted(self._ports)]
+
+    def subscribe(self, listener: Callable):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def rescan(self) -> List[PortInfo]:
+        """Enumerate ports now, notify listeners of the differences and return the new list"""
+        current = {info.device: info for info in list_port_infos()}
+        with self._lock:
+            attached = [info for device, info in current.items() if self._ports.get(device) != info]
+            detached = [info for device, info in self._ports.items() if device not in current]
+            self._ports = current
+            if attached or detached:
+                self.generation += 1
+            listeners = list(self._listeners)
+
+        for event, infos in ((DETACH, detached), (ATTACH, attached)):
+            for info in infos:
+                for listener in listeners:
+                    try:
+                        listener(event, info)
+                    except Exception as e:
+                        print(f"Port listener failed: {e}")
+        return self.ports()
+
+    def start(self):
+        """Scan once synchronously, then keep watching in the background (mode is set on return)"""
+        if self._thread:
+            return
+        # Started before the first scan, so a board plugged in meanwhile is not missed
+        monitor = _udev_monitor()
+        self.mode = "udev" if monitor else "polling"
+        self.rescan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(monitor,), name="port-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2 * self.interval)
+            self._thread = None
+
+    def _run(self, monitor):
+        while not self._stop.is_set():
+            try:
+                if monitor:
+                    if monitor.poll(timeout=self.interval) is None:
+                        continue
+                    # Let the rest of the burst (and the /dev/serial symlinks) arrive, then scan once
+                    time.sleep(0.2)
+                    while monitor.poll(timeout=0):
+                        pass
+                elif self._stop.wait(self.interval):
+                    break
+                self.rescan()
+            except Exception as e:
+                print(f"Port watcher: {e}")
+                self._stop.wait(self.interval)
+
+
+class AutoFlasher:
+    """Flash every matching port as it is plugged in
+
+    targets is a list of (project name, config, firmware path). Each new port
+    gets the target whose USB identity (or port hint) matches it best; a
+    single target without either matches every USB serial port. Ports are
+    flashed in parallel (at most max_parallel at once), once per attach,
+    through a FlashQueue, so a failed flash is retried unattended; unplugging
+    a board drops its pending retries. A board with a USB serial number is
+    not flashed again within REFLASH_COOLDOWN_SECONDS, because native-USB
+    chips drop off the bus and come back when they reset after flashing.
+    """
+
+    def __init__(self, watcher: PortWatcher, targets: List[Tuple[str, Dict, str]], log,
+                 max_parallel: int = DEFAULT_GANG_CONCURRENCY, on_status=None, on_progress=None):
+        if not targets:
+            raise ValueError("Auto-flash needs at least one project")
+        self.watcher = watcher
+        self.targets = {name: (config, firmware_path) for name, config, firmware_path in targets}
+        self.index = ProjectIndex({name: config for name, config, _ in targets})
+        self.log = log
+        self.on_status = on_status
+        self.on_progress = on_progress
+        self.results: Dict[str, int] = {}
+        self.queue = FlashQueue(log, max_parallel, on_status, on_progress)
+        self._busy = set()
+        self._flashed_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._active = False
+
+    def start(self, include_present: bool = False):
+        """Start flashing new arrivals (and the ports already present if include_present)"""
+        self._active = True
+        self.watcher.subscribe(self._on_event)
+        if include_present:
+            for info in self.watcher.ports():
+                self._on_event(ATTACH, info)
+
+    def stop(self):
+        """Stop reacting to new ports (flashes already running finish)"""
+        self._active = False
+        self.watcher.unsubscribe(self._on_event)
+
+    def busy(self) -> int:
+        with self._lock:
+            return len(self._busy)
+
+    def target_for(self, info: PortInfo) -> Optional[str]:
+        """Project to flash onto a port, or None to leave it alone"""
+        project = self.index.best_project(info)
+        if project is not None or len(self.targets) != 1 or info.vid is None:
+            # A project without identity only takes USB serial devices, never ttyS0 and the like
+            return project
+        name, (config, _) = next(iter(self.targets.items()))
+        if has_identity(config) and port_score(config, info) == 0:
+            return None
+        return name
+
+    def _on_event(self, event: str, info: PortInfo):
+        if event == DETACH:
+            self.queue.cancel_port(info.device)
+        if event != ATTACH or not self._active:
+            return
+        project = self.target_for(info)
+        if project is None:
+            return
+        with self._lock:
+            if info.device in self._busy:
+                return
+            if info.serial_number:
+                flashed_at = self._flashed_at.get(info.serial_number)
+                if flashed_at and time.monotonic() - flashed_at < REFLASH_COOLDOWN_SECONDS:
+                    return
+            self._busy.add(info.device)
+        self._flash(info, project)
+
+    def _flash(self, info: PortInfo, project: str):
+        """Queue the flash (after the driver settles) and record its result when it ends"""
+        config, firmware_path = self.targets[project]
+        self.log(f"[{info.device}] Attached: {info.description} -> {project}\n")
+
+        def finished(job):
+            with self._lock:
+                # Unplugged before its first attempt: nothing was flashed
+                if job.attempts:
+                    self.results[info.device] = job.returncode
+                    if info.serial_number:
+                        self._flashed_at[info.serial_number] = time.monotonic()
+                self._busy.discard(info.device)
+
+        try:
+            job = self.queue.submit(config, info.device, firmware_path, delay=ATTACH_SETTLE_SECONDS)
+        except Exception:
+            with self._lock:
+                self._busy.discard(info.device)
+            raise
+        job.add_done_callback(finished)
@@ -0,0 +1,163 @@
+"""USB identity matching between serial ports and projects
+
+A project can declare the USB identity of its board under "usb", as one
+object or a list of them:
+
+    "usb": [{"vid": "1A86", "pid": "55D4"},
+            {"vid": "0403", "pid": "6001", "manufacturer": "FTDI", "serial": "A5*"}]
+
+vid/pid are hex; manufacturer and serial are case-insensitive glob patterns.
+ProjectIndex compiles these into a dict keyed by (vid, pid), so finding the
+candidate projects for a port is one lookup however many projects exist.
+Projects without "usb" fall back to their "port_hint", matched against the
+port description. The hint may list alternatives ("CH340 or FT232").
+"""
+import re
+import fnmatch
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# A USB identity always outranks a description match
+USB_BASE_SCORE = 10
+
+
+def parse_usb_id(value) -> int:
+    """Parse a VID or PID given as int, "1A86" or "0x1A86" """
+    if isinstance(value, int):
+        number = value
+    else:
+        text = str(value).strip().lower()
+        number = int(text[2:] if text.startswith("0x") else text, 16)
+    if not 0 <= number <= 0xFFFF:
+        raise ValueError(f"USB id out of range: {value}")
+    return number
+
+
+class UsbMatch(NamedTuple):
+    vid: int
+    pid: Optional[int]
+    manufacturer: Optional[str]
+    serial: Optional[str]
+
+    @classmethod
+    def from_config(cls, entry: Dict) -> "UsbMatch":
+        if not isinstance(entry, dict) or "vid" not in entry:
+            raise ValueError(f"USB match needs at least a vid: {entry}")
+        unknown = set(entry) - {"vid", "pid", "manufacturer", "serial"}
+        if unknown:
+            raise ValueError(f"Unknown USB match key(s): {', '.join(sorted(unknown))}")
+        return cls(
+            parse_usb_id(entry["vid"]),
+            parse_usb_id(entry["pid"]) if entry.get("pid") is not None else None,
+            entry.get("manufacturer", "").lower() or None,
+            entry.get("serial", "").lower() or None,
+        )
+
+    def score(self, info) -> int:
+        """How specifically this matches a port (0 if it does not match)"""
+        if info.vid != self.vid or (self.pid is not None and info.pid != self.pid):
+            return 0
+        score = USB_BASE_SCORE + (2 if self.pid is not None else 0)
+        if self.manufacturer:
+            if not fnmatch.fnmatchcase((info.manufacturer or "").lower(), self.manufacturer):
+                return 0
+            score += 1
+        if self.serial:
+            if not fnmatch.fnmatchcase((info.serial_number or "").lower(), self.serial):
+                return 0
+            score += 4
+        return score
+
+
+def usb_matches(config: Dict) -> List[UsbMatch]:
+    """The compiled "usb" entries of a project config (raises ValueError if malformed)"""
+    entries = config.get("usb") or []
+    if isinstance(entries, dict):
+        entries = [entries]
+    return [UsbMatch.from_config(entry) for entry in entries]
+
+
+def hint_alternatives(hint: str) -> List[List[str]]:
+    """Split a port hint into alternatives, each a list of words that must all occur"""
+    parts = re.split(r"\s+or\s+|[,|/]", hint.lower())
+    return [part.split() for part in parts if part.strip()]
+
+
+def score_port_hint(description: str, hint: str) -> int:
+    """Number of words of the best port hint alternative found in description (0 if none match fully)"""
+    desc_lower = description.lower()
+    best = 0
+    for words in hint_alternatives(hint):
+        if all(word in desc_lower for word in words):
+            best = max(best, len(words))
+    return best
+
+
+def has_identity(config: Dict) -> bool:
+    """Whether a project says anything about which port it uses"""
+    return bool(config.get("usb") or config.get("port_hint"))
+
+
+def port_score(config: Dict, info) -> int:
+    """How well a port matches a single project (0 if it does not)"""
+    matches = usb_matches(config)
+    if matches:
+        return max(match.score(info) for match in matches)
+    hint = config.get("port_hint", "")
+    return score_port_hint(info.description, hint) if hint else 0
+
+
+class ProjectIndex:
+    """Maps a port to its candidate projects in one dict lookup
+
+    Built once from {name: config}. Results are memoised per port identity,
+    so refreshing a port list does not score anything again.
+    """
+
+    def __init__(self, projects: Dict[str, Dict]):
+        self._order = {name: idx for idx, name in enumerate(projects)}
+        self._by_id: Dict[Tuple[int, Optional[int]], List[Tuple[str, UsbMatch]]] = {}
+        self._hints: List[Tuple[str, str]] = []
+        self._memo: Dict[tuple, Dict[str, int]] = {}
+
+        for name, config in projects.items():
+            try:
+                matches = usb_matches(config)
+            except ValueError as e:
+                print(f"Warning: project {name!r}: {e}")
+                matches = []
+            for match in matches:
+                self._by_id.setdefault((match.vid, match.pid), []).append((name, match))
+            if not matches and config.get("port_hint"):
+                self._hints.append((name, config["port_hint"]))
+
+    def _scores(self, info) -> Dict[str, int]:
+        key = (info.vid, info.pid, info.serial_number, info.manufacturer, info.description)
+        scores = self._memo.get(key)
+        if scores is not None:
+            return scores
+
+        scores = {}
+        if info.vid is not None:
+            for id_key in ((info.vid, info.pid), (info.vid, None)):
+                for name, match in self._by_id.get(id_key, ()):
+                    score = match.score(info)
+                    if score > scores.get(name, 0):
+                        scores[name] = score
+        for name, hint in self._hints:
+            score = score_port_hint(info.description, hint)
+            if score:
+                scores[name] = score
+        self._memo[key] = scores
+        return scores
+
+    def candidates(self, info) -> List[Tuple[str, int]]:
+        """(project, score) pairs for a port, best first (ties keep project order)"""
+        scores = self._scores(info)
+        return sorted(scores.items(), key=lambda item: (-item[1], self._order[item[0]]))
+
+    def best_project(self, info) -> Optional[str]:
+        candidates = self.candidates(info)
+        return candidates[0][0] if candidates else None
+
+    def score(self, name: str, info) -> int:
+        return self._scores(info).get(name, 0)
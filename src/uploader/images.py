@@ -0,0 +1,154 @@
+"""Firmware image sets: which files go to which flash address
+
+A project normally writes one file at its "address". A full provision needs
+several segments (bootloader, partition table, otadata, app), which a project
+can declare as "segments", or the operator can select an ESP-IDF build's
+flasher_args.json. Either way the result is a FlashPlan that is written in one
+esptool run: one sync, one compressed write pass and one reset.
+
+Merged images (esptool merge-bin output) are a single segment at 0x0, i.e.
+a project with "address": "0x0". With "partitions" the plan is then fitted
+to the partition table (partitions.py).
+
+Image files are read through mapped_file(), so hashing, diffing and
+comparing a 16 MB image works on slices of the file's pages instead of
+copies of its contents.
+"""
+import os
+import json
+import mmap
+import contextlib
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+FLASHER_ARGS_NAME = "flasher_args.json"
+# Placeholder in a project's "segments" for the firmware file selected by the operator
+SELECTED_FIRMWARE = "$firmware"
+
+
+class FlashPlan(NamedTuple):
+    segments: List[Tuple[int, str]]
+    flash_settings: Dict[str, str]
+    # What partition planning changed, for the log
+    notes: Tuple[str, ...] = ()
+
+    def esptool_args(self) -> List[str]:
+        """Arguments following "write-flash" on the esptool command line"""
+        args = []
+        for key in ("flash_mode", "flash_freq", "flash_size"):
+            if self.flash_settings.get(key):
+                args += ["--" + key.replace("_", "-"), self.flash_settings[key]]
+        for address, path in self.segments:
+            args += [hex(address), path]
+        return args
+
+    def total_bytes(self) -> int:
+        return sum(os.path.getsize(path) for _, path in self.segments)
+
+    def describe(self) -> str:
+        return "\n".join(f"  {address:#08x}  {os.path.basename(path)}" for address, path in self.segments)
+
+
+@contextlib.contextmanager
+def mapped_file(path: str):
+    """Read-only memoryview of a file, memory-mapped rather than read
+
+    Slices are zero-copy views; don't keep them past the with block. An
+    empty file (which can't be mapped) gives an empty view.
+    """
+    with open(path, 'rb') as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield memoryview(b"")
+            return
+        view = memoryview(mapping)
+        try:
+            yield view
+        finally:
+            try:
+                view.release()
+                mapping.close()
+            except BufferError:
+                # A slice outlived the block; the mapping closes when it is collected
+                pass
+
+
+def _parse_address(value) -> int:
+    return value if isinstance(value, int) else int(str(value), 0)
+
+
+def _check_segments(segments: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+    """Sort segments by address and reject missing files or overlapping ranges"""
+    segments = sorted(segments)
+    previous_end, previous_path = 0, None
+    for address, path in segments:
+        if not os.path.exists(path):
+            raise ValueError(f"Segment file not found: {path}")
+        if previous_path and address < previous_end:
+            raise ValueError(
+                f"{os.path.basename(path)} at {address:#x} overlaps "
+                f"{os.path.basename(previous_path)} (ends at {previous_end:#x})"
+            )
+        previous_end, previous_path = address + os.path.getsize(path), path
+    return segments
+
+
+def load_flasher_args(path: str, chip: Optional[str] = None) -> FlashPlan:
+    """Read an ESP-IDF build's flasher_args.json (paths are relative to its folder)"""
+    with open(path, 'r') as f:
+        flasher_args = json.load(f)
+
+    build_chip = flasher_args.get("extra_esptool_args", {}).get("chip")
+    if chip and build_chip and build_chip != chip:
+        raise ValueError(f"{os.path.basename(path)} was built for {build_chip}, project expects {chip}")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    segments = [
+        (_parse_address(address), os.path.join(base_dir, file))
+        for address, file in flasher_args.get("flash_files", {}).items()
+    ]
+    if not segments:
+        raise ValueError(f"{os.path.basename(path)} lists no flash_files")
+    settings = {
+        key: value for key, value in flasher_args.get("flash_settings", {}).items()
+        if key in ("flash_mode", "flash_freq", "flash_size") and value
+    }
+    return FlashPlan(_check_segments(segments), settings)
+
+
+def resolve_flash_plan(config: Dict, firmware_path: str, read_flash=None) -> FlashPlan:
+    """Work out what to write for a project and the file the operator selected
+
+    - a flasher_args.json selects every file of that ESP-IDF build
+    - a project with "segments" writes each {address, file}; "$firmware" (or a
+      missing file) is the selected firmware, relative files are resolved
+      against the selected firmware's folder
+    - otherwise the selected file goes to the project's "address"
+
+    With "partitions" the plan is checked against (and fitted to) the
+    partition table; read_flash(address, size) reads it from a connected
+    device when the image set has none.
+    """
+    plan = _resolve_segments(config, firmware_path)
+    from .partitions import PartitionSettings, plan_partitions, resolve_table
+    settings = PartitionSettings.from_config(config)
+    if settings is None:
+        return plan
+    table, source = resolve_table(plan, settings, read_flash)
+    return plan_partitions(plan, settings, table, source)
+
+
+def _resolve_segments(config: Dict, firmware_path: str) -> FlashPlan:
+    if os.path.basename(firmware_path).lower().endswith(".json"):
+        return load_flasher_args(firmware_path, config.get("chip"))
+
+    if config.get("segments"):
+        base_dir = os.path.dirname(os.path.abspath(firmware_path))
+        segments = []
+        for segment in config["segments"]:
+            file = segment.get("file") or SELECTED_FIRMWARE
+            path = firmware_path if file == SELECTED_FIRMWARE else os.path.join(base_dir, file)
+            segments.append((_parse_address(segment["address"]), path))
+        return FlashPlan(_check_segments(segments), dict(config.get("flash_settings", {})))
+
+    return FlashPlan([(_parse_address(config["address"]), firmware_path)], {})
@@ -0,0 +1,355 @@
+"""Flash job queue with automatic retries
+
+A FlashQueue holds pending flash jobs (project config, port, firmware) and
+gives every port its own worker, a task on the flash engine's event loop
+(engine.py): jobs for one port run one after another, while different ports
+flash in parallel (at most max_parallel at once). Higher priority jobs go
+first, on their port and for a free flash slot. A job
+that fails is put back on its port's queue after a backoff delay instead of
+failing the batch; it does not hold a flash slot while it waits. Jobs can be
+submitted, waited for and cancelled from any thread.
+
+Retries are set per project with "retry" (all keys optional):
+
+    "retry": {"retries": 2, "delay": 2, "backoff": 2, "max_delay": 30, "drop_baud": true}
+
+The n-th retry waits delay * backoff^(n-1) seconds, at most max_delay. A single
+failure is usually a sync or reset hiccup, so the first retry uses the same
+baud rate; with drop_baud every later retry of an esptool job runs one rate
+lower. Setup problems (missing tool, firmware that doesn't suit the chip) are
+not retried.
+"""
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from .core import (DEFAULT_GANG_CONCURRENCY, MAX_GANG_CONCURRENCY, flash_attempt, prefix_lines,
+                   release_esp_session)
+from .engine import ENGINE
+
+QUEUED = "queued"
+FLASHING = "flashing"
+RETRYING = "retrying"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class RetryPolicy(NamedTuple):
+    retries: int = 2
+    delay: float = 2.0
+    backoff: float = 2.0
+    max_delay: float = 30.0
+    drop_baud: bool = True
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "RetryPolicy":
+        """Policy from a project's "retry" object (defaults for missing keys)"""
+        settings = config.get("retry") or {}
+        unknown = set(settings) - set(cls._fields)
+        if unknown:
+            raise ValueError(f"Unknown retry setting(s): {', '.join(sorted(unknown))}")
+        policy = cls()._replace(**settings)
+        if policy.retries < 0 or policy.delay < 0 or policy.backoff < 1:
+            raise ValueError("retry needs retries >= 0, delay >= 0 and backoff >= 1")
+        return policy
+
+    def delay_for(self, retry: int) -> float:
+        """Seconds to wait before the given retry (1 = first)"""
+        return min(self.delay * self.backoff ** (retry - 1), self.max_delay)
+
+
+def lower_baud(config: Dict, port: str) -> Optional[Dict]:
+    """Config one baud rate step down, or None if it can't go lower
+
+    Only esptool jobs: an AVR bootloader listens at one fixed rate.
+    """
+    if config["tool"] != "esptool":
+        return None
+    from .baud import BAUD_CANDIDATES, effective_baud
+    baud = int(effective_baud(config, port)["baud"])
+    lower = [rate for rate in BAUD_CANDIDATES if rate < baud]
+    return dict(config, baud=str(lower[0])) if lower else None
+
+
+class FlashJob:
+    """One queued flash and its state (status, attempts, returncode)"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, config: Dict, port: str, firmware_path: str, priority: int = 0,
+                 retry: Optional[RetryPolicy] = None, observer: Optional[Callable] = None):
+        self.id = next(self._ids)
+        self.config = config
+        self.port = port
+        self.firmware_path = firmware_path
+        self.priority = priority
+        self.retry = retry or RetryPolicy.from_config(config)
+        self.status = QUEUED
+        self.attempts = 0
+        self.returncode: Optional[int] = None
+        self.not_before = 0.0
+        self.observer = observer
+        self._done = threading.Event()
+        self._callbacks: List[Callable] = []
+
+    @property
+    def order(self):
+        # Highest priority first, then first submitted
+        return (-self.priority, self.id)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the job succeeded, failed for good or was cancelled"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback: Callable):
+        """Call callback(job) once the job is finished (at once if it already is)"""
+        self._callbacks.append(callback)
+        if self.done and callback in self._callbacks:
+            self._callbacks.remove(callback)
+            callback(self)
+
+    def _set_done(self):
+        self._done.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Flash job callback failed: {e}")
+
+
+class FlashQueue:
+    """Pending flash jobs with one worker task per port
+
+    on_status(port, status, returncode) is called as a job moves through
+    "queued", "flashing", "retrying" and "done", "failed" or "cancelled";
+    on_progress(port, FlashProgress) while it writes. Both are called from
+    the engine thread (or from the thread that submits or cancels). With
+    prefix_ports every log line starts with "[port] ", to tell parallel
+    ports apart. A job's own observer(job, kind, data) additionally gets
+    ("status", status), ("log", text) and ("progress", FlashProgress) for that
+    job alone. A port's worker ends when the port has nothing left to do,
+    after releasing the port's esptool session (the board's final reset).
+    """
+
+    def __init__(self, log, max_parallel: int = DEFAULT_GANG_CONCURRENCY, on_status=None, on_progress=None,
+                 prefix_ports: bool = True):
+        self.log = log
+        self.on_status = on_status
+        self.on_progress = on_progress
+        self.prefix_ports = prefix_ports
+        self.max_parallel = max(1, min(max_parallel, MAX_GANG_CONCURRENCY))
+        # Flash slots, used on the engine thread only: when all are taken the
+        # highest priority waiting job gets the next one
+        self._running = 0
+        self._slot_waiters: List = []
+        self._pending: Dict[str, List[FlashJob]] = {}
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._unfinished: List[FlashJob] = []
+        self._workers: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, config: Dict, port: str, firmware_path: str, priority: int = 0,
+               retry: Optional[RetryPolicy] = None, delay: float = 0.0,
+               observer: Optional[Callable] = None) -> FlashJob:
+        """Queue a flash (to start no sooner than delay seconds from now)
+
+        Higher priority jobs for the same port go first.
+        """
+        job = FlashJob(config, port, firmware_path, priority, retry, observer)
+        job.not_before = time.monotonic() + delay if delay else 0.0
+        self._notify(job, QUEUED)
+        with self._lock:
+            queue = self._pending.get(port)
+            start_worker = queue is None
+            self._pending.setdefault(port, []).append(job)
+            self._unfinished.append(job)
+        if start_worker:
+            worker = ENGINE.submit(self._run_port(port))
+            with self._lock:
+                self._workers[port] = worker
+        else:
+            self._wake(port)
+        return job
+
+    def pending(self, port: Optional[str] = None) -> List[FlashJob]:
+        """Jobs waiting to run (or waiting to be retried), in the order they would run"""
+        with self._lock:
+            jobs = [job for p, queue in self._pending.items() if port in (None, p) for job in queue]
+        return sorted(jobs, key=lambda job: job.order)
+
+    def cancel(self, job: FlashJob) -> bool:
+        """Drop a job that hasn't started (or is waiting for a retry)"""
+        with self._lock:
+            queue = self._pending.get(job.port, [])
+            if job not in queue:
+                return False
+            queue.remove(job)
+        self._wake(job.port)
+        self._finish(job, CANCELLED)
+        return True
+
+    def cancel_port(self, port: str) -> int:
+        """Drop every waiting job for a port (e.g. the board was unplugged) and return how many"""
+        return sum(self.cancel(job) for job in self.pending(port))
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every submitted job has finished and every port's worker has ended
+
+        The workers end after the boards' final reset, so a process can exit
+        once join() returns.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                job = self._unfinished[0] if self._unfinished else None
+                workers = [worker for worker in self._workers.values() if not worker.done()]
+            if job is None and not workers:
+                return True
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if job is not None:
+                finished = job.wait(remaining)
+            else:
+                finished = not concurrent.futures.wait(workers, remaining).not_done
+            if not finished and deadline is not None:
+                return False
+
+    def _notify(self, job: FlashJob, status: str, returncode: Optional[int] = None):
+        job.status = status
+        if job.observer:
+            job.observer(job, "status", status)
+        if self.on_status:
+            self.on_status(job.port, status, returncode)
+
+    def _finish(self, job: FlashJob, status: str):
+        self._notify(job, status, job.returncode)
+        with self._lock:
+            if job in self._unfinished:
+                self._unfinished.remove(job)
+        job._set_done()
+
+    def _wake(self, port: str):
+        """Let the port's worker look at its queue again (thread-safe)"""
+        def wake():
+            event = self._wakeups.get(port)
+            if event:
+                event.set()
+        ENGINE.call_soon(wake)
+
+    async def _next_job(self, port: str) -> Optional[FlashJob]:
+        """Wait until a job for port is due; None (and the worker ends) once there are none"""
+        wakeup = self._wakeups.setdefault(port, asyncio.Event())
+        released = False
+        while True:
+            wakeup.clear()
+            with self._lock:
+                queue = self._pending.get(port)
+                if not queue and released:
+                    self._pending.pop(port, None)
+                    del self._wakeups[port]
+                    return None
+                if queue:
+                    now = time.monotonic()
+                    ready = [job for job in queue if job.not_before <= now]
+                    if ready:
+                        job = min(ready, key=lambda job: job.order)
+                        queue.remove(job)
+                        return job
+                    wait = min(job.not_before for job in queue) - now
+            if not queue:
+                # The port's batch is over: reset the board (see esp_session.py). Jobs
+                # submitted meanwhile still find this worker and run after the reset.
+                await ENGINE.to_thread(release_esp_session, port, self._port_log(port))
+                released = True
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _port_log(self, port: str) -> Callable:
+        return lambda text: self.log(prefix_lines(f"[{port}] ", text) if self.prefix_ports else text)
+
+    async def _acquire_slot(self, job: FlashJob):
+        if self._running < self.max_parallel and not self._slot_waiters:
+            self._running += 1
+            return
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._slot_waiters, (job.order, granted))
+        await granted
+
+    def _release_slot(self):
+        # Hand the slot straight to the next waiter, so a new arrival can't jump the queue
+        while self._slot_waiters:
+            _, granted = heapq.heappop(self._slot_waiters)
+            if not granted.done():
+                granted.set_result(None)
+                return
+        self._running -= 1
+
+    async def _run_port(self, port: str):
+        while True:
+            job = await self._next_job(port)
+            if job is None:
+                return
+            try:
+                await self._run(job)
+            except Exception as e:
+                # A status callback failed; the job still has to finish
+                print(f"Flash queue: {e}")
+                job.returncode = job.returncode or 1
+                self._finish(job, FAILED)
+
+    async def _run(self, job: FlashJob):
+        def port_log(text):
+            if job.observer:
+                job.observer(job, "log", text)
+            self.log(prefix_lines(f"[{job.port}] ", text) if self.prefix_ports else text)
+
+        def port_progress(progress):
+            if job.observer:
+                job.observer(job, "progress", progress)
+            if self.on_progress:
+                self.on_progress(job.port, progress)
+
+        job.attempts += 1
+        await self._acquire_slot(job)
+        try:
+            self._notify(job, FLASHING)
+            job.returncode, retryable = await flash_attempt(job.config, job.port, job.firmware_path,
+                                                            port_log, port_progress)
+        finally:
+            self._release_slot()
+
+        retry = job.attempts  # the retry this would be (1 = first)
+        if job.returncode != 0 and retryable and retry <= job.retry.retries:
+            delay = job.retry.delay_for(retry)
+            note = ""
+            if job.retry.drop_baud and retry > 1:
+                lowered = await ENGINE.to_thread(lower_baud, job.config, job.port)
+                if lowered:
+                    job.config = lowered
+                    note = f" at {lowered['baud']} baud"
+            port_log(f"↻ Retry {retry}/{job.retry.retries} in {delay:g} s{note}\n")
+            job.not_before = time.monotonic() + delay
+            self._notify(job, RETRYING, job.returncode)
+            with self._lock:
+                self._pending.setdefault(job.port, []).append(job)
+            return
+
+        if job.returncode == 0:
+            port_log("✅ Flash complete!\n")
+            self._finish(job, DONE)
+        else:
+            attempts = f" after {job.attempts} attempts" if job.attempts > 1 else ""
+            port_log(f"❌ Flash failed{attempts} (exit code: {job.returncode})\n")
+            self._finish(job, FAILED)
@@ -0,0 +1,184 @@
+"""Live output views for the Tk window: batched log pipeline and flash progress bar
+
+Worker threads call LogPipeline.write() and ProgressView.update() from anywhere. Text is queued and the
+Tk main loop drains the queue every LOG_FLUSH_INTERVAL_MS with a single insert,
+so the UI cost stays fixed no matter how much esptool/avrdude print. The widget
+keeps only the last LOG_SCROLLBACK_LINES lines; the complete log is written to
+a session file on disk.
+"""
+import os
+import glob
+import time
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk
+from collections import deque
+
+from .core import get_user_data_path, format_progress
+
+LOG_FLUSH_INTERVAL_MS = 100
+# Lines kept in the log window (older lines only live in the session file)
+LOG_SCROLLBACK_LINES = 5000
+# Upper bound of queued chunks handled per drain, so one tick never blocks the UI
+LOG_MAX_CHUNKS_PER_DRAIN = 2000
+# Session log files kept in the logs folder
+LOG_SESSIONS_KEPT = 20
+
+PROGRESS_REDRAW_INTERVAL_MS = 200
+# Warn the operator when a running write hasn't advanced for this long
+PROGRESS_STALL_SECONDS = 5
+
+
+def new_session_log_path() -> str:
+    """Return a fresh session log file path and prune old session logs"""
+    path = get_user_data_path("logs", time.strftime("session-%Y%m%d-%H%M%S.log"))
+    old_logs = sorted(glob.glob(os.path.join(os.path.dirname(path), "session-*.log")))
+    for old_log in old_logs[:-LOG_SESSIONS_KEPT]:
+        try:
+            os.remove(old_log)
+        except OSError:
+            pass
+    return path
+
+
+class LogPipeline:
+    """Queue between flash workers and a ScrolledText, drained in batches via after()"""
+
+    def __init__(self, widget, spill_path=None, max_lines=LOG_SCROLLBACK_LINES,
+                 interval_ms=LOG_FLUSH_INTERVAL_MS):
+        self.widget = widget
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.spill_path = spill_path
+        self._queue = queue.SimpleQueue()
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        if spill_path:
+            try:
+                self._spill_file = open(spill_path, 'a', encoding='utf-8')
+            except OSError as e:
+                print(f"Warning: Could not open log file {spill_path}: {e}")
+        self._after_id = None
+
+    def __call__(self, text: str):
+        self.write(text)
+
+    def write(self, text: str):
+        """Queue text for the log window (safe to call from any thread)"""
+        if not text:
+            return
+        self._queue.put(text)
+        with self._spill_lock:
+            if self._spill_file:
+                self._spill_file.write(text)
+
+    def start(self):
+        """Start draining the queue on the Tk main loop"""
+        if self._after_id is None:
+            self._after_id = self.widget.after(self.interval_ms, self._drain)
+
+    def stop(self):
+        """Stop draining, flush what is queued and close the session file"""
+        try:
+            if self._after_id is not None:
+                self.widget.after_cancel(self._after_id)
+            self._drain_once()
+        except tk.TclError:
+            # Window already destroyed - everything is in the session file anyway
+            pass
+        self._after_id = None
+        with self._spill_lock:
+            if self._spill_file:
+                self._spill_file.close()
+                self._spill_file = None
+
+    def _drain(self):
+        self._drain_once()
+        with self._spill_lock:
+            if self._spill_file:
+                self._spill_file.flush()
+        self._after_id = self.widget.after(self.interval_ms, self._drain)
+
+    def _drain_once(self):
+        chunks = []
+        try:
+            while len(chunks) < LOG_MAX_CHUNKS_PER_DRAIN:
+                chunks.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not chunks:
+            return
+
+        # Ring buffer: a huge burst never puts more than max_lines into the widget
+        lines = deque("".join(chunks).splitlines(keepends=True), maxlen=self.max_lines)
+        self.widget.insert("end", "".join(lines))
+
+        line_count = int(self.widget.index("end-1c").split(".")[0])
+        if line_count > self.max_lines:
+            self.widget.delete("1.0", f"{line_count - self.max_lines + 1}.0")
+        self.widget.see("end")
+
+
+class ProgressView:
+    """Progress bar with throughput/ETA label, fed from worker threads and redrawn by the main loop"""
+
+    def __init__(self, parent, interval_ms=PROGRESS_REDRAW_INTERVAL_MS):
+        self.frame = tk.Frame(parent)
+        self.bar = ttk.Progressbar(self.frame, mode="determinate", maximum=100)
+        self.bar.pack(fill="x")
+        self.label = tk.Label(self.frame, text="", anchor="w")
+        self.label.pack(fill="x")
+        self.interval_ms = interval_ms
+        self._lock = threading.Lock()
+        self._latest = None
+        self._last_change = None
+        self._result = None
+        self._shown = None
+        self.frame.after(self.interval_ms, self._redraw)
+
+    def begin(self):
+        """Reset for a new flash (call from the main thread)"""
+        with self._lock:
+            self._latest = None
+            self._last_change = time.monotonic()
+            self._result = None
+            self._shown = None
+        self.bar["value"] = 0
+        self.label.config(text="Connecting...", fg="black")
+
+    def update(self, progress):
+        """Record the latest FlashProgress (safe to call from any thread)"""
+        with self._lock:
+            self._latest = progress
+            self._last_change = time.monotonic()
+
+    def end(self, success: bool):
+        """Mark the flash as finished (safe to call from any thread)"""
+        with self._lock:
+            self._result = success
+            self._last_change = None
+
+    def _redraw(self):
+        with self._lock:
+            latest, last_change, result = self._latest, self._last_change, self._result
+        state = (latest, result)
+        if result is not None and state != self._shown:
+            if result:
+                self.bar["value"] = 100
+                self.label.config(text="✅ Done", fg="green")
+            else:
+                self.label.config(text="❌ Failed", fg="red")
+        elif latest is not None and state != self._shown:
+            self.bar["value"] = latest.percent
+            self.label.config(text=format_progress(latest), fg="black")
+        elif latest is not None and last_change is not None:
+            # Only a transfer that has started can stall (avrdude never reports progress)
+            stalled = time.monotonic() - last_change
+            if stalled >= PROGRESS_STALL_SECONDS:
+                self.label.config(
+                    text=f"⚠ No progress for {stalled:.0f} s - check cable, port and boot mode",
+                    fg="red"
+                )
+        self._shown = state
+        self.frame.after(self.interval_ms, self._redraw)
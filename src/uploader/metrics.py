@@ -0,0 +1,420 @@
+"""Per-phase flash metrics, exported as JSON lines and a Prometheus textfile
+
+flash_job() records a FlashJobMetrics for every flash: how long each phase
+took, bytes written, throughput, retries, the USB adapter (VID:PID) of the
+port, the device (MAC, else USB serial number) and whether verification
+passed. Phases are split on the tool's own output lines (esptool and avrdude
+print a line as each phase starts), so the CLI, direct and session paths are
+measured the same way. Code that knows better (the built-in STK500 programmer,
+the session runner) marks phases itself through current_job().
+
+Phases: startup (tool process start), port_open, sync, stub, setup (baud
+change and flash detection), backup (reading flash before a flash, see
+backup.py), erase, write, verify, reset.
+
+Every job is appended to flash_metrics.jsonl in the user data folder, and
+the totals so far are rewritten to a Prometheus textfile (metrics.prom in the
+user data folder, or the path in FW_METRICS_TEXTFILE, e.g. node_exporter's
+textfile collector directory). The GUI, CLI and daemon all write the same
+textfile, so the totals are counted from the JSON lines history (including
+other processes' jobs) rather than from this process's jobs alone.
+"""
+import os
+import re
+import json
+import time
+import socket
+import threading
+import contextlib
+import contextvars
+from typing import Dict, List, Optional, Pattern, Tuple
+
+JSONL_NAME = "flash_metrics.jsonl"
+TEXTFILE_NAME = "metrics.prom"
+TEXTFILE_ENV = "FW_METRICS_TEXTFILE"
+# The JSON lines file is rotated to .1 when it grows past this
+MAX_JSONL_BYTES = 10 * 1024 * 1024
+METRIC_PREFIX = "firmware_uploader"
+
+PHASES = ("startup", "port_open", "sync", "stub", "setup", "backup", "erase", "write", "verify", "reset")
+
+# (output line pattern, phase that starts there); None ends the current phase
+ESPTOOL_MARKERS: List[Tuple[Pattern, Optional[str]]] = [
+    (re.compile(r"^Serial port "), "port_open"),
+    (re.compile(r"^Connecting"), "sync"),
+    (re.compile(r"^Uploading stub"), "stub"),
+    (re.compile(r"^(Changing baud rate|Configuring flash size)"), "setup"),
+    # The flasher stub erases while it writes, so only the ROM loader (and
+    # erase-flash) has a separate erase phase; it ends with the first written block
+    (re.compile(r"^Erasing flash"), "erase"),
+    (re.compile(r"^(Flash will be erased|Compressed \d+ bytes|Writing at )"), "write"),
+    (re.compile(r"^(Wrote \d+ bytes|Verifying written data)"), "verify"),
+    (re.compile(r"^Hash of data verified"), None),
+    (re.compile(r"^(Leaving|Hard resetting|Soft resetting|Staying in)"), "reset"),
+]
+AVRDUDE_MARKERS: List[Tuple[Pattern, Optional[str]]] = [
+    (re.compile(r"AVR device initialized"), "sync"),
+    (re.compile(r"erasing chip"), "erase"),
+    (re.compile(r"writing (flash|\d+ bytes flash)"), "write"),
+    (re.compile(r"verifying flash memory"), "verify"),
+    (re.compile(r"bytes of flash verified"), "reset"),
+]
+TOOL_MARKERS = {"esptool": ESPTOOL_MARKERS, "avrdude": AVRDUDE_MARKERS}
+BYTES_WRITTEN_RE = re.compile(r"^(?:Wrote (\d+) bytes|avrdude: (\d+) bytes of flash written)")
+VERIFY_OK_RE = re.compile(r"^(Hash of data verified|avrdude: \d+ bytes of flash verified)")
+VERIFY_FAILED_RE = re.compile(r"MD5 of file does not match|verification error|Verify failed")
+RETRY_RE = re.compile(r"Lost connection, retrying|avrdude: stk500_recv\(\): programmer is not responding")
+
+
+class FlashJobMetrics:
+    """Timings and counters of one flash job
+
+    Phases run one after another: mark() ends the running phase and starts
+    the next. A phase that happens several times (one erase per segment) adds up.
+    """
+
+    def __init__(self, config: Dict, port: str, firmware_path: str,
+                 adapter: Optional[str] = None, serial_number: Optional[str] = None):
+        self.tool = config.get("tool", "")
+        self.chip = config.get("chip", "")
+        self.baud = str(config.get("baud", ""))
+        self.port = port
+        self.firmware = os.path.basename(firmware_path or "")
+        self.adapter = adapter
+        # USB serial number, replaced by the MAC when the chip reports one
+        self.device = serial_number
+        self.verify = config.get("verify")
+        try:
+            from .core import verify_policy
+            self.verify = verify_policy(config)
+        except (ValueError, KeyError):
+            pass
+        self.verified: Optional[bool] = None
+        self.started_at = time.time()
+        self.phases: Dict[str, float] = {}
+        self.bytes_written = 0
+        self.retries = 0
+        self.returncode: Optional[int] = None
+        self.error: Optional[str] = None
+        self.seconds = 0.0
+        self._markers = TOOL_MARKERS.get(self.tool, [])
+        self._started = time.perf_counter()
+        self._phase: Optional[str] = None
+        self._phase_started = self._started
+        self.mark("startup")
+
+    def mark(self, phase: Optional[str]):
+        """End the running phase and start phase (None: nothing runs until the next mark)"""
+        now = time.perf_counter()
+        if self._phase:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._phase_started
+        self._phase = phase
+        self._phase_started = now
+
+    def count_retry(self):
+        self.retries += 1
+
+    def set_device(self, device_id: str):
+        self.device = device_id
+
+    def set_verified(self, ok: bool):
+        """Record a verification result; one failed check fails the job's verification"""
+        self.verified = ok if self.verified is None else (self.verified and ok)
+
+    def feed(self, text: str):
+        """Split phases and count written bytes from tool output"""
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            for pattern, phase in self._markers:
+                if pattern.search(line):
+                    if phase != self._phase:
+                        self.mark(phase)
+                    break
+            match = BYTES_WRITTEN_RE.search(line)
+            if match:
+                self.bytes_written += int(match.group(1) or match.group(2))
+            elif RETRY_RE.search(line):
+                self.count_retry()
+            if VERIFY_OK_RE.search(line):
+                self.set_verified(True)
+            elif VERIFY_FAILED_RE.search(line):
+                self.set_verified(False)
+
+    def wrap_log(self, log):
+        """A log callable that also feeds this job"""
+        def job_log(text):
+            self.feed(text)
+            log(text)
+        return job_log
+
+    def finish(self, returncode: int, error: Optional[str] = None):
+        self.mark(None)
+        self.seconds = time.perf_counter() - self._started
+        self.returncode = returncode
+        self.error = error
+
+    def summary(self) -> str:
+        """One line for the log, e.g. Timing: 2.7 s (sync 0.1 s, stub 0.6 s, write 1.7 s) at 47.8 KB/s"""
+        phases = ", ".join(f"{name} {self.phases[name]:.1f} s" for name in PHASES
+                           if self.phases.get(name, 0.0) >= 0.05)
+        text = f"Timing: {self.seconds:.1f} s"
+        if phases:
+            text += f" ({phases})"
+        if self.bytes_written and self.seconds:
+            text += f" at {self.bytes_written / self.seconds / 1024:.1f} KB/s"
+        if self.retries:
+            text += f", {self.retries} retries"
+        return text
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    def to_record(self) -> Dict:
+        write_seconds = self.phases.get("write", 0.0)
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "host": socket.gethostname(),
+            "port": self.port,
+            "adapter": self.adapter,
+            "device": self.device,
+            "tool": self.tool,
+            "chip": self.chip,
+            "baud": self.baud,
+            "firmware": self.firmware,
+            "ok": self.ok,
+            "returncode": self.returncode,
+            "error": self.error,
+            "seconds": round(self.seconds, 3),
+            "phases": {name: round(self.phases[name], 3) for name in PHASES if name in self.phases},
+            "bytes_written": self.bytes_written,
+            "bytes_per_sec": round(self.bytes_written / self.seconds) if self.seconds else None,
+            "write_bytes_per_sec": round(self.bytes_written / write_seconds) if write_seconds else None,
+            "retries": self.retries,
+            "verify": self.verify,
+            "verified": self.verified,
+        }
+
+
+class _NoJob:
+    """Stand-in when no job is being recorded on this thread"""
+    adapter = None
+
+    def mark(self, phase):
+        pass
+
+    def count_retry(self):
+        pass
+
+    def set_device(self, device_id):
+        pass
+
+    def set_verified(self, ok):
+        pass
+
+
+_NO_JOB = _NoJob()
+# A context variable rather than a thread local: flashes run as tasks on one event loop
+_current: contextvars.ContextVar = contextvars.ContextVar("flash_job", default=_NO_JOB)
+
+
+def current_job():
+    """The job being recorded in this task or thread (a no-op stand-in outside flash_job)"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(job: FlashJobMetrics):
+    """Make job the current_job() of this task (and of executor calls made from it)"""
+    token = _current.set(job)
+    try:
+        yield job
+    finally:
+        _current.reset(token)
+
+
+def adapter_id(port: str) -> Tuple[Optional[str], Optional[str]]:
+    """(VID:PID, serial number) of the USB-serial adapter behind port (None if not USB or not found)"""
+    from .core import list_port_infos
+    try:
+        for info in list_port_infos():
+            if info.device == port and info.vid is not None:
+                return f"{info.vid:04X}:{info.pid:04X}", info.serial_number
+    except Exception:
+        pass
+    return None, None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsSink:
+    """Appends job records to the JSON lines file and keeps the Prometheus textfile current"""
+
+    def __init__(self, jsonl_path: Optional[str] = None, textfile_path: Optional[str] = None):
+        self._jsonl_path = jsonl_path
+        self._textfile_path = textfile_path
+        self._lock = threading.Lock()
+        # (tool, chip, adapter) -> totals; (port) -> last job
+        self._totals: Dict[Tuple[str, str, str], Dict] = {}
+        self._last: Dict[str, Dict] = {}
+        # (inode, byte offset) up to which the JSON lines file has been counted, None before the first read
+        self._read_pos: Optional[Tuple[int, int]] = None
+
+    @property
+    def jsonl_path(self) -> str:
+        if not self._jsonl_path:
+            from .core import get_user_data_path
+            self._jsonl_path = get_user_data_path(JSONL_NAME)
+        return self._jsonl_path
+
+    @property
+    def textfile_path(self) -> str:
+        if not self._textfile_path:
+            from .core import get_user_data_path
+            self._textfile_path = os.getenv(TEXTFILE_ENV) or get_user_data_path(TEXTFILE_NAME)
+        return self._textfile_path
+
+    def record(self, job: FlashJobMetrics) -> Dict:
+        record = job.to_record()
+        with self._lock:
+            try:
+                self._append(record)
+                self._catch_up()
+                self._write_textfile()
+            except OSError as e:
+                print(f"Could not write flash metrics: {e}")
+        return record
+
+    def _catch_up(self):
+        """Count the jobs appended since the last read, by any process (the whole history on the first call)"""
+        path = self.jsonl_path
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return
+        if self._read_pos is None:
+            self._read_file(path + ".1", 0)
+            offset = 0
+        else:
+            last_inode, offset = self._read_pos
+            if inode != last_inode:
+                # Rotated: the rest of the old file is .1 now
+                self._read_file(path + ".1", offset)
+                offset = 0
+        self._read_pos = (inode, self._read_file(path, offset))
+
+    def _read_file(self, path: str, offset: int) -> int:
+        """Add the records of path from offset on; returns the offset after the last complete line"""
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return offset
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                finished = time.mktime(time.strptime(record["time"], "%Y-%m-%dT%H:%M:%S")) + record["seconds"]
+                self._add(record, finished)
+            except (ValueError, KeyError, TypeError):
+                continue
+        return offset + end
+
+    def _add(self, record: Dict, finished: Optional[float] = None):
+        key = (record["tool"], record["chip"], record["adapter"] or "unknown")
+        totals = self._totals.setdefault(key, {
+            "ok": 0, "failed": 0, "bytes": 0, "retries": 0, "seconds": 0.0, "phases": {},
+            "verify_passed": 0, "verify_failed": 0,
+        })
+        totals["ok" if record["ok"] else "failed"] += 1
+        totals["bytes"] += record["bytes_written"]
+        totals["retries"] += record["retries"]
+        totals["seconds"] += record["seconds"]
+        if record["verified"] is not None:
+            totals["verify_passed" if record["verified"] else "verify_failed"] += 1
+        for phase, seconds in record["phases"].items():
+            count, total = totals["phases"].get(phase, (0, 0.0))
+            totals["phases"][phase] = (count + 1, total + seconds)
+        self._last[record["port"]] = dict(record, finished=finished or time.time())
+
+    def _append(self, record: Dict):
+        path = self.jsonl_path
+        try:
+            if os.path.getsize(path) > MAX_JSONL_BYTES:
+                os.replace(path, path + ".1")
+        except OSError:
+            pass
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def _write_textfile(self):
+        p = METRIC_PREFIX
+        lines = [
+            f"# HELP {p}_flash_jobs_total Flash jobs by result",
+            f"# TYPE {p}_flash_jobs_total counter",
+        ]
+        for (tool, chip, adapter), totals in sorted(self._totals.items()):
+            for result in ("ok", "failed"):
+                lines.append(f"{p}_flash_jobs_total"
+                             f"{_labels(tool=tool, chip=chip, adapter=adapter, result=result)} {totals[result]}")
+        lines += [f"# HELP {p}_flash_verify_total Verification results",
+                  f"# TYPE {p}_flash_verify_total counter"]
+        for (tool, chip, adapter), totals in sorted(self._totals.items()):
+            for result in ("passed", "failed"):
+                lines.append(f"{p}_flash_verify_total"
+                             f"{_labels(tool=tool, chip=chip, adapter=adapter, result=result)} "
+                             f"{totals['verify_' + result]}")
+        for name, key, help_text in (
+            ("flash_bytes_written_total", "bytes", "Bytes written to flash"),
+            ("flash_retries_total", "retries", "Retries (reconnects, baud fallbacks, sync attempts)"),
+            ("flash_seconds_total", "seconds", "Time spent in flash jobs"),
+        ):
+            lines += [f"# HELP {p}_{name} {help_text}", f"# TYPE {p}_{name} counter"]
+            for (tool, chip, adapter), totals in sorted(self._totals.items()):
+                lines.append(f"{p}_{name}{_labels(tool=tool, chip=chip, adapter=adapter)} {totals[key]}")
+
+        lines += [f"# HELP {p}_flash_phase_seconds Time per flash phase",
+                  f"# TYPE {p}_flash_phase_seconds summary"]
+        for (tool, chip, adapter), totals in sorted(self._totals.items()):
+            for phase in PHASES:
+                if phase in totals["phases"]:
+                    count, total = totals["phases"][phase]
+                    labels = _labels(tool=tool, chip=chip, adapter=adapter, phase=phase)
+                    lines.append(f"{p}_flash_phase_seconds_sum{labels} {total:.3f}")
+                    lines.append(f"{p}_flash_phase_seconds_count{labels} {count}")
+
+        lines += [f"# HELP {p}_last_flash_bytes_per_second Throughput of the last flash per port",
+                  f"# TYPE {p}_last_flash_bytes_per_second gauge"]
+        for port, record in sorted(self._last.items()):
+            labels = _labels(port=port, adapter=record["adapter"] or "unknown")
+            lines.append(f"{p}_last_flash_bytes_per_second{labels} {record['bytes_per_sec'] or 0}")
+        lines += [f"# HELP {p}_last_flash_baud Baud rate of the last flash per port",
+                  f"# TYPE {p}_last_flash_baud gauge"]
+        for port, record in sorted(self._last.items()):
+            try:
+                baud = int(record["baud"])
+            except (ValueError, TypeError):
+                continue
+            lines.append(f"{p}_last_flash_baud{_labels(port=port)} {baud}")
+        lines += [f"# HELP {p}_last_flash_timestamp_seconds When the last flash per port finished",
+                  f"# TYPE {p}_last_flash_timestamp_seconds gauge"]
+        for port, record in sorted(self._last.items()):
+            lines.append(f"{p}_last_flash_timestamp_seconds{_labels(port=port)} {int(record['finished'])}")
+
+        # Written under another name and renamed, so the collector never reads half a file
+        tmp_path = self.textfile_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.textfile_path)
+
+
+METRICS = MetricsSink()
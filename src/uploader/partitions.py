@@ -0,0 +1,310 @@
+"""ESP-IDF partition tables and partition-aware flash plans
+
+With "partitions" in an ESP32 project, every flash plan is checked against
+the target's partition table before anything is sent:
+
+- The table comes from the image set (a segment covering the table offset,
+  e.g. partition-table.bin or a merged image) or, over the esptool session,
+  from the device. "table": "auto" (default) prefers the image set.
+- A segment overlapping a protected partition ("protect", default the NVS
+  partitions) is refused, unless that part of it is blank (0xFF) padding, as
+  in a merged image. Then it is split around the partition, so the device
+  keeps what it has stored there.
+- "only" limits the write to some partitions, e.g. ["app"] writes just the
+  app out of a full build, or ["app", "otadata"].
+- An image that starts at a partition must fit in it.
+- Writing the app the bootloader starts when otadata is blank (factory, else
+  ota_0) also erases otadata, so the board doesn't keep booting an older OTA
+  slot ("reset_otadata": false keeps it).
+
+    "partitions": {"table": "auto", "protect": ["nvs", "nvs_keys"], "only": ["app"], "offset": "0x8000"}
+
+"partitions": true uses the defaults. Names in "protect" and "only" match a
+partition's name, type (app, data) or subtype (nvs, otadata, ota_0, ...);
+"bootloader" and "partition_table" stand for the areas before and at the
+table. Split pieces and erase blocks are written to small files in the user
+data folder (slices/), so every esptool path can flash them.
+"""
+import os
+import time
+import struct
+import hashlib
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .core import get_user_data_path
+from .images import FlashPlan, mapped_file
+
+DEFAULT_TABLE_OFFSET = 0x8000
+ENTRY_SIZE = 32
+# The table (and its MD5 entry) fits in 0xC00 bytes of its 4 KB sector
+MAX_TABLE_SIZE = 0xC00
+TABLE_SECTOR_SIZE = 0x1000
+ENTRY_MAGIC = b"\xaa\x50"
+MD5_MAGIC = b"\xeb\xeb"
+TABLE_SOURCES = ("auto", "image", "device")
+DEFAULT_PROTECTED = ("nvs", "nvs_keys")
+
+SLICE_DIR = "slices"
+# Slices unused for this long are removed when new ones are written
+SLICE_MAX_AGE = 7 * 24 * 3600
+
+TYPE_APP = 0x00
+TYPE_DATA = 0x01
+TYPE_NAMES = {TYPE_APP: "app", TYPE_DATA: "data", 0x02: "bootloader", 0x03: "partition_table"}
+SUBTYPE_NAMES = {
+    (TYPE_APP, 0x00): "factory", (TYPE_APP, 0x20): "test",
+    (TYPE_DATA, 0x00): "otadata", (TYPE_DATA, 0x01): "phy", (TYPE_DATA, 0x02): "nvs",
+    (TYPE_DATA, 0x03): "coredump", (TYPE_DATA, 0x04): "nvs_keys", (TYPE_DATA, 0x05): "efuse",
+    (TYPE_DATA, 0x06): "undefined", (TYPE_DATA, 0x80): "esphttpd", (TYPE_DATA, 0x81): "fat",
+    (TYPE_DATA, 0x82): "spiffs", (TYPE_DATA, 0x83): "littlefs",
+}
+OTA_SUBTYPES = range(0x10, 0x20)
+_BLANK = b"\xff" * 65536
+
+
+class Partition(NamedTuple):
+    name: str
+    type: int
+    subtype: int
+    offset: int
+    size: int
+    flags: int = 0
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+    @property
+    def type_name(self) -> str:
+        return TYPE_NAMES.get(self.type, f"{self.type:#x}")
+
+    @property
+    def subtype_name(self) -> str:
+        if self.type == TYPE_APP and self.subtype in OTA_SUBTYPES:
+            return f"ota_{self.subtype - OTA_SUBTYPES.start}"
+        return SUBTYPE_NAMES.get((self.type, self.subtype), f"{self.subtype:#x}")
+
+    def matches(self, names) -> bool:
+        return bool({self.name, self.type_name, self.subtype_name} & set(names))
+
+    def describe(self) -> str:
+        """e.g. nvs (data/nvs) 0x9000-0xefff"""
+        return f"{self.name} ({self.type_name}/{self.subtype_name}) {self.offset:#x}-{self.end - 1:#x}"
+
+
+def parse_partition_table(data) -> List[Partition]:
+    """Partitions of a binary ESP-IDF partition table, sorted by offset
+
+    Raises ValueError for data that isn't a table, a wrong MD5 entry or
+    overlapping partitions.
+    """
+    partitions = []
+    for position in range(0, min(len(data), MAX_TABLE_SIZE) - ENTRY_SIZE + 1, ENTRY_SIZE):
+        entry = bytes(data[position:position + ENTRY_SIZE])
+        magic = entry[:2]
+        if magic == b"\xff\xff":
+            break
+        if magic == MD5_MAGIC:
+            if entry[16:] != hashlib.md5(data[:position]).digest():
+                raise ValueError("Partition table MD5 mismatch")
+            continue
+        if magic != ENTRY_MAGIC:
+            raise ValueError(f"Not a partition table (bad entry at {position:#x})")
+        _, ptype, subtype, offset, size, name, flags = struct.unpack("<2sBBII16sI", entry)
+        partitions.append(Partition(name.split(b"\0", 1)[0].decode("ascii", "replace"),
+                                    ptype, subtype, offset, size, flags))
+    if not partitions:
+        raise ValueError("Partition table is empty")
+
+    partitions.sort(key=lambda partition: partition.offset)
+    for previous, partition in zip(partitions, partitions[1:]):
+        if partition.offset < previous.end:
+            raise ValueError(f"Partition {partition.name} overlaps {previous.name}")
+    return partitions
+
+
+class PartitionSettings(NamedTuple):
+    table: str = "auto"
+    offset: int = DEFAULT_TABLE_OFFSET
+    protect: Tuple[str, ...] = DEFAULT_PROTECTED
+    only: Tuple[str, ...] = ()
+    reset_otadata: bool = True
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["PartitionSettings"]:
+        """Settings from a project's "partitions" (None when it has none)"""
+        value = config.get("partitions")
+        if not value:
+            return None
+        settings = {} if value is True else dict(value)
+        unknown = set(settings) - set(cls._fields)
+        if unknown:
+            raise ValueError(f"Unknown partitions setting(s): {', '.join(sorted(unknown))}")
+        if "offset" in settings:
+            settings["offset"] = int(str(settings["offset"]), 0)
+        for key in ("protect", "only"):
+            if key in settings:
+                settings[key] = tuple(settings[key])
+        result = cls()._replace(**settings)
+        if result.table not in TABLE_SOURCES:
+            raise ValueError(f"partitions \"table\" must be one of: {', '.join(TABLE_SOURCES)}")
+        return result
+
+
+# ─────────────────────────────
+# FINDING THE TABLE
+# ─────────────────────────────
+def table_from_plan(plan: FlashPlan, offset: int = DEFAULT_TABLE_OFFSET) -> Optional[List[Partition]]:
+    """The partition table the image set writes, or None if none of its segments covers it"""
+    for address, path in plan.segments:
+        if address <= offset and offset + ENTRY_SIZE <= address + os.path.getsize(path):
+            with mapped_file(path) as view:
+                return parse_partition_table(view[offset - address:offset - address + MAX_TABLE_SIZE])
+    return None
+
+
+def resolve_table(plan: FlashPlan, settings: PartitionSettings,
+                  read_flash: Optional[Callable] = None) -> Tuple[List[Partition], str]:
+    """(partitions, "image" or "device") for a plan, as settings.table asks"""
+    if settings.table != "device":
+        table = table_from_plan(plan, settings.offset)
+        if table:
+            return table, "image"
+        if settings.table == "image":
+            raise ValueError(f"The image set has no partition table at {settings.offset:#x}")
+    if read_flash is None:
+        raise ValueError("Reading the partition table from the device needs the esptool session; "
+                         "add partition-table.bin to the image set instead")
+    return parse_partition_table(read_flash(settings.offset, MAX_TABLE_SIZE)), "device"
+
+
+# ─────────────────────────────
+# PLANNING
+# ─────────────────────────────
+def _areas(table: List[Partition], offset: int) -> List[Partition]:
+    """The table plus the bootloader and table areas (unless the table lists them)"""
+    areas = list(table)
+    if not any(partition.type == 0x02 for partition in table):
+        areas.append(Partition("bootloader", 0x02, 0x00, 0, offset))
+    if not any(partition.type == 0x03 for partition in table):
+        areas.append(Partition("partition_table", 0x03, 0x00, offset, TABLE_SECTOR_SIZE))
+    return sorted(areas, key=lambda partition: partition.offset)
+
+
+def _is_blank(view) -> bool:
+    """True if every byte is 0xFF (erased flash)"""
+    for start in range(0, len(view), len(_BLANK)):
+        chunk = view[start:start + len(_BLANK)]
+        if chunk != _BLANK[:len(chunk)]:
+            return False
+    return True
+
+
+def _slice_root() -> str:
+    return os.path.dirname(get_user_data_path(SLICE_DIR, "_"))
+
+
+def _prune_slices(root: str):
+    cutoff = time.time() - SLICE_MAX_AGE
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_slice(name: str, write) -> str:
+    """Path of a slice file, written by write(file) unless it already exists"""
+    root = _slice_root()
+    path = os.path.join(root, name)
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    _prune_slices(root)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def slice_file(path: str, start: int, end: int) -> str:
+    """A file holding bytes [start, end) of path"""
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+    def write(f):
+        with mapped_file(path) as view:
+            f.write(view[start:end])
+    return _write_slice(f"{key}_{start:x}-{end:x}.bin", write)
+
+
+def erased_file(size: int) -> str:
+    """A file of size 0xFF bytes: writing it erases that much flash"""
+    return _write_slice(f"erased_{size:x}.bin", lambda f: f.write(b"\xff" * size))
+
+
+def plan_partitions(plan: FlashPlan, settings: PartitionSettings, table: List[Partition],
+                    source: str = "image") -> FlashPlan:
+    """Fit a flash plan to a partition table: refuse, split or drop segments and reset otadata"""
+    areas = _areas(table, settings.offset)
+    notes = [f"Partition table ({source}): " + ", ".join(
+        f"{p.name}{' [protected]' if p.matches(settings.protect) else ''}" for p in table)]
+    segments = []
+    written: List[Tuple[int, int]] = []
+
+    for address, path in plan.segments:
+        name = os.path.basename(path)
+        end = address + os.path.getsize(path)
+        target = next((p for p in table if p.offset == address), None)
+        if target and end > target.end and not target.matches(settings.protect):
+            raise ValueError(f"{name} ({end - address} bytes) does not fit in partition "
+                             f"{target.name} ({target.size} bytes)")
+
+        cuts = sorted({address, end} | {edge for p in areas for edge in (p.offset, p.end) if address < edge < end})
+        kept = []
+        with mapped_file(path) as view:
+            for start, stop in zip(cuts, cuts[1:]):
+                area = next((p for p in areas if p.offset <= start < p.end), None)
+                if settings.only and not (area and area.matches(settings.only)):
+                    continue
+                if area and area.matches(settings.protect):
+                    if not _is_blank(view[start - address:stop - address]):
+                        raise ValueError(f"{name} would overwrite protected partition {area.describe()}")
+                    notes.append(f"Keeping {area.name} ({start:#x}-{stop - 1:#x}), not written")
+                    continue
+                if kept and kept[-1][1] == start:
+                    kept[-1] = (kept[-1][0], stop)
+                else:
+                    kept.append((start, stop))
+
+        if kept == [(address, end)]:
+            segments.append((address, path))
+        else:
+            if not kept:
+                notes.append(f"Skipping {name} at {address:#x}, no part of it is written")
+            for start, stop in kept:
+                segments.append((start, slice_file(path, start - address, stop - address)))
+                notes.append(f"Writing {name} {start:#x}-{stop - 1:#x}")
+        written += kept
+
+    if not segments:
+        raise ValueError("Nothing to write: no part of the image set is in the partitions listed in \"only\"")
+
+    def writes(partition: Optional[Partition]) -> bool:
+        return bool(partition) and any(start < partition.end and partition.offset < stop for start, stop in written)
+
+    otadata = next((p for p in table if p.type == TYPE_DATA and p.subtype == 0x00), None)
+    apps = [p for p in table if p.type == TYPE_APP]
+    boot_app = next((p for p in apps if p.subtype == 0x00), None) or next(
+        (p for p in apps if p.subtype == OTA_SUBTYPES.start), None)
+    if otadata and settings.reset_otadata and not writes(otadata) and not otadata.matches(settings.protect):
+        if writes(boot_app):
+            segments.append((otadata.offset, erased_file(otadata.size)))
+            notes.append(f"Erasing {otadata.name} so the board boots {boot_app.name}")
+        elif any(writes(p) for p in apps):
+            notes.append(f"⚠ The app goes to an OTA slot; {otadata.name} decides whether it boots")
+
+    return FlashPlan(sorted(segments), plan.flash_settings, tuple(notes))
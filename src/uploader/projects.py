@@ -0,0 +1,250 @@
+"""Layered project configuration with hot reload
+
+Project configs are merged from these layers, later ones overriding earlier
+ones key by key within a project:
+
+1. built-in  the generic boards in core.ADVANCED_PROJECTS (shown in advanced mode)
+2. bundled   projects_config.json shipped with the app or next to the script
+3. site      FW_UPLOADER_SITE_CONFIG, else /etc/firmware_uploader/projects_config.json
+             (%PROGRAMDATA%\\firmware_uploader\\projects_config.json on Windows)
+4. user      projects_config.json in the user data folder
+5. env       the JSON file named by FW_UPLOADER_PROJECTS
+
+A layer can change single keys of a project from an earlier layer
+({"Aircue Receiver": {"baud": "921600"}}) or remove it (null). Every merged
+project is checked against SCHEMA; one with problems is left out and the
+problems are listed in ProjectRegistry.problems, without affecting the
+others. A file that fails to parse keeps its last good contents.
+
+The result is compiled into a ProjectRegistry: read-only configs, the
+project lists and the port matching index, built once. Lookups read the
+current registry without locking. A background thread checks the files'
+modification times and swaps in a new registry when one changes, so neither
+the GUI nor a running flash ever waits for a reload. Jobs keep the config
+they were started with.
+"""
+import os
+import json
+import time
+import threading
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from .core import ADVANCED_PROJECTS, SRC_DIR, VERIFY_POLICIES, get_resource_path, get_user_data_path
+from .identity import ProjectIndex, usb_matches
+
+CONFIG_NAME = "projects_config.json"
+SITE_CONFIG_ENV = "FW_UPLOADER_SITE_CONFIG"
+PROJECTS_ENV = "FW_UPLOADER_PROJECTS"
+# Seconds between checks of the config files' modification times
+RELOAD_INTERVAL = 2.0
+
+TOOLS = ("esptool", "avrdude", "stk500")
+# Key: allowed JSON types
+SCHEMA = {
+    "chip": (str,), "tool": (str,), "baud": (str, int), "address": (str, int), "programmer": (str,),
+    "port_hint": (str,), "usb": (dict, list), "segments": (list,), "flash_settings": (dict,),
+    "connect": (str,), "reset": (str,), "session": (bool,), "incremental": (bool,), "verify": (str,),
+    "retry": (dict,), "backup": (bool,), "partitions": (bool, dict), "releases": (str, dict),
+    "raw": (bool,), "advanced": (bool,),
+}
+REQUIRED = ("chip", "tool", "baud")
+
+
+def validate_project(config: Dict) -> List[str]:
+    """Problems with a merged project config (empty if it is usable)"""
+    problems = [f"missing \"{key}\"" for key in REQUIRED if key not in config]
+    for key, value in config.items():
+        types = SCHEMA.get(key)
+        if types is None:
+            problems.append(f"unknown key \"{key}\"")
+        elif not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            problems.append(f"\"{key}\" must be {' or '.join(t.__name__ for t in types)}")
+    if problems:
+        return problems
+
+    if config["tool"] not in TOOLS:
+        problems.append(f"\"tool\" must be one of {', '.join(TOOLS)}")
+    elif config["tool"] == "esptool" and "address" not in config and "segments" not in config:
+        problems.append("esptool projects need \"address\" or \"segments\"")
+    if str(config["baud"]) != "auto" and not str(config["baud"]).isdigit():
+        problems.append("\"baud\" must be a number or \"auto\"")
+    if config.get("verify") not in (None,) + VERIFY_POLICIES:
+        problems.append(f"\"verify\" must be one of {', '.join(VERIFY_POLICIES)}")
+    try:
+        if "address" in config:
+            int(str(config["address"]), 0)
+        usb_matches(config)
+        if "releases" in config:
+            from .releases import ReleaseSource
+            ReleaseSource.from_config(config)
+    except ValueError as e:
+        problems.append(str(e))
+    return problems
+
+
+class ProjectRegistry(NamedTuple):
+    """Compiled project configs; never changed once built"""
+    projects: Mapping[str, Mapping]
+    names: Tuple[str, ...]
+    advanced_names: Tuple[str, ...]
+    index: ProjectIndex
+    sources: Tuple[Tuple[str, str, bool], ...]
+    problems: Tuple[str, ...]
+    generation: int
+
+    def project_list(self, show_advanced: bool = False) -> List[str]:
+        return list(self.names + self.advanced_names if show_advanced else self.names)
+
+
+def _bundled_path() -> Optional[str]:
+    # Bundled config first (for compiled exe), then next to the main script, then the project root
+    candidates = [
+        get_resource_path(CONFIG_NAME),
+        os.path.join(SRC_DIR, CONFIG_NAME),
+        os.path.join(os.path.dirname(SRC_DIR), CONFIG_NAME),
+    ]
+    for path in dict.fromkeys(os.path.normpath(path) for path in candidates):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _site_path() -> str:
+    if os.getenv(SITE_CONFIG_ENV):
+        return os.environ[SITE_CONFIG_ENV]
+    if os.name == 'nt':
+        return os.path.join(os.getenv("PROGRAMDATA", r"C:\ProgramData"), "firmware_uploader", CONFIG_NAME)
+    return os.path.join("/etc", "firmware_uploader", CONFIG_NAME)
+
+
+def config_layers() -> List[Tuple[str, Optional[str]]]:
+    """(layer name, file path or None) of every file layer, in merge order"""
+    return [
+        ("bundled", _bundled_path()),
+        ("site", _site_path()),
+        ("user", get_user_data_path(CONFIG_NAME)),
+        ("env", os.getenv(PROJECTS_ENV) or None),
+    ]
+
+
+def _stat(path: Optional[str]) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except (OSError, TypeError):
+        return None
+
+
+class ProjectConfig:
+    """The current ProjectRegistry, reloaded when a config file changes"""
+
+    def __init__(self):
+        self._registry: Optional[ProjectRegistry] = None
+        self._lock = threading.Lock()
+        # path -> (stat, last good contents or None, parse error or None)
+        self._files: Dict[str, Tuple] = {}
+        self._layers: List[Tuple[str, Optional[str]]] = []
+        self._generation = 0
+        self._watcher: Optional[threading.Thread] = None
+
+    @property
+    def registry(self) -> ProjectRegistry:
+        registry = self._registry
+        return registry if registry is not None else self.reload()
+
+    def _snapshot(self, layers) -> tuple:
+        return tuple((name, path, _stat(path)) for name, path in layers)
+
+    def changed(self) -> bool:
+        """Whether a config file appeared, changed or disappeared since the last load"""
+        return self._snapshot(config_layers()) != self._snapshot(self._layers) or any(
+            self._files.get(path, (None,))[0] != _stat(path) for _, path in self._layers if path
+        )
+
+    def reload(self, force: bool = False) -> ProjectRegistry:
+        """Load changed files and compile a new registry (the current one if nothing changed)"""
+        with self._lock:
+            if self._registry is not None and not force and not self.changed():
+                return self._registry
+            self._layers = config_layers()
+            merged: Dict[str, Dict] = {name: dict(config, advanced=True) for name, config in ADVANCED_PROJECTS.items()}
+            problems: List[str] = []
+            sources = [("built-in", "core.ADVANCED_PROJECTS", True)]
+
+            for layer, path in self._layers:
+                if not path:
+                    continue
+                data, error = self._read(path)
+                sources.append((layer, path, data is not None))
+                if error:
+                    problems.append(f"{layer} config {path}: {error}")
+                for name, entry in (data or {}).items():
+                    if entry is None:
+                        merged.pop(name, None)
+                    elif not isinstance(entry, dict):
+                        problems.append(f"{layer} config {path}: project {name!r} must be an object")
+                    else:
+                        # Projects from files are listed normally unless they say otherwise
+                        base = merged.get(name, {})
+                        merged[name] = dict(base, advanced=False, **entry) if "advanced" not in entry else dict(base, **entry)
+
+            projects = {}
+            for name, config in merged.items():
+                issues = validate_project(config)
+                if issues:
+                    problems.append(f"Project {name!r} skipped: {'; '.join(issues)}")
+                    continue
+                projects[name] = MappingProxyType({key: value for key, value in config.items() if key != "advanced"})
+
+            names = tuple(name for name in projects if not merged[name]["advanced"])
+            advanced_names = tuple(name for name in projects if merged[name]["advanced"])
+            # User projects come first when matching ports
+            ordered = {name: projects[name] for name in names + advanced_names}
+            self._generation += 1
+            self._registry = ProjectRegistry(
+                MappingProxyType(ordered), names, advanced_names, ProjectIndex(ordered),
+                tuple(sources), tuple(problems), self._generation,
+            )
+            return self._registry
+
+    def _read(self, path: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """(contents, error) of a layer file, the last good contents if it doesn't parse"""
+        stat = _stat(path)
+        cached = self._files.get(path)
+        if cached and cached[0] == stat:
+            return cached[1], cached[2]
+        if stat is None:
+            self._files[path] = (None, None, None)
+            return None, None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("expected an object of projects")
+            error = None
+        except (OSError, ValueError) as e:
+            data = cached[1] if cached else None
+            error = f"{e}" + (" (keeping the previous version)" if data is not None else "")
+        self._files[path] = (stat, data, error)
+        return data, error
+
+    def watch(self, interval: float = RELOAD_INTERVAL):
+        """Check the config files in the background and reload when they change"""
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), name="project-config", daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                if self.changed():
+                    self.reload()
+            except Exception as e:
+                print(f"Warning: reloading project configs failed: {e}")
+
+
+PROJECT_CONFIG = ProjectConfig()
@@ -0,0 +1,258 @@
+"""Firmware releases per project, prefetched into the firmware store
+
+A project can name where its releases are published:
+
+    "releases": "https://fw.example.com/aircue-rx/"
+    "releases": {"source": "//fileserver/firmware/aircue-rx", "version": "1.4.2"}
+
+The source is a directory or http(s) URL holding manifest.json (or the
+manifest file itself):
+
+    {"latest": "1.4.2",
+     "releases": [{"version": "1.4.2", "file": "rx-1.4.2.bin", "sha256": "..."}, ...]}
+
+File names are relative to the manifest. Without "latest" the highest final
+version is used (pre-releases such as 1.5.0-rc1 only if there is no final
+one); "version" in the project pins one. At startup every project's
+release is fetched in the background and stored in the firmware store, but
+only if its SHA-256 matches the manifest. The release last resolved for each
+source is recorded (releases.json), so flashing needs neither the network
+nor a file dialog: the image is taken from the store and hashed once more
+before it is used.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import urllib.parse
+import urllib.request
+from typing import Dict, List, NamedTuple, Optional
+
+from .core import get_user_data_path
+from .firmware_store import FIRMWARE_STORE, FirmwareInfo, FirmwareStore, check_compatible
+
+MANIFEST_NAME = "manifest.json"
+STATE_NAME = "releases.json"
+# Seconds to wait for a file server before working from the cache
+FETCH_TIMEOUT = 10.0
+
+
+class ReleaseSource(NamedTuple):
+    source: str
+    version: Optional[str]
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["ReleaseSource"]:
+        """The project's "releases" setting, None if it has none"""
+        entry = config.get("releases")
+        if not entry:
+            return None
+        if isinstance(entry, str):
+            return cls(entry, None)
+        if not isinstance(entry, dict) or not entry.get("source"):
+            raise ValueError("\"releases\" needs a source directory or URL")
+        unknown = set(entry) - {"source", "version"}
+        if unknown:
+            raise ValueError(f"Unknown releases key(s): {', '.join(sorted(unknown))}")
+        return cls(str(entry["source"]), str(entry["version"]) if entry.get("version") else None)
+
+    @property
+    def key(self) -> str:
+        return f"{self.source}#{self.version or 'latest'}"
+
+    @property
+    def is_url(self) -> bool:
+        return self.source.lower().startswith(("http://", "https://"))
+
+    def manifest_location(self) -> str:
+        if self.source.lower().endswith(".json"):
+            return self.source
+        if self.is_url:
+            return self.source.rstrip("/") + "/" + MANIFEST_NAME
+        return os.path.join(self.source, MANIFEST_NAME)
+
+
+class Release(NamedTuple):
+    version: str
+    name: str
+    location: str
+    sha256: str
+
+
+def version_key(version: str):
+    """Sort key: 1.10.0 after 1.9.2, final releases after every pre-release (1.4.2-rc1)"""
+    match = re.match(r"v?(\d+(?:\.\d+)*)(.*)", version)
+    if not match:
+        return 0, (), version
+    return 0 if match.group(2) else 1, tuple(int(part) for part in match.group(1).split(".")), match.group(2)
+
+
+def _open(location: str, is_url: bool):
+    if is_url:
+        return urllib.request.urlopen(location, timeout=FETCH_TIMEOUT)
+    return open(location, 'rb')
+
+
+def read_manifest(source: ReleaseSource) -> List[Release]:
+    """Releases listed by the source's manifest (network or share access; raises OSError/ValueError)"""
+    location = source.manifest_location()
+    with _open(location, source.is_url) as f:
+        manifest = json.loads(f.read().decode("utf-8"))
+    if isinstance(manifest, list):
+        manifest = {"releases": manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("releases", []), list):
+        raise ValueError(f"{location}: expected an object with a \"releases\" list")
+
+    releases = []
+    for entry in manifest.get("releases", []):
+        if not isinstance(entry, dict):
+            raise ValueError(f"{location}: every release must be an object")
+        if not all(entry.get(key) for key in ("version", "file", "sha256")):
+            raise ValueError(f"{location}: every release needs version, file and sha256")
+        file_name = str(entry["file"])
+        # Relative to the manifest and never outside its directory
+        parts = re.split(r"[/\\]", file_name)
+        if os.path.isabs(file_name) or file_name.startswith(("/", "\\")) or ".." in parts \
+                or urllib.parse.urlparse(file_name).scheme:
+            raise ValueError(f"{location}: release file {file_name!r} must be a path below the manifest")
+        if source.is_url:
+            file_location = urllib.parse.urljoin(location, file_name)
+        else:
+            file_location = os.path.join(os.path.dirname(location), *parts)
+        releases.append(Release(str(entry["version"]), parts[-1], file_location, str(entry["sha256"]).lower()))
+    if not releases:
+        raise ValueError(f"{location}: no releases listed")
+    latest = manifest.get("latest")
+    if latest:
+        latest = str(latest)
+        if not any(release.version == latest for release in releases):
+            raise ValueError(f"{location}: latest {latest} is not listed")
+        releases.sort(key=lambda release: release.version != latest)
+    else:
+        releases.sort(key=lambda release: version_key(release.version), reverse=True)
+    return releases
+
+
+def select_release(releases: List[Release], version: Optional[str]) -> Release:
+    """The pinned version, or the latest"""
+    if version is None:
+        return releases[0]
+    for release in releases:
+        if release.version == version:
+            return release
+    raise ValueError(f"Release {version} is not in the manifest")
+
+
+class ReleaseCache:
+    """The release last resolved for each source, with its image in the firmware store"""
+
+    def __init__(self, store: FirmwareStore = FIRMWARE_STORE, path: Optional[str] = None):
+        self.store = store
+        self._path = path
+        self._lock = threading.Lock()
+        # Bumped whenever a newly fetched release is recorded (the GUI watches it)
+        self.generation = 0
+
+    @property
+    def path(self) -> str:
+        if not self._path:
+            self._path = get_user_data_path(STATE_NAME)
+        return self._path
+
+    def _read(self) -> Dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, source: ReleaseSource, release: Release):
+        with self._lock:
+            state = self._read()
+            changed = state.get(source.key, {}).get("sha256") != release.sha256
+            state[source.key] = {"version": release.version, "name": release.name, "sha256": release.sha256,
+                                 "fetched": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, self.path)
+            if changed:
+                self.generation += 1
+
+    def cached(self, source: ReleaseSource) -> Optional[FirmwareInfo]:
+        """The recorded release's stored image, or None (no network access)"""
+        with self._lock:
+            entry = self._read().get(source.key)
+        return self.store.get(entry["sha256"]) if entry else None
+
+    def cached_version(self, source: ReleaseSource) -> Optional[str]:
+        with self._lock:
+            return self._read().get(source.key, {}).get("version")
+
+    def fetch(self, source: ReleaseSource, log) -> FirmwareInfo:
+        """Read the manifest, download the release unless it is stored already, and record it"""
+        release = select_release(read_manifest(source), source.version)
+        info = self.store.get(release.sha256)
+        if info is None:
+            log(f"Downloading release {release.version} ({release.name}) from {source.source}...\n")
+            with _open(release.location, source.is_url) as f:
+                info = self.store.add_verified(f, release.name, release.sha256)
+        self._record(source, release)
+        return info
+
+    def prefetch(self, configs: List[Dict], log):
+        """Fetch the releases of several projects, each source once; failures are logged"""
+        sources = {}
+        for config in configs:
+            try:
+                source = ReleaseSource.from_config(config)
+            except ValueError as e:
+                log(f"Warning: {e}\n")
+                continue
+            if source:
+                sources[source.key] = source
+        for source in sources.values():
+            try:
+                info = self.fetch(source, log)
+                log(f"Release {self.cached_version(source)} ready: {info.describe()}\n")
+            except (OSError, ValueError) as e:
+                cached = self.cached(source)
+                fallback = (f", using cached {self.cached_version(source)}" if cached
+                            else ", no release available offline")
+                log(f"Warning: could not fetch releases from {source.source} ({e}){fallback}\n")
+
+    def firmware_path(self, config: Dict, log) -> str:
+        """Path of the project's verified release image, fetching it first if nothing is cached"""
+        source = ReleaseSource.from_config(config)
+        if source is None:
+            raise ValueError("No firmware file selected (and the project has no \"releases\")")
+        info = self.cached(source)
+        if info is not None and file_sha256(info.path) != info.sha256:
+            log(f"Cached release {info.name} is damaged, fetching it again\n")
+            self.store.remove(info.sha256)
+            info = None
+        if info is None:
+            info = self.fetch(source, log)
+        check_compatible(info, config)
+        log(f"Release {self.cached_version(source)}: {info.describe()}\n")
+        return info.path
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+RELEASES = ReleaseCache()
+
+
+def prefetch_in_background(configs: List[Dict], log) -> threading.Thread:
+    """Start RELEASES.prefetch() on a daemon thread"""
+    thread = threading.Thread(target=RELEASES.prefetch, args=(configs, log), name="releases", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,72 @@
+"""Startup timing for --profile-startup
+
+Imported first by the entry script, so STARTED is as close to process start
+as Python code gets. Checkpoints are recorded with mark(); report() prints
+them and appends one JSON line per run to startup.jsonl in the user data
+folder, so time-to-interactive can be compared between releases.
+
+Only the standard library is imported here.
+"""
+import os
+import sys
+import json
+import time
+from typing import List, Optional, Tuple
+
+STARTED = time.perf_counter()
+PROFILE_FLAG = "--profile-startup"
+
+
+class StartupProfile:
+    """Named checkpoints in seconds since STARTED (recording is a no-op unless enabled)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.marks: List[Tuple[str, float]] = []
+
+    def mark(self, name: str):
+        if self.enabled:
+            self.marks.append((name, time.perf_counter() - STARTED))
+
+    def format(self) -> str:
+        lines = ["Startup profile:"]
+        previous = 0.0
+        for name, at in self.marks:
+            lines.append(f"  {at * 1000:8.1f} ms  (+{(at - previous) * 1000:6.1f})  {name}")
+            previous = at
+        return "\n".join(lines) + "\n"
+
+    def report(self, version: str, path: Optional[str] = None) -> Optional[str]:
+        """Print the checkpoints and append them to the history file; returns its path"""
+        if not self.enabled or not self.marks:
+            return None
+        if sys.stderr:
+            sys.stderr.write(self.format())
+
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "version": version,
+            "frozen": bool(getattr(sys, "frozen", False)),
+            "platform": sys.platform,
+            "marks_ms": {name: round(at * 1000, 1) for name, at in self.marks},
+        }
+        if path is None:
+            from .core import get_user_data_path
+            path = get_user_data_path("startup.jsonl")
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not write startup profile: {e}")
+            return None
+        return path
+
+
+PROFILE = StartupProfile()
+
+
+def enable_from_argv(argv: List[str]) -> List[str]:
+    """Turn profiling on if the flag is present and return argv without it"""
+    if PROFILE_FLAG in argv or os.getenv("FW_PROFILE_STARTUP"):
+        PROFILE.enabled = True
+    return [arg for arg in argv if arg != PROFILE_FLAG]
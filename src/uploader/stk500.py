@@ -0,0 +1,370 @@
+"""Built-in STK500v1 programmer for Arduino (optiboot) bootloaders
+
+Selected with "tool": "stk500" in a project config, as a drop-in for avrdude's
+"arduino" programmer without starting a process or parsing avrdude.conf. The
+firmware (Intel HEX or raw .bin at address 0) is parsed once into pages.
+Each page goes out as a single write holding both LOAD_ADDRESS and
+PROG_PAGE, and the next page follows as soon as STK_OK arrives, so a page
+costs one round trip instead of avrdude's two. The programmer is a
+coroutine on the flash engine (engine.py): while a port waits for the
+bootloader's answer it costs no thread.
+
+Optiboot cannot receive while it writes a page (the UART only buffers two
+bytes), so the next page is never sent before the previous one is confirmed.
+
+Optiboot has no chip erase: it erases a page as it writes it, and a page it
+isn't sent keeps the old firmware. So every page from the image's first to
+its last non-blank page is written, blank (0xFF) ones and gaps included.
+Flash before and after that range keeps its earlier contents; the new
+firmware doesn't use it and verification doesn't read it.
+
+The bootloader has no checksum command, so verification reads flash back:
+"verify": "full" reads every written page, "hash" reads a checksum region
+(the first and last written page and every HASH_SAMPLE_STRIDE-th one) and
+compares its CRC-32, "none" skips the read-back.
+"""
+import time
+import zlib
+import asyncio
+from typing import Dict, List, NamedTuple, Tuple
+
+from .core import FlashProgress, VERIFY_FULL, VERIFY_NONE, verify_policy
+from .engine import AsyncSerial
+from .metrics import current_job
+
+STK_OK = 0x10
+STK_INSYNC = 0x14
+STK_NOSYNC = 0x15
+CRC_EOP = 0x20
+STK_GET_SYNC = 0x30
+STK_ENTER_PROGMODE = 0x50
+STK_LEAVE_PROGMODE = 0x51
+STK_LOAD_ADDRESS = 0x55
+STK_PROG_PAGE = 0x64
+STK_READ_PAGE = 0x74
+STK_READ_SIGN = 0x75
+MEMTYPE_FLASH = ord("F")
+
+SYNC_ATTEMPTS = 10
+# Optiboot waits ~1 s for the first command after reset
+SYNC_TIMEOUT = 0.2
+# A page erase + write takes ~9 ms on the chip; allow for slow USB-serial adapters
+REPLY_TIMEOUT = 1.0
+# "verify": "hash" reads back every n-th written page (plus the first and last)
+HASH_SAMPLE_STRIDE = 8
+
+
+class AvrPart(NamedTuple):
+    signature: bytes
+    flash_size: int
+    page_size: int
+
+
+# Parts with STK500v1 (optiboot) bootloaders, by their avrdude names
+AVR_PARTS = {
+    "atmega328p": AvrPart(b"\x1e\x95\x0f", 32 * 1024, 128),
+    "atmega328pb": AvrPart(b"\x1e\x95\x16", 32 * 1024, 128),
+    "atmega328": AvrPart(b"\x1e\x95\x14", 32 * 1024, 128),
+    "atmega168p": AvrPart(b"\x1e\x94\x0b", 16 * 1024, 128),
+    "atmega168": AvrPart(b"\x1e\x94\x06", 16 * 1024, 128),
+    "atmega1284p": AvrPart(b"\x1e\x97\x05", 128 * 1024, 256),
+}
+AVR_PART_ALIASES = {"m328p": "atmega328p", "m328pb": "atmega328pb", "m328": "atmega328",
+                    "m168p": "atmega168p", "m168": "atmega168", "m1284p": "atmega1284p"}
+
+
+class Stk500Error(IOError):
+    """The bootloader did not answer or answered out of sync"""
+
+
+def get_part(chip: str) -> AvrPart:
+    name = AVR_PART_ALIASES.get(chip.lower(), chip.lower())
+    if name not in AVR_PARTS:
+        raise ValueError(f"Chip {chip!r} is not supported by the built-in programmer (use avrdude)")
+    return AVR_PARTS[name]
+
+
+# ─────────────────────────────
+# FIRMWARE IMAGES
+# ─────────────────────────────
+def parse_intel_hex(text: str) -> List[Tuple[int, bytearray]]:
+    """Parse Intel HEX into sorted (start address, data) runs of contiguous bytes
+
+    Raises ValueError on a malformed record. Where records overlap, the later
+    one wins.
+    """
+    records = []
+    base = 0
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if not line.startswith(":"):
+                raise ValueError("missing ':'")
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("bad length")
+            if sum(record) & 0xFF:
+                raise ValueError("bad checksum")
+        except ValueError as e:
+            raise ValueError(f"Invalid HEX record on line {number}: {e}") from None
+
+        length, offset, record_type = record[0], (record[1] << 8) | record[2], record[3]
+        data = record[4:4 + length]
+        if record_type == 0x00:
+            records.append((base + offset, data))
+        elif record_type == 0x01:
+            break
+        elif record_type == 0x02:
+            base = int.from_bytes(data, "big") << 4
+        elif record_type == 0x04:
+            base = int.from_bytes(data, "big") << 16
+        # 0x03/0x05 (start address) mean nothing to a bootloader
+    runs: List[Tuple[int, bytearray]] = []
+    # A stable sort keeps file order for records at the same address
+    for start, data in sorted(records, key=lambda record: record[0]):
+        if runs and start <= runs[-1][0] + len(runs[-1][1]):
+            run_start, run = runs[-1]
+            run[start - run_start:start - run_start + len(data)] = data
+        else:
+            runs.append((start, bytearray(data)))
+    return runs
+
+
+def load_image(firmware_path: str) -> List[Tuple[int, bytes]]:
+    """Read a .hex (Intel HEX) or anything else as a raw binary at address 0, as (start, data) runs"""
+    if firmware_path.lower().endswith((".hex", ".ihex", ".ihx")):
+        with open(firmware_path, 'r') as f:
+            return parse_intel_hex(f.read())
+    with open(firmware_path, 'rb') as f:
+        return [(0, f.read())]
+
+
+def image_pages(runs: List[Tuple[int, bytes]], part: AvrPart) -> List[Tuple[int, bytes]]:
+    """Split an image into (byte address, page data) pairs, padded with 0xFF
+
+    Every page from the first to the last non-blank one is included, so a blank
+    page or gap in between erases what the old firmware left there.
+    """
+    end = max((start + len(data) for start, data in runs), default=0)
+    if end > part.flash_size:
+        raise ValueError(f"Firmware ends at {end:#x}, beyond the {part.flash_size // 1024} KB flash")
+    pages = {}
+    for start, data in runs:
+        view = memoryview(data)
+        position, run_end = start, start + len(data)
+        while position < run_end:
+            page_start = position - position % part.page_size
+            chunk_end = min(page_start + part.page_size, run_end)
+            page = pages.get(page_start)
+            if page is None:
+                page = pages[page_start] = bytearray(b"\xff" * part.page_size)
+            page[position - page_start:chunk_end - page_start] = view[position - start:chunk_end - start]
+            position = chunk_end
+    used = [start for start, page in pages.items() if page.count(0xFF) != len(page)]
+    if not used:
+        return []
+    blank = b"\xff" * part.page_size
+    return [(start, bytes(pages.get(start, blank)))
+            for start in range(min(used), max(used) + part.page_size, part.page_size)]
+
+
+def checksum_region(pages: List[Tuple[int, bytes]], stride: int = HASH_SAMPLE_STRIDE) -> List[Tuple[int, bytes]]:
+    """The pages read back by "verify": "hash": the first, the last and every stride-th"""
+    last = len(pages) - 1
+    return [page for idx, page in enumerate(pages) if idx % stride == 0 or idx == last]
+
+
+# ─────────────────────────────
+# PROGRAMMER
+# ─────────────────────────────
+class Stk500Programmer:
+    """One STK500v1 connection to an optiboot bootloader (create it on the event loop)"""
+
+    def __init__(self, port: str, baud: int):
+        self.serial = AsyncSerial(port, baud)
+
+    def close(self):
+        self.serial.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def reset(self) -> bool:
+        """Pulse DTR/RTS like avrdude's arduino programmer; False if the port has no modem lines"""
+        try:
+            self.serial.set_modem_lines(False, False)
+            await asyncio.sleep(0.25)
+            self.serial.set_modem_lines(True, True)
+            await asyncio.sleep(0.05)
+        except OSError:
+            return False
+        return True
+
+    async def _read(self, count: int, timeout: float = REPLY_TIMEOUT) -> bytes:
+        data = await self.serial.read(count, timeout)
+        if len(data) < count:
+            raise Stk500Error(f"No answer from bootloader (got {len(data)} of {count} bytes)")
+        return data
+
+    async def _expect_ok(self, payload_length: int = 0, timeout: float = REPLY_TIMEOUT) -> bytes:
+        reply = await self._read(payload_length + 2, timeout)
+        if reply[0] != STK_INSYNC or reply[-1] != STK_OK:
+            raise Stk500Error(f"Bootloader out of sync (reply {reply[:8].hex()})")
+        return reply[1:-1]
+
+    async def command(self, *payload: int, reply_length: int = 0) -> bytes:
+        self.serial.write(bytes(payload) + bytes([CRC_EOP]))
+        return await self._expect_ok(reply_length)
+
+    async def sync(self, attempts: int = SYNC_ATTEMPTS):
+        for _ in range(attempts):
+            self.serial.reset_input_buffer()
+            self.serial.write(bytes([STK_GET_SYNC, CRC_EOP]))
+            try:
+                await self._expect_ok(timeout=SYNC_TIMEOUT)
+            except Stk500Error:
+                current_job().count_retry()
+                continue
+            # Answers to earlier attempts may still be in flight
+            await asyncio.sleep(0.01)
+            self.serial.reset_input_buffer()
+            return
+        raise Stk500Error(f"Bootloader did not answer sync after {attempts} attempts")
+
+    async def read_signature(self) -> bytes:
+        return await self.command(STK_READ_SIGN, reply_length=3)
+
+    async def enter_progmode(self):
+        await self.command(STK_ENTER_PROGMODE)
+
+    async def leave_progmode(self):
+        """Leaving programming mode starts the application"""
+        await self.command(STK_LEAVE_PROGMODE)
+
+    @staticmethod
+    def _load_address(address: int) -> bytes:
+        # Flash is addressed in 16-bit words
+        word = address >> 1
+        return bytes([STK_LOAD_ADDRESS, word & 0xFF, (word >> 8) & 0xFF, CRC_EOP])
+
+    async def write_page(self, address: int, data: bytes):
+        """LOAD_ADDRESS and PROG_PAGE in one write; both replies are read together"""
+        self.serial.write(
+            self._load_address(address)
+            + bytes([STK_PROG_PAGE, len(data) >> 8, len(data) & 0xFF, MEMTYPE_FLASH])
+            + data + bytes([CRC_EOP])
+        )
+        await self._expect_ok()
+        await self._expect_ok()
+
+    async def read_page(self, address: int, length: int) -> bytes:
+        self.serial.write(
+            self._load_address(address)
+            + bytes([STK_READ_PAGE, length >> 8, length & 0xFF, MEMTYPE_FLASH, CRC_EOP])
+        )
+        await self._expect_ok()
+        return await self._expect_ok(length)
+
+
+class _PageProgress:
+    """FlashProgress updates per written page, in whole-percent steps"""
+
+    def __init__(self, total_bytes: int, on_progress):
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.bytes_done = 0
+        self._started = time.monotonic()
+        self._last_percent = -1
+
+    def add(self, nbytes: int):
+        self.bytes_done += nbytes
+        if not self.on_progress:
+            return
+        percent = 100.0 * self.bytes_done / self.total_bytes if self.total_bytes else 100.0
+        if int(percent) == self._last_percent and percent < 100:
+            return
+        self._last_percent = int(percent)
+        elapsed = time.monotonic() - self._started
+        bytes_per_sec = self.bytes_done / elapsed if elapsed > 0 else 0.0
+        eta_seconds = (self.total_bytes - self.bytes_done) / bytes_per_sec if bytes_per_sec else None
+        self.on_progress(FlashProgress(percent, self.bytes_done, self.total_bytes, bytes_per_sec, eta_seconds))
+
+
+async def _verify_pages(programmer: Stk500Programmer, pages: List[Tuple[int, bytes]], policy: str, log) -> bool:
+    if policy == VERIFY_FULL:
+        for address, data in pages:
+            if await programmer.read_page(address, len(data)) != data:
+                log(f"\n❌ Verify failed: flash page at {address:#06x} differs from the firmware\n")
+                return False
+        log(f"Verified {sum(len(data) for _, data in pages)} bytes\n")
+        return True
+
+    region = checksum_region(pages)
+    expected = actual = 0
+    for address, data in region:
+        expected = zlib.crc32(data, expected)
+        actual = zlib.crc32(await programmer.read_page(address, len(data)), actual)
+    if actual != expected:
+        log(f"\n❌ Verify failed: checksum region CRC {actual:08x}, expected {expected:08x}\n")
+        return False
+    log(f"Verified checksum region ({len(region)} of {len(pages)} pages, CRC {expected:08x})\n")
+    return True
+
+
+async def run_stk500(config: Dict, port: str, firmware_path: str, log, on_progress=None) -> int:
+    """Flash an optiboot board: reset, sync, check signature, write pages, verify, start the app
+
+    Raises ValueError for a chip, firmware or verify policy that won't work, so
+    the job queue doesn't retry it; serial problems are logged and return 1.
+    """
+    policy = verify_policy(config)
+    part = get_part(config["chip"])
+    pages = image_pages(load_image(firmware_path), part)
+    total = sum(len(data) for _, data in pages)
+    log(f"{len(pages)} pages ({total} bytes) to write\n")
+
+    try:
+        job = current_job()
+        job.mark("port_open")
+        with Stk500Programmer(port, int(config["baud"])) as programmer:
+            if not await programmer.reset():
+                log("No DTR/RTS on this port, assuming the bootloader is already running\n")
+            job.mark("sync")
+            await programmer.sync()
+            signature = await programmer.read_signature()
+            if signature != part.signature:
+                log(f"\n❌ Device signature {signature.hex()} does not match "
+                    f"{config['chip']} ({part.signature.hex()})\n")
+                return 1
+            log(f"Device signature: {signature.hex()}\n")
+            await programmer.enter_progmode()
+
+            job.mark("write")
+            started = time.monotonic()
+            progress = _PageProgress(total, on_progress)
+            for address, data in pages:
+                await programmer.write_page(address, data)
+                progress.add(len(data))
+            elapsed = time.monotonic() - started
+            log(f"Wrote {total} bytes in {elapsed:.2f} s ({total / elapsed / 1024 if elapsed else 0:.1f} KB/s)\n")
+
+            if policy != VERIFY_NONE:
+                job.mark("verify")
+                if not await _verify_pages(programmer, pages, policy, log):
+                    job.set_verified(False)
+                    return 1
+                job.set_verified(True)
+            job.mark("reset")
+            await programmer.leave_progmode()
+        return 0
+    except Stk500Error as e:
+        log(f"\n❌ {e}\n"
+            "Check the port and baud rate (Uno 115200, Nano 57600 or 115200 with the new bootloader).\n")
+    except OSError as e:
+        log(f"\n❌ {e}\n")
+    return 1
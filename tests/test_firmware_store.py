@@ -0,0 +1,121 @@
+import struct
+
+import pytest
+
+from uploader.firmware_store import (ESP_APP_DESC_MAGIC, ESP_APP_OFFSET, FirmwareStore, check_compatible,
+                                     parse_esp_image)
+
+# Image header chip IDs
+ESP32, ESP32S3, ESP32C3 = 0, 9, 5
+
+
+def app_desc(version="1.4.2", project="rx", idf="v5.2") -> bytes:
+    """esp_app_desc_t: magic, secure_version, 2 reserved words, version, project_name, time, date, idf_ver"""
+    desc = struct.pack("<II8x32s32s16s16s32s", ESP_APP_DESC_MAGIC, 0, version.encode(), project.encode(),
+                       b"12:00:00", b"Oct 17 2026", idf.encode())
+    return desc + b"\0" * (256 - len(desc))
+
+
+def esp_image(chip_id=ESP32, segments=(b"\x11" * 64,)) -> bytes:
+    # 8 byte header, 16 byte extended header with the chip ID at byte 12
+    data = struct.pack("<BBBBI", 0xE9, len(segments), 2, 0x20, 0x40080000)
+    data += struct.pack("<B3sH10x", 0xEE, b"\0\0\0", chip_id)
+    for idx, segment in enumerate(segments):
+        data += struct.pack("<II", 0x3F400020 + idx * 0x1000, len(segment)) + segment
+    return data
+
+
+def app_image(chip_id=ESP32, **desc) -> bytes:
+    return esp_image(chip_id, (app_desc(**desc), b"\x22" * 128))
+
+
+def merged(bootloader_offset=0x1000, chip_id=ESP32, app=None) -> bytes:
+    data = bytearray(b"\xff" * ESP_APP_OFFSET)
+    bootloader = esp_image(chip_id)
+    data[bootloader_offset:bootloader_offset + len(bootloader)] = bootloader
+    return bytes(data) + (app if app is not None else app_image(chip_id))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FirmwareStore(str(tmp_path / "store"))
+
+
+def add(store, tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return store.add(str(path))
+
+
+def test_header_chip_and_segments():
+    image = parse_esp_image(esp_image(ESP32C3, (b"\x11" * 64, b"\x22" * 32)))
+    assert image == {"chip": "esp32c3", "segments": [(0x3F400020, 64), (0x3F401020, 32)], "app": None}
+
+
+def test_app_descriptor_is_read_from_the_first_segment():
+    image = parse_esp_image(app_image(ESP32S3, version="2.0.1", project="sensor", idf="v5.3.1"))
+    assert image["chip"] == "esp32s3"
+    assert image["app"] == {"version": "2.0.1", "project_name": "sensor", "idf_version": "v5.3.1"}
+
+
+@pytest.mark.parametrize("data", [
+    b"\xe9" + b"\0" * 10,                            # shorter than a header
+    esp_image(segments=(b"\x11" * 64,))[:-1],       # segment runs past the end
+    b"\xe9\x00" + esp_image()[2:],                  # no segments
+    b"\xe9\x20" + esp_image()[2:],                  # more segments than an image has
+    b"\x00" + esp_image()[1:],                      # no magic byte
+])
+def test_data_that_is_not_an_image(data):
+    assert parse_esp_image(data) is None
+
+
+def test_app_image_metadata(store, tmp_path):
+    info = add(store, tmp_path, "app.bin", app_image(ESP32C3))
+    assert (info.kind, info.chip, info.version, info.project_name, info.idf_version) == \
+        ("esp-app", "esp32c3", "1.4.2", "rx", "v5.2")
+    assert len(info.segments) == 2
+
+
+@pytest.mark.parametrize("offset, chip_id, chip", [(0x1000, ESP32, "esp32"), (0x2000, 23, "esp32c5")])
+def test_merged_image_reads_the_app_at_0x10000(store, tmp_path, offset, chip_id, chip):
+    info = add(store, tmp_path, "merged.bin", merged(offset, chip_id))
+    assert (info.kind, info.chip, info.version, info.project_name) == ("esp-merged", chip, "1.4.2", "rx")
+
+
+def test_merged_image_without_an_app_keeps_the_bootloader_chip(store, tmp_path):
+    info = add(store, tmp_path, "merged.bin", merged(app=b"\xff" * 1024))
+    assert (info.kind, info.chip, info.version) == ("esp-merged", "esp32", None)
+
+
+def test_check_compatible_esp_chips(store, tmp_path):
+    info = add(store, tmp_path, "app.bin", app_image(ESP32S3))
+    check_compatible(info, {"tool": "esptool", "chip": "esp32s3"})
+    check_compatible(info, {"tool": "esptool", "chip": "auto"})
+    with pytest.raises(ValueError, match="built for esp32s3"):
+        check_compatible(info, {"tool": "esptool", "chip": "esp32"})
+    with pytest.raises(ValueError, match="is an ESP image"):
+        check_compatible(info, {"tool": "stk500", "chip": "atmega328p"})
+
+
+def test_check_compatible_raw_data(store, tmp_path):
+    info = add(store, tmp_path, "spiffs.bin", b"\x00" * 4096)
+    assert info.kind == "raw"
+    with pytest.raises(ValueError, match="not an ESP image"):
+        check_compatible(info, {"tool": "esptool", "chip": "esp32"})
+    check_compatible(info, {"tool": "esptool", "chip": "esp32", "raw": True})
+    check_compatible(info, {"tool": "avrdude", "chip": "atmega328p"})
+
+
+def test_check_compatible_esp8266_image_without_extended_header(store, tmp_path):
+    # ESP8266 images have no extended header, so they are stored as raw data
+    info = add(store, tmp_path, "esp8266.bin", b"\xe9\x01\x00\x20" + b"\xff" * 60)
+    assert info.kind == "raw"
+    check_compatible(info, {"tool": "esptool", "chip": "esp8266"})
+
+
+def test_check_compatible_intel_hex(store, tmp_path):
+    info = add(store, tmp_path, "blink.hex", b":0400000001020304F2\n:00000001FF\n")
+    assert (info.kind, info.ranges) == ("intel-hex", [(0, 4)])
+    check_compatible(info, {"tool": "stk500", "chip": "atmega328p"})
+    with pytest.raises(ValueError, match="Intel HEX"):
+        check_compatible(info, {"tool": "esptool", "chip": "esp32"})
@@ -0,0 +1,81 @@
+import pytest
+
+from uploader.core import PortInfo
+from uploader.identity import ProjectIndex, UsbMatch, port_score, usb_matches
+
+BASE = {"chip": "esp32", "tool": "esptool", "baud": "921600", "address": "0x10000"}
+
+
+def port(vid=0x1A86, pid=0x55D4, serial="A5001234", manufacturer="QinHeng", description="USB Serial") -> PortInfo:
+    return PortInfo("/dev/ttyUSB0", description, vid, pid, serial, manufacturer)
+
+
+def project(**config):
+    return dict(BASE, **config)
+
+
+def test_usb_matches_accepts_one_entry_or_a_list():
+    single = usb_matches(project(usb={"vid": "1A86", "pid": "0x55d4"}))
+    assert single == [UsbMatch(0x1A86, 0x55D4, None, None)]
+    listed = usb_matches(project(usb=[{"vid": 0x0403}, {"vid": "10C4", "pid": "EA60", "serial": "AB*"}]))
+    assert listed == [UsbMatch(0x0403, None, None, None), UsbMatch(0x10C4, 0xEA60, None, "ab*")]
+    assert usb_matches(project()) == []
+
+
+@pytest.mark.parametrize("usb", [
+    {"pid": "55D4"},
+    {"vid": "1A86", "product": "CH340"},
+    {"vid": "12345"},
+    {"vid": "xyz"},
+])
+def test_malformed_usb_entries_are_rejected(usb):
+    with pytest.raises(ValueError):
+        usb_matches(project(usb=usb))
+
+
+def test_serial_outranks_vid_pid_which_outranks_vid_alone():
+    index = ProjectIndex({
+        "any ch340": project(usb={"vid": "1A86"}),
+        "ch340 board": project(usb={"vid": "1A86", "pid": "55D4"}),
+        "bench unit": project(usb={"vid": "1A86", "pid": "55D4", "serial": "a5*"}),
+    })
+    assert [name for name, _ in index.candidates(port())] == ["bench unit", "ch340 board", "any ch340"]
+    # Another serial number drops the serial-bound project, not the others
+    assert [name for name, _ in index.candidates(port(serial="B7000001"))] == ["ch340 board", "any ch340"]
+    # A different PID only leaves the VID-only project
+    assert index.best_project(port(pid=0x7523)) == "any ch340"
+
+
+def test_manufacturer_must_match_when_given():
+    config = project(usb={"vid": "0403", "pid": "6001", "manufacturer": "FTDI"})
+    assert port_score(config, port(0x0403, 0x6001, manufacturer="ftdi")) > 0
+    assert port_score(config, port(0x0403, 0x6001, manufacturer="Clone Inc")) == 0
+
+
+def test_usb_identity_outranks_port_hint():
+    index = ProjectIndex({
+        "hinted": project(port_hint="USB Serial CH340"),
+        "usb": project(usb={"vid": "1A86", "pid": "55D4"}),
+    })
+    info = port(description="USB Serial CH340")
+    assert [name for name, _ in index.candidates(info)] == ["usb", "hinted"]
+    # Without a USB identity the hint is all there is
+    assert index.candidates(port(vid=None, pid=None, description="USB Serial CH340")) == [("hinted", 3)]
+
+
+def test_hint_alternatives_and_ties_keep_project_order():
+    index = ProjectIndex({
+        "first": project(port_hint="CH340 or FT232"),
+        "second": project(port_hint="FT232"),
+    })
+    info = port(vid=None, pid=None, description="FT232R USB UART")
+    assert index.candidates(info) == [("first", 1), ("second", 1)]
+    assert index.score("first", port(vid=None, pid=None, description="CP2102")) == 0
+
+
+def test_a_project_with_a_malformed_usb_entry_is_not_matched():
+    index = ProjectIndex({
+        "broken": project(usb={"pid": "55D4"}),
+        "ok": project(usb={"vid": "1A86"}),
+    })
+    assert index.candidates(port()) == [("ok", 10)]
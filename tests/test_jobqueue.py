@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from uploader import jobqueue
+from uploader.jobqueue import (CANCELLED, DONE, FAILED, RETRYING, FlashQueue, RetryPolicy, lower_baud)
+
+ESP = {"chip": "esp32", "tool": "esptool", "baud": "921600", "address": "0x10000"}
+AVR = {"chip": "atmega328p", "tool": "stk500", "baud": "115200"}
+FAST = RetryPolicy(retries=2, delay=0.05, backoff=2.0, max_delay=0.08)
+
+
+class FakeFlasher:
+    """Stands in for core.flash_attempt: records every attempt and fails as told"""
+
+    def __init__(self, failures=None, duration=0.0, retryable=True):
+        # (port, firmware): attempts that fail before the one that succeeds
+        self.failures = failures or {}
+        self.duration = duration
+        self.retryable = retryable
+        self.attempts = []
+        self.started = []
+        self._lock = threading.Lock()
+
+    async def __call__(self, config, port, firmware_path, log, on_progress=None):
+        with self._lock:
+            self.started.append((time.monotonic(), firmware_path))
+        if self.duration:
+            await asyncio.sleep(self.duration)
+        with self._lock:
+            self.attempts.append((port, firmware_path, config["baud"]))
+            failed = sum(1 for attempt in self.attempts if attempt[:2] == (port, firmware_path))
+        if failed <= self.failures.get((port, firmware_path), 0):
+            log("sync failed\n")
+            return 1, self.retryable
+        return 0, True
+
+
+@pytest.fixture
+def flasher(monkeypatch):
+    def install(**kwargs):
+        fake = FakeFlasher(**kwargs)
+        monkeypatch.setattr(jobqueue, "flash_attempt", fake)
+        return fake
+    return install
+
+
+def make_queue(max_parallel=4):
+    lines, statuses = [], []
+    queue = FlashQueue(lines.append, max_parallel, on_status=lambda *status: statuses.append(status))
+    return queue, lines, statuses
+
+
+# ─────────────────────────────
+# RETRY POLICY
+# ─────────────────────────────
+def test_retry_delays_back_off_up_to_max_delay():
+    policy = RetryPolicy(retries=5, delay=2, backoff=3, max_delay=10)
+    assert [policy.delay_for(retry) for retry in range(1, 5)] == [2, 6, 10, 10]
+
+
+def test_retry_policy_from_config_rejects_unknown_and_invalid_settings():
+    assert RetryPolicy.from_config({"retry": {"retries": 4}}).retries == 4
+    with pytest.raises(ValueError, match="Unknown retry"):
+        RetryPolicy.from_config({"retry": {"tries": 4}})
+    with pytest.raises(ValueError):
+        RetryPolicy.from_config({"retry": {"backoff": 0.5}})
+
+
+def test_lower_baud_steps_esptool_down_and_leaves_avr_alone():
+    assert lower_baud(ESP, "/dev/x")["baud"] == "460800"
+    assert lower_baud(dict(ESP, baud="115200"), "/dev/x") is None
+    assert lower_baud(AVR, "/dev/x") is None
+
+
+# ─────────────────────────────
+# QUEUE
+# ─────────────────────────────
+def test_failed_job_is_retried_up_to_the_limit(flasher):
+    fake = flasher(failures={("/dev/a", "fw.bin"): 10})
+    queue, lines, statuses = make_queue()
+    job = queue.submit(ESP, "/dev/a", "fw.bin", retry=FAST._replace(drop_baud=False))
+    assert job.wait(5)
+    assert job.status == FAILED and job.returncode == 1
+    assert job.attempts == 3 and len(fake.attempts) == 3
+    assert [status for _, status, _ in statuses].count(RETRYING) == 2
+    log = "".join(lines)
+    assert "Retry 1/2 in 0.05 s" in log
+    # The second delay (0.1 s) is clamped to max_delay
+    assert "Retry 2/2 in 0.08 s" in log
+    assert "Flash failed after 3 attempts" in log
+
+
+def test_retry_succeeds_and_drops_baud_from_the_second_retry(flasher):
+    fake = flasher(failures={("/dev/a", "fw.bin"): 2})
+    queue, _, _ = make_queue()
+    job = queue.submit(ESP, "/dev/a", "fw.bin", retry=FAST)
+    assert job.wait(5)
+    assert job.status == DONE and job.returncode == 0
+    # The first retry keeps the rate, every later one goes one step down
+    assert [baud for _, _, baud in fake.attempts] == ["921600", "921600", "460800"]
+
+
+def test_setup_errors_are_not_retried(flasher):
+    fake = flasher(failures={("/dev/a", "fw.bin"): 1}, retryable=False)
+    queue, _, _ = make_queue()
+    job = queue.submit(ESP, "/dev/a", "fw.bin", retry=FAST)
+    assert job.wait(5)
+    assert job.status == FAILED and len(fake.attempts) == 1
+
+
+def test_retry_waits_without_blocking_the_port(flasher):
+    fake = flasher(failures={("/dev/a", "first.bin"): 1})
+    queue, _, _ = make_queue()
+    first = queue.submit(ESP, "/dev/a", "first.bin", retry=FAST._replace(delay=0.3, max_delay=0.3))
+    time.sleep(0.1)
+    second = queue.submit(ESP, "/dev/a", "second.bin", retry=FAST)
+    assert queue.join(5)
+    assert first.status == second.status == DONE
+    assert [firmware for _, firmware, _ in fake.attempts] == ["first.bin", "second.bin", "first.bin"]
+    # The retry was put back with not_before and only started once its delay was over
+    (first_start, _), _, (retry_start, _) = fake.started
+    assert retry_start - first_start >= 0.3
+
+
+def test_submit_delay_holds_the_job_back(flasher):
+    fake = flasher()
+    queue, _, _ = make_queue()
+    submitted = time.monotonic()
+    job = queue.submit(ESP, "/dev/a", "fw.bin", delay=0.2)
+    assert job.wait(5) and job.status == DONE
+    assert fake.started[0][0] - submitted >= 0.2
+
+
+def test_free_slot_goes_to_the_highest_priority_job(flasher):
+    fake = flasher(duration=0.2)
+    queue, _, _ = make_queue(max_parallel=1)
+    queue.submit(ESP, "/dev/a", "running.bin")
+    time.sleep(0.05)
+    queue.submit(ESP, "/dev/b", "low.bin", priority=0)
+    queue.submit(ESP, "/dev/c", "high.bin", priority=5)
+    assert queue.join(5)
+    assert [firmware for _, firmware in fake.started] == ["running.bin", "high.bin", "low.bin"]
+
+
+def test_higher_priority_job_runs_first_on_its_port(flasher):
+    fake = flasher(duration=0.1)
+    queue, _, _ = make_queue()
+    queue.submit(ESP, "/dev/a", "running.bin")
+    time.sleep(0.05)
+    queue.submit(ESP, "/dev/a", "low.bin")
+    queue.submit(ESP, "/dev/a", "high.bin", priority=1)
+    assert queue.join(5)
+    assert [firmware for _, firmware, _ in fake.attempts] == ["running.bin", "high.bin", "low.bin"]
+
+
+def test_cancel_port_drops_a_pending_retry(flasher):
+    fake = flasher(failures={("/dev/a", "fw.bin"): 1})
+    queue, _, statuses = make_queue()
+    job = queue.submit(ESP, "/dev/a", "fw.bin", retry=FAST._replace(delay=0.3, max_delay=0.3))
+    deadline = time.monotonic() + 5
+    while job.status != RETRYING and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.cancel_port("/dev/a") == 1
+    assert job.wait(1) and job.status == CANCELLED
+    # The retry's delay passes without it being started again
+    time.sleep(0.5)
+    assert len(fake.attempts) == 1
+    assert statuses[-1] == ("/dev/a", CANCELLED, 1)
+    assert queue.pending() == []
+
+
+def test_join_waits_for_the_port_release(flasher, monkeypatch):
+    # Long enough for the second job to arrive while the first one runs
+    flasher(duration=0.1)
+    released = []
+
+    def release(port, log):
+        time.sleep(0.1)
+        released.append(port)
+    monkeypatch.setattr(jobqueue, "release_esp_session", release)
+    queue, _, _ = make_queue()
+    queue.submit(ESP, "/dev/join-a", "first.bin")
+    queue.submit(ESP, "/dev/join-a", "second.bin")
+    queue.submit(ESP, "/dev/join-b", "fw.bin")
+    assert queue.join(5)
+    # Once per port, after its last job (workers of earlier tests may release their own ports)
+    assert sorted(port for port in released if "join" in port) == ["/dev/join-a", "/dev/join-b"]
@@ -0,0 +1,48 @@
+from uploader.metrics import FlashJobMetrics, MetricsSink
+
+
+def job(port="/dev/ttyUSB0", baud=460800, ok=True) -> FlashJobMetrics:
+    metrics = FlashJobMetrics({"tool": "esptool", "chip": "esp32", "baud": baud}, port, "app.bin",
+                              adapter="1A86:55D4")
+    metrics.feed("Wrote 4096 bytes (100 compressed) at 0x00010000 in 0.1 seconds")
+    metrics.finish(0 if ok else 2)
+    return metrics
+
+
+def sink(tmp_path) -> MetricsSink:
+    return MetricsSink(str(tmp_path / "flash_metrics.jsonl"), str(tmp_path / "metrics.prom"))
+
+
+def sample(tmp_path, name, **labels) -> str:
+    for line in (tmp_path / "metrics.prom").read_text().splitlines():
+        if line.startswith(name + "{") and all(f'{key}="{value}"' in line for key, value in labels.items()):
+            return line.rsplit(" ", 1)[1]
+    return None
+
+
+def test_totals_include_jobs_of_other_processes(tmp_path):
+    gui, daemon = sink(tmp_path), sink(tmp_path)
+    gui.record(job())
+    daemon.record(job(port="/dev/ttyUSB1"))
+    gui.record(job(ok=False))
+    assert sample(tmp_path, "firmware_uploader_flash_jobs_total", result="ok") == "2"
+    assert sample(tmp_path, "firmware_uploader_flash_jobs_total", result="failed") == "1"
+    assert sample(tmp_path, "firmware_uploader_flash_bytes_written_total") == "12288"
+    # The daemon's port is still listed after the GUI rewrote the file
+    assert sample(tmp_path, "firmware_uploader_last_flash_timestamp_seconds", port="/dev/ttyUSB1")
+
+
+def test_totals_survive_a_restart(tmp_path):
+    sink(tmp_path).record(job())
+    sink(tmp_path).record(job())
+    assert sample(tmp_path, "firmware_uploader_flash_jobs_total", result="ok") == "2"
+
+
+def test_baud_is_a_value_not_a_label(tmp_path):
+    metrics = sink(tmp_path)
+    metrics.record(job(baud=921600))
+    metrics.record(job(baud=115200))
+    text = (tmp_path / "metrics.prom").read_text()
+    assert "baud=" not in text
+    assert text.count("firmware_uploader_last_flash_bytes_per_second{") == 1
+    assert sample(tmp_path, "firmware_uploader_last_flash_baud", port="/dev/ttyUSB0") == "115200"
@@ -0,0 +1,145 @@
+import hashlib
+import struct
+
+import pytest
+
+from uploader.images import FlashPlan
+from uploader.partitions import (PartitionSettings, parse_partition_table, plan_partitions, resolve_table)
+
+# name, type, subtype, offset, size
+LAYOUT = [
+    ("nvs", 0x01, 0x02, 0x9000, 0x6000),
+    ("otadata", 0x01, 0x00, 0xF000, 0x2000),
+    ("phy_init", 0x01, 0x01, 0x11000, 0x1000),
+    ("factory", 0x00, 0x00, 0x20000, 0x10000),
+    ("ota_0", 0x00, 0x10, 0x30000, 0x10000),
+]
+
+
+def table_bytes(layout=LAYOUT, md5=True) -> bytes:
+    data = b"".join(struct.pack("<2sBBII16sI", b"\xaa\x50", ptype, subtype, offset, size,
+                                name.encode(), 0) for name, ptype, subtype, offset, size in layout)
+    if md5:
+        data += b"\xeb\xeb" + b"\xff" * 14 + hashlib.md5(data).digest()
+    return data + b"\xff" * (0xC00 - len(data))
+
+
+@pytest.fixture(autouse=True)
+def user_data(tmp_path, monkeypatch):
+    # Split pieces and erase blocks go to the user data folder
+    monkeypatch.setenv("FW_UPLOADER_HOME", str(tmp_path / "home"))
+
+
+def write(tmp_path, name, data) -> str:
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def merged_image(nvs=b"") -> bytearray:
+    """Bootloader, table and factory app in one file from 0x0, blank in between"""
+    image = bytearray(b"\xff" * 0x28000)
+    image[0x1000:0x1100] = b"\xe9" * 0x100
+    image[0x8000:0x8C00] = table_bytes()
+    image[0x9000:0x9000 + len(nvs)] = nvs
+    image[0x20000:0x28000] = b"\x5a" * 0x8000
+    return image
+
+
+def segment_data(plan, address) -> bytes:
+    path = dict(plan.segments)[address]
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# ─────────────────────────────
+# TABLE
+# ─────────────────────────────
+def test_parse_table_with_md5_entry():
+    table = parse_partition_table(table_bytes())
+    assert [p.name for p in table] == ["nvs", "otadata", "phy_init", "factory", "ota_0"]
+    assert table[4].subtype_name == "ota_0" and table[3].type_name == "app"
+
+
+def test_parse_table_rejects_md5_mismatch():
+    data = bytearray(table_bytes())
+    data[0x10] ^= 0x01  # nvs size
+    with pytest.raises(ValueError, match="MD5 mismatch"):
+        parse_partition_table(bytes(data))
+
+
+def test_parse_table_rejects_overlapping_partitions():
+    layout = LAYOUT + [("spiffs", 0x01, 0x82, 0x38000, 0x10000)]
+    with pytest.raises(ValueError, match="spiffs overlaps ota_0"):
+        parse_partition_table(table_bytes(layout))
+
+
+def test_parse_table_rejects_data_that_is_no_table():
+    with pytest.raises(ValueError, match="Not a partition table"):
+        parse_partition_table(b"\x00" * 0xC00)
+
+
+def test_table_is_taken_from_the_image_set(tmp_path):
+    plan = FlashPlan([(0x0, write(tmp_path, "merged.bin", merged_image()))], {})
+    table, source = resolve_table(plan, PartitionSettings())
+    assert source == "image" and len(table) == 5
+
+
+# ─────────────────────────────
+# PLANNING
+# ─────────────────────────────
+def test_protected_partition_with_data_is_refused(tmp_path):
+    plan = FlashPlan([(0x0, write(tmp_path, "merged.bin", merged_image(nvs=b"\x01\x02")))], {})
+    with pytest.raises(ValueError, match="would overwrite protected partition nvs"):
+        plan_partitions(plan, PartitionSettings(), parse_partition_table(table_bytes()))
+
+
+def test_blank_protected_area_is_split_out(tmp_path):
+    image = merged_image()
+    plan = FlashPlan([(0x0, write(tmp_path, "merged.bin", image))], {})
+    result = plan_partitions(plan, PartitionSettings(), parse_partition_table(table_bytes()))
+    assert [address for address, _ in result.segments] == [0x0, 0xF000]
+    # Everything but nvs: bootloader and table up to 0x9000, then from otadata to the end
+    assert segment_data(result, 0x0) == bytes(image[:0x9000])
+    assert segment_data(result, 0xF000) == bytes(image[0xF000:])
+    assert any(note.startswith("Keeping nvs") for note in result.notes)
+
+
+def test_only_writes_the_listed_partitions(tmp_path):
+    image = merged_image()
+    plan = FlashPlan([(0x0, write(tmp_path, "merged.bin", image))], {})
+    settings = PartitionSettings(only=("app",), reset_otadata=False)
+    result = plan_partitions(plan, settings, parse_partition_table(table_bytes()))
+    assert [address for address, _ in result.segments] == [0x20000]
+    assert segment_data(result, 0x20000) == bytes(image[0x20000:])
+
+
+def test_only_without_matching_data_is_refused(tmp_path):
+    plan = FlashPlan([(0x20000, write(tmp_path, "app.bin", b"\x5a" * 0x100))], {})
+    with pytest.raises(ValueError, match="Nothing to write"):
+        plan_partitions(plan, PartitionSettings(only=("phy",)), parse_partition_table(table_bytes()))
+
+
+def test_app_larger_than_its_partition_is_refused(tmp_path):
+    plan = FlashPlan([(0x20000, write(tmp_path, "app.bin", b"\x5a" * 0x10001))], {})
+    with pytest.raises(ValueError, match="does not fit in partition factory"):
+        plan_partitions(plan, PartitionSettings(), parse_partition_table(table_bytes()))
+
+
+def test_writing_the_boot_app_erases_otadata(tmp_path):
+    app = write(tmp_path, "app.bin", b"\x5a" * 0x100)
+    result = plan_partitions(FlashPlan([(0x20000, app)], {}), PartitionSettings(),
+                             parse_partition_table(table_bytes()))
+    assert result.segments[0] == (0xF000, result.segments[0][1])
+    assert segment_data(result, 0xF000) == b"\xff" * 0x2000
+    assert dict(result.segments)[0x20000] == app
+
+
+def test_otadata_is_kept_when_asked_or_for_an_ota_slot(tmp_path):
+    table = parse_partition_table(table_bytes())
+    app = write(tmp_path, "app.bin", b"\x5a" * 0x100)
+    kept = plan_partitions(FlashPlan([(0x20000, app)], {}), PartitionSettings(reset_otadata=False), table)
+    assert kept.segments == [(0x20000, app)]
+    ota = plan_partitions(FlashPlan([(0x30000, app)], {}), PartitionSettings(), table)
+    assert ota.segments == [(0x30000, app)]
+    assert any("decides whether it boots" in note for note in ota.notes)
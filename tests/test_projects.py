@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from uploader.projects import ProjectConfig, validate_project
+
+ESP = {"chip": "esp32", "tool": "esptool", "baud": "921600", "address": "0x10000"}
+AVR = {"chip": "atmega328p", "tool": "stk500", "baud": "115200"}
+# A new modification time for every write, however fast the writes come
+_mtimes = itertools.count(1)
+
+
+@pytest.fixture
+def layers(tmp_path, monkeypatch):
+    """Paths of the site, user and env layer files (the bundled layer is the repo's own config)"""
+    home = tmp_path / "home"
+    home.mkdir()
+    paths = {"site": tmp_path / "site.json", "user": home / "projects_config.json", "env": tmp_path / "env.json"}
+    monkeypatch.setenv("FW_UPLOADER_HOME", str(home))
+    monkeypatch.setenv("FW_UPLOADER_SITE_CONFIG", str(paths["site"]))
+    monkeypatch.setenv("FW_UPLOADER_PROJECTS", str(paths["env"]))
+    return paths
+
+
+def write(path, contents):
+    path.write_text(contents if isinstance(contents, str) else json.dumps(contents))
+    mtime = next(_mtimes) * 10**9
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.mark.parametrize("config, problem", [
+    ({"chip": "esp32", "tool": "esptool", "address": "0x10000"}, 'missing "baud"'),
+    (dict(ESP, colour="red"), 'unknown key "colour"'),
+    (dict(ESP, session="yes"), '"session" must be bool'),
+    (dict(ESP, baud=True), '"baud" must be str or int'),
+    (dict(ESP, tool="openocd"), '"tool" must be one of'),
+    ({"chip": "esp32", "tool": "esptool", "baud": "921600"}, 'need "address" or "segments"'),
+    (dict(ESP, baud="fast"), '"baud" must be a number or "auto"'),
+    (dict(ESP, verify="twice"), '"verify" must be one of'),
+    (dict(ESP, address="0xZZ"), "invalid literal"),
+    (dict(ESP, usb={"pid": "55D4"}), "needs at least a vid"),
+])
+def test_validate_project_problems(config, problem):
+    problems = validate_project(config)
+    assert any(problem in text for text in problems), problems
+
+
+def test_validate_project_accepts_complete_configs():
+    assert validate_project(ESP) == []
+    assert validate_project(dict(AVR, baud=115200, usb=[{"vid": "1A86"}], verify="full")) == []
+
+
+def test_layers_merge_key_by_key(layers):
+    write(layers["site"], {"Board": dict(ESP, port_hint="CP2102"), "Nano": AVR})
+    write(layers["user"], {"Board": {"baud": "460800"}})
+    write(layers["env"], {"Board": {"verify": "full"}})
+    registry = ProjectConfig().reload()
+    assert dict(registry.projects["Board"]) == dict(ESP, port_hint="CP2102", baud="460800", verify="full")
+    assert dict(registry.projects["Nano"]) == AVR
+    assert [layer for layer, _, loaded in registry.sources if loaded] == ["built-in", "bundled", "site", "user", "env"]
+
+
+def test_null_removes_a_project_from_earlier_layers(layers):
+    write(layers["site"], {"Board": ESP, "Nano": AVR})
+    write(layers["user"], {"Nano": None, "Aircue Receiver": None})
+    registry = ProjectConfig().reload()
+    assert "Nano" not in registry.projects
+    assert "Aircue Receiver" not in registry.projects
+    assert "Board" in registry.names
+
+
+def test_a_rejected_project_leaves_the_others_loaded(layers):
+    write(layers["site"], {"Board": ESP, "Nano": AVR})
+    write(layers["user"], {"Nano": {"tool": "openocd"}, "Broken": "not an object"})
+    registry = ProjectConfig().reload()
+    assert "Board" in registry.names
+    assert "Nano" not in registry.projects
+    assert "Broken" not in registry.projects
+    assert any("'Nano' skipped" in problem and '"tool"' in problem for problem in registry.problems)
+    assert any("'Broken' must be an object" in problem for problem in registry.problems)
+
+
+def test_a_file_that_fails_to_parse_keeps_its_last_good_contents(layers):
+    config = ProjectConfig()
+    write(layers["user"], {"Board": ESP})
+    first = config.reload()
+    assert "Board" in first.projects and not first.problems
+
+    write(layers["user"], '{"Board": {"chip": "esp32",')
+    assert config.changed()
+    second = config.reload()
+    assert second.generation > first.generation
+    assert dict(second.projects["Board"]) == ESP
+    assert any("keeping the previous version" in problem for problem in second.problems)
+
+    write(layers["user"], {"Board": dict(ESP, baud="460800")})
+    third = config.reload()
+    assert third.projects["Board"]["baud"] == "460800"
+    assert not third.problems
+
+
+def test_a_file_that_never_parsed_contributes_nothing(layers):
+    write(layers["env"], "[1, 2, 3]")
+    registry = ProjectConfig().reload()
+    assert any("expected an object of projects" in problem for problem in registry.problems)
+    assert "keeping the previous version" not in " ".join(registry.problems)
+    assert "Aircue Receiver" in registry.names
+
+
+def test_reload_keeps_the_registry_when_nothing_changed(layers):
+    config = ProjectConfig()
+    write(layers["site"], {"Board": ESP})
+    registry = config.reload()
+    assert config.reload() is registry
+    write(layers["site"], {"Board": dict(ESP, baud="115200")})
+    assert config.reload() is not registry
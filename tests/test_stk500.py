@@ -0,0 +1,253 @@
+import asyncio
+
+import pytest
+
+from uploader import stk500
+from uploader.core import VERIFY_FULL, VERIFY_HASH
+from uploader.stk500 import (AVR_PARTS, CRC_EOP, STK_INSYNC, STK_OK, Stk500Programmer, image_pages,
+                             parse_intel_hex, run_stk500)
+
+PART = AVR_PARTS["atmega328p"]
+
+
+def record(record_type: int, offset: int, data: bytes = b"") -> str:
+    body = bytes([len(data), offset >> 8, offset & 0xFF, record_type]) + data
+    return ":" + (body + bytes([-sum(body) & 0xFF])).hex().upper()
+
+
+def hex_file(*records: str) -> str:
+    return "\n".join(records + (record(0x01, 0),)) + "\n"
+
+
+class FakeSerial:
+    """Optiboot on the other end of an AsyncSerial, answering from an in-memory flash"""
+
+    def __init__(self, port=None, baud=None, part=PART):
+        self.part = part
+        self.flash = bytearray(b"\xff" * part.flash_size)
+        self.address = 0
+        self.written = []
+        self.read_back = []
+        self._pending = bytearray()
+        self._out = bytearray()
+
+    def close(self):
+        pass
+
+    def set_modem_lines(self, dtr, rts):
+        pass
+
+    def reset_input_buffer(self):
+        self._out.clear()
+
+    def write(self, data: bytes):
+        self._pending += data
+        while self._command():
+            pass
+
+    async def read(self, count: int, timeout: float) -> bytes:
+        data = bytes(self._out[:count])
+        del self._out[:count]
+        return data
+
+    def _reply(self, payload: bytes = b""):
+        self._out += bytes([STK_INSYNC]) + payload + bytes([STK_OK])
+
+    def _command(self) -> bool:
+        buf = self._pending
+        if not buf:
+            return False
+        cmd = buf[0]
+        if cmd in (stk500.STK_PROG_PAGE, stk500.STK_READ_PAGE):
+            length = (buf[1] << 8) | buf[2]
+            total = 5 + (length if cmd == stk500.STK_PROG_PAGE else 0)
+            address = self.address * 2
+            if cmd == stk500.STK_PROG_PAGE:
+                self.flash[address:address + length] = buf[4:4 + length]
+                self.written.append(address)
+                self._reply()
+            else:
+                self.read_back.append(address)
+                self._reply(bytes(self.flash[address:address + length]))
+        elif cmd == stk500.STK_LOAD_ADDRESS:
+            total = 4
+            self.address = buf[1] | (buf[2] << 8)
+            self._reply()
+        elif cmd == stk500.STK_READ_SIGN:
+            total = 2
+            self._reply(self.part.signature)
+        else:
+            total = 2
+            self._reply()
+        assert buf[total - 1] == CRC_EOP
+        del buf[:total]
+        return True
+
+
+# ─────────────────────────────
+# INTEL HEX
+# ─────────────────────────────
+def test_parse_intel_hex_merges_contiguous_records():
+    text = hex_file(record(0x00, 0x0000, b"\x01\x02"), record(0x00, 0x0002, b"\x03"),
+                    record(0x00, 0x0100, b"\x04"))
+    assert parse_intel_hex(text) == [(0x0000, bytearray(b"\x01\x02\x03")), (0x0100, bytearray(b"\x04"))]
+
+
+def test_parse_intel_hex_rejects_bad_checksum():
+    good = record(0x00, 0x0000, b"\x01\x02")
+    bad = good[:-2] + "%02X" % ((int(good[-2:], 16) + 1) & 0xFF)
+    with pytest.raises(ValueError, match="line 1: bad checksum"):
+        parse_intel_hex(hex_file(bad))
+
+
+def test_parse_intel_hex_rejects_bad_length():
+    with pytest.raises(ValueError, match="bad length"):
+        parse_intel_hex(":0500000001FA\n")
+
+
+def test_parse_intel_hex_extended_segment_address():
+    # Type 02: base = value << 4
+    text = hex_file(record(0x02, 0, b"\x10\x00"), record(0x00, 0x0010, b"\xaa"))
+    assert parse_intel_hex(text) == [(0x10010, bytearray(b"\xaa"))]
+
+
+def test_parse_intel_hex_extended_linear_address():
+    # Type 04: base = value << 16
+    text = hex_file(record(0x04, 0, b"\x00\x01"), record(0x00, 0x0020, b"\xbb"),
+                    record(0x04, 0, b"\x00\x00"), record(0x00, 0x0000, b"\xcc"))
+    assert parse_intel_hex(text) == [(0x00000, bytearray(b"\xcc")), (0x10020, bytearray(b"\xbb"))]
+
+
+def test_parse_intel_hex_stops_at_end_of_file():
+    text = record(0x00, 0, b"\x01") + "\n" + record(0x01, 0) + "\n" + record(0x00, 0x10, b"\x02") + "\n"
+    assert parse_intel_hex(text) == [(0, bytearray(b"\x01"))]
+
+
+# ─────────────────────────────
+# PAGES
+# ─────────────────────────────
+def test_image_pages_splits_runs_across_page_boundaries():
+    data = bytes(range(16))
+    pages = image_pages([(PART.page_size - 8, data)], PART)
+    assert [address for address, _ in pages] == [0, PART.page_size]
+    first, second = pages[0][1], pages[1][1]
+    assert len(first) == len(second) == PART.page_size
+    assert first[:-8] == b"\xff" * (PART.page_size - 8) and first[-8:] == data[:8]
+    assert second[:8] == data[8:] and second[8:] == b"\xff" * (PART.page_size - 8)
+
+
+def test_image_pages_merges_runs_on_one_page():
+    pages = image_pages([(0, b"\x01"), (4, b"\x02")], PART)
+    assert len(pages) == 1
+    assert pages[0][1][:5] == b"\x01\xff\xff\xff\x02"
+
+
+def test_image_pages_writes_blank_pages_inside_the_image():
+    # Optiboot only erases the pages it is sent: a blank page or gap must be written
+    blank = b"\xff" * PART.page_size
+    pages = image_pages([(0, b"\x00" * PART.page_size + blank + b"\x01"), (4 * PART.page_size, b"\x02")], PART)
+    assert [address for address, _ in pages] == [page * PART.page_size for page in range(5)]
+    assert pages[1][1] == pages[3][1] == blank
+
+
+def test_image_pages_trims_blank_pages_at_either_end():
+    blank = b"\xff" * PART.page_size
+    pages = image_pages([(0, blank + b"\x01" + b"\xff" * (PART.flash_size - PART.page_size - 1))], PART)
+    assert [address for address, _ in pages] == [PART.page_size]
+    assert image_pages([(0, blank)], PART) == []
+
+
+def test_image_pages_rejects_image_beyond_flash():
+    with pytest.raises(ValueError, match="beyond"):
+        image_pages([(PART.flash_size - 1, b"\x00\x00")], PART)
+
+
+# ─────────────────────────────
+# PROGRAMMER
+# ─────────────────────────────
+def test_write_and_read_page_round_trip():
+    async def run():
+        programmer = Stk500Programmer.__new__(Stk500Programmer)
+        programmer.serial = FakeSerial()
+        page = bytes(range(PART.page_size))
+        await programmer.write_page(0x100, page)
+        assert programmer.serial.flash[0x100:0x100 + PART.page_size] == page
+        return await programmer.read_page(0x100, PART.page_size)
+
+    assert asyncio.run(run()) == bytes(range(PART.page_size))
+
+
+def flash_with_fake(monkeypatch, tmp_path, policy, corrupt=None):
+    serials = []
+
+    def make_serial(port, baud):
+        serial = FakeSerial(port, baud)
+        if corrupt is not None:
+            original = serial._command
+
+            def command():
+                handled = original()
+                # The chip keeps one byte of this page erased
+                serial.flash[corrupt] = 0xFF
+                return handled
+            serial._command = command
+        serials.append(serial)
+        return serial
+
+    monkeypatch.setattr(stk500, "AsyncSerial", make_serial)
+
+    async def no_sleep(delay):
+        pass
+    monkeypatch.setattr(stk500.asyncio, "sleep", no_sleep)
+
+    firmware = tmp_path / "app.bin"
+    firmware.write_bytes(bytes(i & 0x7F for i in range(20 * PART.page_size)))
+    config = {"tool": "stk500", "chip": "atmega328p", "baud": 115200, "verify": policy}
+    log = []
+    returncode = asyncio.run(run_stk500(config, "/dev/fake", str(firmware), log.append))
+    return returncode, serials[0], "".join(log)
+
+
+@pytest.mark.parametrize("config, firmware, error", [
+    ({"chip": "attiny85"}, b"\x00", "not supported"),
+    ({}, b"\x00" * (PART.flash_size + 1), "beyond"),
+    ({"verify": "sometimes"}, b"\x00", "Unknown verify policy"),
+])
+def test_setup_errors_raise_instead_of_failing_the_attempt(monkeypatch, tmp_path, config, firmware, error):
+    # ValueError tells the job queue not to retry (see core.flash_attempt)
+    monkeypatch.setattr(stk500, "AsyncSerial", FakeSerial)
+    path = tmp_path / "app.bin"
+    path.write_bytes(firmware)
+    config = dict({"tool": "stk500", "chip": "atmega328p", "baud": 115200}, **config)
+    with pytest.raises(ValueError, match=error):
+        asyncio.run(run_stk500(config, "/dev/fake", str(path), lambda text: None))
+
+
+def test_malformed_hex_raises(tmp_path):
+    path = tmp_path / "app.hex"
+    path.write_text(":0100000001FF\n")
+    config = {"tool": "stk500", "chip": "atmega328p", "baud": 115200}
+    with pytest.raises(ValueError, match="Invalid HEX record"):
+        asyncio.run(run_stk500(config, "/dev/fake", str(path), lambda text: None))
+
+
+def test_full_verify_reads_back_every_page(monkeypatch, tmp_path):
+    returncode, serial, log = flash_with_fake(monkeypatch, tmp_path, VERIFY_FULL)
+    assert returncode == 0
+    assert serial.written == [page * PART.page_size for page in range(20)]
+    assert serial.read_back == serial.written
+    assert "Verified 2560 bytes" in log
+
+
+def test_hash_verify_reads_back_the_checksum_region(monkeypatch, tmp_path):
+    returncode, serial, log = flash_with_fake(monkeypatch, tmp_path, VERIFY_HASH)
+    assert returncode == 0
+    assert serial.read_back == [page * PART.page_size for page in (0, 8, 16, 19)]
+    assert "4 of 20 pages" in log
+
+
+@pytest.mark.parametrize("policy", [VERIFY_FULL, VERIFY_HASH])
+def test_verify_detects_a_bad_page(monkeypatch, tmp_path, policy):
+    returncode, _, log = flash_with_fake(monkeypatch, tmp_path, policy, corrupt=8 * PART.page_size + 3)
+    assert returncode == 1
+    assert "Verify failed" in log